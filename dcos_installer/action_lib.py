@@ -1,7 +1,12 @@
 import asyncio
+import functools
+import hashlib
 import json
 import logging
 import os
+import re
+import shlex
+import tarfile
 from typing import Optional
 
 import pkgpanda
@@ -22,14 +27,22 @@ REMOTE_TEMP_DIR = '/opt/dcos_install_tmp'
 log = logging.getLogger(__name__)
 
 
-def get_async_runner(config, hosts, async_delegate=None):
+def get_async_runner(config, hosts, async_delegate=None, process_timeout=None):
     # TODO(cmaloney): Delete these repeats. Use gen / expanded configuration to get all the values.
-    process_timeout = config.hacky_default_get('process_timeout', 120)
+    if process_timeout is None:
+        process_timeout = config.hacky_default_get('process_timeout', 120)
     extra_ssh_options = config.hacky_default_get('extra_ssh_options', '')
     ssh_key_path = config.hacky_default_get('ssh_key_path', SSH_KEY_PATH)
 
     # if ssh_parallelism is not set, use 20 concurrent ssh sessions by default.
-    parallelism = config.hacky_default_get('ssh_parallelism', 20)
+    parallelism = int(config.hacky_default_get('ssh_parallelism', 20))
+    # copies (scp, streamed bundles) are limited separately, by default to as many as other commands.
+    copy_parallelism = int(config.hacky_default_get('ssh_copy_parallelism', parallelism))
+    adaptive = str(config.hacky_default_get('ssh_adaptive_parallelism', 'false')).lower() == 'true'
+
+    # if ssh_fanout is set, hosts relay the deploy bundle to each other rather than each of them getting it
+    # from this host. This forwards an agent holding the ssh key to the relaying hosts, see ssh.validate.
+    fanout = int(config.hacky_default_get('ssh_fanout', 0))
 
     return ssh.runner.MultiRunner(
         hosts,
@@ -39,7 +52,10 @@ def get_async_runner(config, hosts, async_delegate=None):
         extra_opts=extra_ssh_options,
         async_delegate=async_delegate,
         parallelism=parallelism,
-        default_port=int(config.hacky_default_get('ssh_port', 22)))
+        copy_parallelism=copy_parallelism,
+        adaptive=adaptive,
+        default_port=int(config.hacky_default_get('ssh_port', 22)),
+        fanout=fanout)
 
 
 def add_pre_action(chain, ssh_user):
@@ -55,6 +71,15 @@ def add_post_action(chain):
                       stage='Cleaning up temporary directory')
 
 
+def _add_deploy_post_action(chain):
+    # Keep a delivered bundle on hosts which failed to install, so retrying the deploy can resume from it.
+    script = (
+        'if [ -e {dir}/.bundle_id ] && [ ! -e {dir}/.installed ]; then '
+        'echo "Keeping {dir} to resume the deploy"; exit 0; fi; '
+        'sudo rm -rf {dir}').format(dir=shlex.quote(REMOTE_TEMP_DIR))
+    chain.add_execute(['sh', '-c', shlex.quote(script)], stage='Cleaning up temporary directory')
+
+
 class ExecuteException(Exception):
     """Raised when execution fails"""
 
@@ -102,6 +127,10 @@ def run_preflight(config, pf_script_path=(SERVE_DIR + '/dcos_install.sh'), block
     targets = get_full_nodes_list(config)
 
     pf = get_async_runner(config, targets, async_delegate=async_delegate)
+    if str(config.hacky_default_get('ssh_batched_preflight', 'false')).lower() == 'true':
+        result = yield from _run_batched_preflight(config, pf, pf_script_path, block, state_json_dir)
+        return result
+
     chains = []
 
     preflight_chain = ssh.utils.CommandChain('preflight')
@@ -124,6 +153,69 @@ def run_preflight(config, pf_script_path=(SERVE_DIR + '/dcos_install.sh'), block
     return result
 
 
+def get_piped_script_cmd(args):
+    '''
+    Get the command which saves the bash script piped to it and runs it as root with the given arguments, so
+    a script can be sent and run within a single ssh session.
+    '''
+    script = (
+        'f=$(mktemp) && cat > "$f" && sudo bash "$f" {}; '
+        'rc=$?; rm -f "$f"; exit $rc').format(' '.join(shlex.quote(arg) for arg in args))
+    return ['sh', '-c', shlex.quote(script)]
+
+
+PREFLIGHT_CHECK_REGEX = re.compile(r'^(?P<name>.*?)[:\s]*\b(?P<result>PASS|FAIL)\b\s*(?P<output>.*)$')
+
+
+def parse_preflight_output(stdout, returncode):
+    '''
+    Turn the PASS / FAIL lines printed by dcos_install.sh --preflight-only into a check runner response, which
+    PrettyPrint prints the same way as the postflight checks.
+    :param stdout: list of lines printed by the preflight checks
+    :param returncode: Int, exit code of the preflight checks
+    :return: Dict, check runner response
+    '''
+    checks = {}
+    check = None
+    for line in stdout:
+        match = PREFLIGHT_CHECK_REGEX.match(line)
+        if match:
+            # Some checks print their name after the result.
+            name, output = match.group('name'), match.group('output')
+            if not name:
+                name, output = output, ''
+            check = checks[name] = {'status': 0 if match.group('result') == 'PASS' else 2, 'output': output}
+        elif check is not None and line.strip():
+            # Failed checks explain themselves on the lines that follow.
+            check['output'] = '\n'.join(filter(None, [check['output'], line]))
+
+    if not checks and returncode != 0:
+        return {'error': '\n'.join(stdout) or 'Preflight checks exited with {}'.format(returncode)}
+    return {
+        'status': 0 if returncode == 0 and all(c['status'] == 0 for c in checks.values()) else 2,
+        'checks': checks}
+
+
+@asyncio.coroutine
+def _run_batched_preflight(config, pf, pf_script_path, block, state_json_dir):
+    # A single ssh session per host, which receives the script on stdin and runs it. There is no temporary
+    # directory to set up nor to clean up. Sessions have no tty to keep stdin clean, so sudo must not
+    # require one.
+    preflight_chain = ssh.utils.CommandChain('preflight')
+    preflight_chain.add_pipe(pf_script_path, get_piped_script_cmd(['--preflight-only', 'master']),
+                             stage='Executing preflight check')
+
+    result = yield from pf.run_commands_chain_async([preflight_chain], block=block, state_json_dir=state_json_dir,
+                                                    delegate_extra_params=nodes_count_by_type(config))
+    if block:
+        for host_result in result:
+            for command_result in host_result:
+                for process_result in command_result.values():
+                    process_result['checks'] = parse_preflight_output(
+                        process_result['stdout'], process_result['returncode'])
+    return result
+
+
 def _add_copy_dcos_install(chain, local_install_path=SERVE_DIR):
     dcos_install_script = 'dcos_install.sh'
     local_install_path = os.path.join(local_install_path, dcos_install_script)
@@ -160,6 +252,81 @@ def _add_copy_bootstap(chain, local_bs_path):
                    stage='Copying bootstrap')
 
 
+def _get_deploy_bundle_files(bootstrap_tarball, cluster_package_list, local_install_path=SERVE_DIR):
+    '''
+    List the files a node needs to install DC/OS.
+    :return: list of (local path, path relative to REMOTE_TEMP_DIR) tuples, matching the layout the
+             individual copies of _add_copy_* produce.
+    '''
+    if not os.path.isfile(CLUSTER_PACKAGES_PATH):
+        err_msg = '{} not found'.format(CLUSTER_PACKAGES_PATH)
+        log.error(err_msg)
+        raise ExecuteException(err_msg)
+
+    files = [(os.path.join(local_install_path, 'dcos_install.sh'), 'dcos_install.sh')]
+    cluster_packages = pkgpanda.load_json(CLUSTER_PACKAGES_PATH)
+    for package, params in sorted(cluster_packages.items()):
+        local_pkg_path = os.path.join(local_install_path, params['filename'])
+        files.append((local_pkg_path, os.path.join('packages', package, os.path.basename(local_pkg_path))))
+    files.append((bootstrap_tarball, os.path.join('bootstrap', os.path.basename(bootstrap_tarball))))
+    files.append((cluster_package_list, os.path.join('package_lists', os.path.basename(cluster_package_list))))
+    return files
+
+
+def _get_deploy_bundle_id(files):
+    '''
+    Get the id of the bundle of the given files, a hash of their names, sizes and modification times.
+    :param files: list of (local path, path in the bundle) tuples
+    '''
+    manifest = []
+    for local_path, arcname in files:
+        stat = os.stat(local_path)
+        manifest.append([arcname, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+
+def _write_deploy_bundle(files, fileobj):
+    '''
+    Write a tar stream of the given files to fileobj, so they can be sent to a node over a single ssh
+    session. The bundle is never stored locally. The packages and the bootstrap tarball are compressed
+    already, so the bundle is not.
+    :param files: list of (local path, path in the bundle) tuples
+    '''
+    with tarfile.open(fileobj=fileobj, mode='w|') as bundle:
+        for local_path, arcname in files:
+            bundle.add(local_path, arcname=arcname)
+
+
+def _get_extract_bundle_cmd(bundle_id, files):
+    '''
+    Get the command extracting a deploy bundle into REMOTE_TEMP_DIR from stdin.
+    A host checkpoints a complete extraction by writing the bundle id (the hash of its manifest) next to
+    the files. A retried deploy checks that id and the sizes of all the files with a single stat, and
+    skips the transfer when they match, without reading the bundle from stdin.
+    '''
+    expected = '\n'.join('{} {}'.format(os.path.getsize(local_path), arcname) for local_path, arcname in files)
+    script = (
+        'cd {dir} && '
+        'if [ "$(cat .bundle_id 2>/dev/null)" = {id} ] && '
+        '[ "$(stat -c \'%s %n\' {names} 2>/dev/null)" = {expected} ]; then '
+        'echo "Bundle {id} was delivered already"; exit 0; fi; '
+        'rm -f .bundle_id .installed && tar -x -f - && echo {id} > .bundle_id').format(
+            dir=shlex.quote(REMOTE_TEMP_DIR),
+            id=bundle_id,
+            names=' '.join(shlex.quote(arcname) for _, arcname in files),
+            expected=shlex.quote(expected))
+    return ['sh', '-c', shlex.quote(script)]
+
+
+def _add_copy_bundle(chain, files):
+    # Hosts which received the bundle can relay it by archiving its extracted files again.
+    members = sorted({arcname.split(os.sep)[0] for _, arcname in files})
+    chain.add_pipe(functools.partial(_write_deploy_bundle, files),
+                   _get_extract_bundle_cmd(_get_deploy_bundle_id(files), files),
+                   relay_cmd=['tar', '-c', '-f', '-', '-C', REMOTE_TEMP_DIR] + members,
+                   stage='Copying DC/OS installation bundle')
+
+
 def _get_bootstrap_tarball(tarball_base_dir=BOOTSTRAP_DIR):
     '''
     Get a bootstrap tarball from a local filesystem
@@ -211,21 +378,12 @@ def _read_state_file(state_file):
 
 
 def _remove_host(state_file, host):
-
-    json_state = _read_state_file(state_file)
-
-    if 'hosts' not in json_state or host not in json_state['hosts']:
+    state_dir, filename = os.path.split(state_file)
+    store = ssh.utils.ChainStateStore(state_dir, os.path.splitext(filename)[0])
+    if not store.remove_host(host):
         return False
 
     log.debug('removing host {} from {}'.format(host, state_file))
-    try:
-        del json_state['hosts'][host]
-    except KeyError:
-        return False
-
-    with open(state_file, 'w') as fh:
-        json.dump(json_state, fh)
-
     return True
 
 
@@ -287,14 +445,20 @@ def install_dcos(
     chains.append(chain)
 
     add_pre_action(chain, runner.user)
-    _add_copy_dcos_install(chain)
-    _add_copy_packages(chain)
-    _add_copy_bootstap(chain, bootstrap_tarball)
-    _add_copy_package_list(chain, cluster_package_list)
+    if str(config.hacky_default_get('ssh_bundle_transfer', 'true')).lower() == 'true':
+        # Stream everything a node needs through one ssh session instead of a copy per file.
+        bundle_files = _get_deploy_bundle_files(bootstrap_tarball, cluster_package_list)
+        _add_copy_bundle(chain, bundle_files)
+    else:
+        _add_copy_dcos_install(chain)
+        _add_copy_packages(chain)
+        _add_copy_bootstap(chain, bootstrap_tarball)
+        _add_copy_package_list(chain, cluster_package_list)
 
     chain.add_execute(
         lambda node: (
-            'sudo bash {}/dcos_install.sh {}'.format(REMOTE_TEMP_DIR, node.tags['dcos_install_param'])).split(),
+            'sudo bash {dir}/dcos_install.sh {role} && touch {dir}/.installed'.format(
+                dir=REMOTE_TEMP_DIR, role=node.tags['dcos_install_param'])).split(),
         stage=lambda node: 'Installing DC/OS'
     )
 
@@ -312,7 +476,7 @@ def install_dcos(
 
     # Setup the cleanup chain
     cleanup_chain = ssh.utils.CommandChain('deploy_cleanup')
-    add_post_action(cleanup_chain)
+    _add_deploy_post_action(cleanup_chain)
     chains.append(cleanup_chain)
 
     result = yield from runner.run_commands_chain_async(chains, block=block, state_json_dir=state_json_dir,
@@ -0,0 +1,141 @@
+"""
+Serve the installer artifacts in genconf/serve to the nodes over HTTP
+"""
+
+import email.utils
+import http.server
+import logging
+import mimetypes
+import os
+import re
+import socketserver
+import threading
+import urllib.parse
+
+from dcos_installer.constants import SERVE_DIR
+
+log = logging.getLogger(__name__)
+
+RANGE_REGEX = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_etag(stat):
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(range_header, size):
+    """
+    Parse a Range header for a file of the given size.
+    :return: (first byte, last byte) tuple, None when the whole file should be sent, which is the case for
+             headers with several ranges, or False when the range is unsatisfiable.
+    """
+    match = RANGE_REGEX.match(range_header.strip())
+    if not match:
+        return None
+
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # The last N bytes of the file.
+        if int(last) == 0:
+            return False
+        return max(size - int(last), 0), size - 1
+
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first > last:
+        return False
+    return first, last
+
+
+class ArtifactRequestHandler(http.server.BaseHTTPRequestHandler):
+    # Keep connections alive, dcos_install.sh fetches many files in a row.
+    protocol_version = 'HTTP/1.1'
+    server_version = 'dcos-installer'
+
+    def do_GET(self):  # noqa: ignore=N802
+        self.serve_file(send_body=True)
+
+    def do_HEAD(self):  # noqa: ignore=N802
+        self.serve_file(send_body=False)
+
+    def log_message(self, format, *args):
+        log.debug('%s - %s', self.address_string(), format % args)
+
+    def translate_path(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        full_path = os.path.realpath(os.path.join(self.server.root, path.lstrip('/')))
+        if not full_path.startswith(self.server.root + os.sep) or not os.path.isfile(full_path):
+            return None
+        return full_path
+
+    def serve_file(self, send_body):
+        path = self.translate_path()
+        if path is None:
+            self.send_error(404)
+            return
+
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            etag = get_etag(stat)
+            if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            byte_range = None
+            if 'Range' in self.headers and self.headers.get('If-Range', etag) == etag:
+                byte_range = parse_range(self.headers['Range'], stat.st_size)
+            if byte_range is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(stat.st_size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            if byte_range is None:
+                offset, count = 0, stat.st_size
+                self.send_response(200)
+            else:
+                offset, count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1], stat.st_size))
+            self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            self.send_header('Content-Length', str(count))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', email.utils.formatdate(stat.st_mtime, usegmt=True))
+            self.end_headers()
+
+            if send_body and count:
+                # Transfers beyond the limit wait for a slot rather than fail, the nodes don't retry.
+                with self.server.transfer_slots:
+                    # socket.sendfile() hands the file to the kernel with sendfile(2), without copying it through
+                    # userspace.
+                    self.connection.sendfile(f, offset, count)
+
+
+class ArtifactServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    # Many nodes start their downloads at once during a deploy.
+    request_queue_size = 128
+
+    def __init__(self, address, root, max_transfers):
+        self.root = os.path.realpath(root)
+        self.transfer_slots = threading.BoundedSemaphore(max_transfers)
+        super().__init__(address, ArtifactRequestHandler)
+
+
+def serve_artifacts(serve_dir=SERVE_DIR, port=9000, max_transfers=64):
+    server = ArtifactServer(('', port), serve_dir, max_transfers)
+    log.warning('Serving {} on port {}, at most {} transfers at once'.format(serve_dir, port, max_transfers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
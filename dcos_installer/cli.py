@@ -11,10 +11,12 @@ from passlib.hash import sha512_crypt
 import dcos_installer.config
 import dcos_installer.constants
 import gen.calc
-from dcos_installer import action_lib, backend
+import gen.internals
+from dcos_installer import action_lib, artifact_server, backend, upgrade
 from dcos_installer.config import Config
 from dcos_installer.installer_analytics import InstallerAnalytics
 from dcos_installer.prettyprint import PrettyPrint, print_header
+from pkgpanda.util import write_json, write_string
 
 from ssh.utils import AbstractSSHLibDelegate
 
@@ -55,6 +57,9 @@ class CliDelegate(AbstractSSHLibDelegate):
     def prepare_status(self, name, nodes):
         pass
 
+    def on_output(self, name, host, stage, stream, line):
+        log.debug('{}:{} {}: {}'.format(host.ip, host.port, stage or name, line))
+
 
 def run_loop(action, options):
     assert callable(action)
@@ -116,10 +121,23 @@ def do_version(args):
     return 0
 
 
+def write_validate_profile(profile):
+    os.makedirs(dcos_installer.constants.STATE_DIR, exist_ok=True)
+    write_json(dcos_installer.constants.VALIDATE_PROFILE_JSON_PATH, profile.to_dict())
+    write_string(dcos_installer.constants.VALIDATE_PROFILE_STACKS_PATH, profile.folded_stacks())
+    print("Configuration resolution took {:.3f}s. Wrote profile to {} and flame graph stacks to {}".format(
+        profile.total_seconds,
+        dcos_installer.constants.VALIDATE_PROFILE_JSON_PATH,
+        dcos_installer.constants.VALIDATE_PROFILE_STACKS_PATH))
+
+
 def do_validate_config(args):
     log_warn_only()
     config = Config(dcos_installer.constants.CONFIG_PATH)
-    validation_errors = config.do_validate(include_ssh=True)
+    profile = gen.internals.ResolverProfile() if args.profile else None
+    validation_errors = config.do_validate(include_ssh=True, profile=profile)
+    if profile is not None:
+        write_validate_profile(profile)
     if validation_errors:
         print_validation_errors(validation_errors)
         return 1
@@ -146,6 +164,11 @@ dispatch_dict_simple = {
         do_validate_config,
         'VALIDATING CONFIGURATION',
         'Validate the configuration for executing --genconf and deploy arguments in config.yaml'),
+    'serve': (
+        lambda args: artifact_server.serve_artifacts(
+            dcos_installer.constants.SERVE_DIR, args.port, args.max_transfers),
+        'SERVING DC/OS INSTALL FILES',
+        'Serve the files --genconf created to the nodes over HTTP on --port.'),
     'aws-cloudformation': (
         lambda args: backend.do_aws_cf_configure(),
         'EXECUTING AWS CLOUD FORMATION TEMPLATE GENERATION',
@@ -211,6 +234,16 @@ def dispatch(args):
         status = backend.generate_node_upgrade_script(args.installed_cluster_version)
         sys.exit(status)
 
+    if args.action == 'upgrade-nodes':
+        if args.installed_cluster_version is None:
+            print('Must provide the version of the cluster upgrading from')
+            sys.exit(1)
+        if do_validate_config(args) != 0:
+            sys.exit(1)
+        print_header('EXECUTING NODE UPGRADE')
+        errors = run_loop(upgrade.upgrade_nodes, args)
+        sys.exit(1 if errors > 0 else 0)
+
     if args.action in dispatch_dict_simple:
         action = dispatch_dict_simple[args.action]
         if action[1] is not None:
@@ -279,6 +312,16 @@ def get_argument_parser():
         help='Generate a script that upgrades DC/OS nodes running installed_cluster_version'
     )
 
+    mutual_exc.add_argument(
+        '--upgrade-nodes',
+        action=ArgsAction,
+        metavar='installed_cluster_version',
+        dest='installed_cluster_version',
+        nargs='?',
+        help='Upgrade the DC/OS nodes running installed_cluster_version over ssh, masters one at a time and '
+             'agents in batches of --agent-batch-size'
+    )
+
     parser.add_argument(
         '-v',
         '--verbose',
@@ -290,7 +333,13 @@ def get_argument_parser():
         '--port',
         type=int,
         default=9000,
-        help=argparse.SUPPRESS)
+        help='Port --serve listens on')
+
+    parser.add_argument(
+        '--max-transfers',
+        type=int,
+        default=64,
+        help='Number of files --serve sends at once, further requests wait for their turn')
 
     parser.add_argument(
         '--offline',
@@ -298,6 +347,25 @@ def get_argument_parser():
         help='Do not install preflight prerequisites on CentOS7, RHEL7 in web mode'
     )
 
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Record where configuration validation spends its time and write it to {}'.format(
+            dcos_installer.constants.STATE_DIR))
+
+    parser.add_argument(
+        '--agent-batch-size',
+        type=int,
+        default=1,
+        help='Number of agents --upgrade-nodes upgrades at once')
+
+    parser.add_argument(
+        '--upgrade-timeout',
+        type=int,
+        default=900,
+        help='Seconds --upgrade-nodes waits for the upgrade script on a node. This covers fetching the packages '
+             'and the up to 300 seconds of health checks after activating them')
+
     parser.add_argument(
         '--cli-telemetry-disabled',
         action='store_true',
@@ -83,6 +83,9 @@ class Config():
     def __init__(self, config_path):
         self.config_path = config_path
 
+        # Re-validating after an update() only recalculates what the updated arguments affect.
+        self._resolver_cache = gen.internals.ResolverCache()
+
         # Create the config file iff allowed and there isn't one provided by the user.
 
         self._config = self._load_config()
@@ -118,7 +121,7 @@ class Config():
     def as_gen_format(self):
         return gen.stringify_configuration(self._config)
 
-    def do_validate(self, include_ssh):
+    def do_validate(self, include_ssh, profile: gen.internals.ResolverProfile=None):
         user_arguments = self.as_gen_format()
         extra_sources = [onprem_source]
         extra_targets = []
@@ -129,7 +132,7 @@ class Config():
         sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(user_arguments, [], extra_sources)
         targets = targets + extra_targets
 
-        resolver = gen.internals.resolve_configuration(sources, targets)
+        resolver = gen.internals.resolve_configuration(sources, targets, self._resolver_cache, profile)
         # TODO(cmaloney): kill this function and make the API return the structured
         # results api as was always intended rather than the flattened / lossy other
         # format. This will be an  API incompatible change. The messages format was
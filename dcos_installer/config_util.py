@@ -1,3 +1,4 @@
+import errno
 import logging
 import os
 import subprocess
@@ -58,8 +59,27 @@ def do_move_atomic(src_dir, dest_dir, filenames):
         subprocess.check_output(['mkdir', dirname])
 
     def copy(src, dest):
-        created_files.append(dest)
-        subprocess.check_output(['cp', src, dest])
+        # Files already in place were not created here, a rollback leaves them alone.
+        if not os.path.exists(dest):
+            created_files.append(dest)
+        # Artifacts are never modified in place, so the serve dir can share them with the installer rather
+        # than getting copies of them. Linking fails across filesystems, which need the copy.
+        try:
+            try:
+                os.link(src, dest)
+            except FileExistsError:
+                if os.path.samefile(src, dest):
+                    return
+                tmp = dest + '.tmp'
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                os.link(src, tmp)
+                os.replace(tmp, dest)
+        except OSError as ex:
+            if ex.errno not in (errno.EXDEV, errno.EPERM):
+                raise
+            log.debug("Copying %s, unable to hardlink it: %s", src, ex.strerror)
+            subprocess.check_output(['cp', src, dest])
 
     def rollback():
         for filename in reversed(created_files):
@@ -5,6 +5,8 @@ IP_DETECT_PATH = GENCONF_DIR + '/ip-detect'
 CLUSTER_PACKAGES_PATH = GENCONF_DIR + '/cluster_packages.json'
 SERVE_DIR = GENCONF_DIR + '/serve'
 STATE_DIR = GENCONF_DIR + '/state'
+VALIDATE_PROFILE_JSON_PATH = STATE_DIR + '/validate_config_profile.json'
+VALIDATE_PROFILE_STACKS_PATH = STATE_DIR + '/validate_config_profile.folded'
 BOOTSTRAP_DIR = SERVE_DIR + '/bootstrap'
 PACKAGE_LIST_DIR = SERVE_DIR + '/package_lists'
 ARTIFACT_DIR = 'artifacts'
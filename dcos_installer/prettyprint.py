@@ -61,7 +61,10 @@ class PrettyPrint():
             for host in hosts:
                 for ip, data in host.items():
                     log = logging.getLogger(str(ip))
-                    if is_check_command(data['cmd']):
+                    if 'checks' in data:
+                        log.error('====> {} CHECK {}'.format(ip, status))
+                        self._print_checks(ip, CheckRunnerResult(data['checks']))
+                    elif is_check_command(data['cmd']):
                         log.error('====> {} CHECK {}'.format(ip, status))
                         self._print_check_result(ip, data)
                     else:
@@ -91,6 +94,11 @@ class PrettyPrint():
             log.error(check_runner_response_body)
             raise
 
+        cls._print_checks(ip, check_runner_result)
+
+    @classmethod
+    def _print_checks(cls, ip, check_runner_result):
+        log = logging.getLogger(str(ip))
         if check_runner_result.is_error:
             log.error('     ERROR: ' + check_runner_result.error_message)
         else:
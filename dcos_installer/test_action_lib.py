@@ -0,0 +1,99 @@
+import io
+import subprocess
+import tarfile
+
+import pkgpanda.util
+from dcos_installer import action_lib
+from dcos_installer.check import CheckRunnerResult
+
+
+def _make_serve_dir(tmpdir, monkeypatch):
+    serve_dir = tmpdir.join('serve')
+    serve_dir.join('dcos_install.sh').write('#!/bin/bash', ensure=True)
+    serve_dir.join('packages/dcos-config/dcos-config--setup_123.tar.xz').write('config', ensure=True)
+    bootstrap_tarball = serve_dir.join('bootstrap/123.bootstrap.tar.xz')
+    bootstrap_tarball.write('bootstrap', ensure=True)
+    package_list = serve_dir.join('package_lists/456.package_list.json')
+    package_list.write('[]', ensure=True)
+    cluster_packages_path = tmpdir.join('cluster_packages.json')
+    pkgpanda.util.write_json(str(cluster_packages_path), {
+        'dcos-config--setup_123': {'filename': 'packages/dcos-config/dcos-config--setup_123.tar.xz'}})
+    monkeypatch.setattr(action_lib, 'CLUSTER_PACKAGES_PATH', str(cluster_packages_path))
+
+    return serve_dir, bootstrap_tarball, package_list
+
+
+def _get_bundle(files):
+    bundle = io.BytesIO()
+    action_lib._write_deploy_bundle(files, bundle)
+    return bundle.getvalue()
+
+
+def test_deploy_bundle(tmpdir, monkeypatch):
+    serve_dir, bootstrap_tarball, package_list = _make_serve_dir(tmpdir, monkeypatch)
+    files = action_lib._get_deploy_bundle_files(str(bootstrap_tarball), str(package_list), str(serve_dir))
+
+    with tarfile.open(fileobj=io.BytesIO(_get_bundle(files))) as bundle:
+        assert sorted(bundle.getnames()) == [
+            'bootstrap/123.bootstrap.tar.xz',
+            'dcos_install.sh',
+            'package_lists/456.package_list.json',
+            'packages/dcos-config--setup_123/dcos-config--setup_123.tar.xz']
+        assert bundle.extractfile('dcos_install.sh').read() == b'#!/bin/bash'
+
+    # The bundle id stays the same as long as none of its files changed.
+    bundle_id = action_lib._get_deploy_bundle_id(files)
+    assert action_lib._get_deploy_bundle_id(files) == bundle_id
+    package_list.write('["dcos-config--setup_123"]')
+    assert action_lib._get_deploy_bundle_id(files) != bundle_id
+
+
+def test_extract_bundle_resumes(tmpdir, monkeypatch):
+    serve_dir, bootstrap_tarball, package_list = _make_serve_dir(tmpdir, monkeypatch)
+    files = action_lib._get_deploy_bundle_files(str(bootstrap_tarball), str(package_list), str(serve_dir))
+    bundle_id = action_lib._get_deploy_bundle_id(files)
+    remote_dir = tmpdir.join('remote').ensure(dir=True)
+    monkeypatch.setattr(action_lib, 'REMOTE_TEMP_DIR', str(remote_dir))
+
+    def extract():
+        # The command is run by the remote login shell, the same way ssh runs it.
+        cmd = action_lib._get_extract_bundle_cmd(bundle_id, files)
+        return subprocess.check_output(' '.join(cmd), shell=True, input=_get_bundle(files)).decode()
+
+    assert extract() == ''
+    assert remote_dir.join('.bundle_id').read().strip() == bundle_id
+    assert remote_dir.join('dcos_install.sh').read() == '#!/bin/bash'
+
+    # A retry finds the bundle delivered already, checking only the file sizes.
+    remote_dir.join('dcos_install.sh').write('#!/bin/dash')
+    assert 'delivered already' in extract()
+    assert remote_dir.join('dcos_install.sh').read() == '#!/bin/dash'
+
+    # A file which did not arrive in full gets the bundle extracted again.
+    remote_dir.join('bootstrap/123.bootstrap.tar.xz').write('boot')
+    assert extract() == ''
+    assert remote_dir.join('bootstrap/123.bootstrap.tar.xz').read() == 'bootstrap'
+
+
+def test_parse_preflight_output():
+    stdout = [
+        'Running preflight checks',
+        'Checking if DC/OS is already installed: PASS (Not installed)',
+        'PASS Is SELinux disabled?',
+        'Checking if port 53 (required by dcos-net) is in use: FAIL',
+        'Port 53 is used by dnsmasq',
+        '']
+    response = action_lib.parse_preflight_output(stdout, 1)
+    assert response == {
+        'status': 2,
+        'checks': {
+            'Checking if DC/OS is already installed': {'status': 0, 'output': '(Not installed)'},
+            'Is SELinux disabled?': {'status': 0, 'output': ''},
+            'Checking if port 53 (required by dcos-net) is in use': {
+                'status': 2, 'output': 'Port 53 is used by dnsmasq'}}}
+    # PrettyPrint consumes it as a check runner response.
+    assert CheckRunnerResult(response).status_text == 'CRITICAL'
+
+    assert action_lib.parse_preflight_output(stdout[:3], 0)['status'] == 0
+    assert action_lib.parse_preflight_output(['sudo: sorry, you must have a tty to run sudo'], 1) == {
+        'error': 'sudo: sorry, you must have a tty to run sudo'}
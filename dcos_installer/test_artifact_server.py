@@ -0,0 +1,68 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from dcos_installer import artifact_server
+
+
+@pytest.fixture
+def server(tmpdir):
+    tmpdir.join('serve/bootstrap/123.bootstrap.tar.xz').write('0123456789', ensure=True)
+    tmpdir.join('secret').write('secret')
+    server = artifact_server.ArtifactServer(('127.0.0.1', 0), str(tmpdir.join('serve')), 2)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield 'http://127.0.0.1:{}'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def fetch(url, headers={}):
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as ex:
+        return ex.code, ex.headers, ex.read()
+
+
+def test_parse_range():
+    assert artifact_server.parse_range('bytes=2-5', 10) == (2, 5)
+    assert artifact_server.parse_range('bytes=2-', 10) == (2, 9)
+    assert artifact_server.parse_range('bytes=5-100', 10) == (5, 9)
+    assert artifact_server.parse_range('bytes=-3', 10) == (7, 9)
+    assert artifact_server.parse_range('bytes=10-', 10) is False
+    assert artifact_server.parse_range('bytes=-0', 10) is False
+    assert artifact_server.parse_range('bytes=0-1,4-5', 10) is None
+
+
+def test_artifact_server(server):
+    url = server + '/bootstrap/123.bootstrap.tar.xz'
+    status, headers, body = fetch(url)
+    assert status == 200
+    assert body == b'0123456789'
+    assert headers['Accept-Ranges'] == 'bytes'
+    etag = headers['ETag']
+
+    status, headers, body = fetch(url, {'Range': 'bytes=3-5'})
+    assert status == 206
+    assert headers['Content-Range'] == 'bytes 3-5/10'
+    assert body == b'345'
+
+    # A changed file is sent whole.
+    status, _, body = fetch(url, {'Range': 'bytes=3-5', 'If-Range': '"stale"'})
+    assert (status, body) == (200, b'0123456789')
+
+    status, headers, _ = fetch(url, {'Range': 'bytes=20-'})
+    assert status == 416
+    assert headers['Content-Range'] == 'bytes */10'
+
+    status, _, body = fetch(url, {'If-None-Match': etag})
+    assert (status, body) == (304, b'')
+
+    assert fetch(server + '/bootstrap/missing')[0] == 404
+    assert fetch(server + '/bootstrap')[0] == 404
+    assert fetch(server + '/../secret')[0] == 404
+    assert fetch(server + '/%2e%2e/secret')[0] == 404
@@ -32,6 +32,10 @@ def test_set_arg_parser():
     assert parser.action == 'deploy'
     parser = parse_args(['--validate-config'])
     assert parser.action == 'validate-config'
+    assert parser.profile is False
+    parser = parse_args(['--validate-config', '--profile'])
+    assert parser.action == 'validate-config'
+    assert parser.profile is True
     parser = parse_args(['--hash-password', 'foo'])
     assert parser.password == 'foo'
     assert parser.action == 'hash-password'
@@ -52,6 +56,12 @@ def test_set_arg_parser():
     assert parser.installed_cluster_version == 'fake'
     assert parser.action == 'generate-node-upgrade-script'
 
+    parser = parse_args(['--upgrade-nodes', 'fake', '--agent-batch-size', '5', '--upgrade-timeout', '1200'])
+    assert parser.installed_cluster_version == 'fake'
+    assert parser.agent_batch_size == 5
+    assert parser.upgrade_timeout == 1200
+    assert parser.action == 'upgrade-nodes'
+
     # Can't do two at once
     with pytest.raises(SystemExit):
         parse_args(['--validate', '--hash-password', 'foo'])
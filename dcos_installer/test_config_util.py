@@ -0,0 +1,25 @@
+import os
+
+from dcos_installer import config_util
+
+
+def test_fetch_artifacts_twice(tmpdir):
+    filenames = ['bootstrap/123.bootstrap.tar.xz', 'bootstrap/123.active.json', 'packages/a/a--1.tar.xz']
+    src_dir = tmpdir.join('artifacts')
+    dest_dir = tmpdir.join('serve')
+    for filename in filenames:
+        src_dir.join(filename).write(filename, ensure=True)
+
+    config_util.fetch_artifacts(filenames, str(src_dir), str(dest_dir))
+    for filename in filenames:
+        assert os.path.samefile(str(src_dir.join(filename)), str(dest_dir.join(filename)))
+
+    # The files already in place are kept, only the missing one is fetched again.
+    dest_dir.join(filenames[0]).remove()
+    dest_dir.join(filenames[1]).remove()
+    dest_dir.join(filenames[1]).write('stale')
+    config_util.fetch_artifacts(filenames, str(src_dir), str(dest_dir))
+    for filename in filenames:
+        assert dest_dir.join(filename).read() == filename
+        assert os.path.samefile(str(src_dir.join(filename)), str(dest_dir.join(filename)))
+    assert not dest_dir.join(filenames[1] + '.tmp').exists()
@@ -0,0 +1,40 @@
+import asyncio
+
+from dcos_installer import upgrade
+from ssh.runner import Node
+
+
+def test_get_upgrade_batches():
+    masters = [Node('10.0.0.{}'.format(i), {'role': 'master'}) for i in range(3)]
+    agents = [Node('10.0.1.{}'.format(i), {'role': 'agent'}) for i in range(4)]
+    public_agent = Node('10.0.2.1', {'role': 'public_agent'})
+    nodes = agents[:2] + masters + agents[2:] + [public_agent]
+
+    assert upgrade.get_upgrade_batches(nodes, 2) == [
+        [masters[0]], [masters[1]], [masters[2]], agents[:2], agents[2:], [public_agent]]
+    assert upgrade.get_upgrade_batches(nodes, 10) == [
+        [masters[0]], [masters[1]], [masters[2]], agents + [public_agent]]
+
+
+def test_run_upgrade_script_timeout(monkeypatch, tmpdir):
+    runners = []
+
+    class FakeRunner:
+        def __init__(self, config, nodes, async_delegate=None, process_timeout=None):
+            self.process_timeout = process_timeout
+            runners.append(self)
+
+        async def run_commands_chain_async(self, chains, block=False):
+            return [[{'10.0.0.1:22': {'returncode': 0}}]]
+
+    monkeypatch.setattr(upgrade.action_lib, 'get_async_runner', FakeRunner)
+    script_path = tmpdir.join('dcos_node_upgrade.sh')
+    script_path.write('')
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(upgrade._run_upgrade_script(
+            {}, [Node('10.0.0.1')], str(script_path), [], 'Upgrading DC/OS', None, 900))
+    finally:
+        loop.close()
+    assert result == [[{'10.0.0.1:22': {'returncode': 0}}]]
+    assert runners[0].process_timeout == 900
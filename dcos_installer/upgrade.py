@@ -1,16 +1,22 @@
 """
-Generating node upgrade script
+Generating node upgrade script, and upgrading the nodes with it
 """
 
+import logging
 import uuid
 
 import gen.build_deploy.util as util
 import gen.calc
 import gen.template
+import ssh.utils
+from dcos_installer import action_lib, config_util
 from dcos_installer.constants import SERVE_DIR
 from pkgpanda.util import make_directory, write_string
 
 
+log = logging.getLogger(__name__)
+
+
 node_upgrade_template = """#!/bin/bash
 #
 # BASH script to upgrade DC/OS on a node
@@ -50,6 +56,7 @@ fi
 
 SKIP_CHECKS=false
 VERBOSE=false
+FETCH_ONLY=false
 
 if [[ $# -ne 0 ]]; then
     for var in "$@"; do
@@ -57,6 +64,9 @@ if [[ $# -ne 0 ]]; then
             echo "Skipping checks"
             SKIP_CHECKS=true
         fi
+        if [[ "$var" = "--fetch-only" ]]; then
+            FETCH_ONLY=true
+        fi
         if [[ "$var" = "--verbose" ]]; then
             echo "Verbose mode on"
             VERBOSE=true
@@ -77,6 +87,13 @@ if [[ "$found_version" != "{{ installed_cluster_version }}" ]]; then
     exit 1
 fi
 
+# Only download the packages, so that the upgrade itself does not have to wait for them.
+if [[ "$FETCH_ONLY" = "true" ]]; then
+    echo "Fetching DC/OS {{ installer_version }} packages"
+    pkgpanda fetch --repository-url={{ bootstrap_url }} {{ cluster_packages }}
+    exit 0
+fi
+
 # Probe for which check command is available, if any.
 check_cmd=""
 if [ -f /opt/mesosphere/bin/dcos-check-runner ]; then
@@ -177,4 +194,64 @@ def generate_node_upgrade_script(gen_out, installed_cluster_version, serve_dir=S
 
     print("Node upgrade script URL: " + bootstrap_url + upgrade_script_path + '/dcos_node_upgrade.sh')
 
-    return 0
+    return serve_dir + upgrade_script_path + '/dcos_node_upgrade.sh'
+
+
+def get_upgrade_batches(nodes, agent_batch_size=1):
+    """
+    Split the nodes into the batches they are upgraded in: masters one at a time, so that the cluster keeps
+    its quorum, then the agents agent_batch_size at a time.
+    """
+    masters = [node for node in nodes if node.tags['role'] == 'master']
+    agents = [node for node in nodes if node.tags['role'] != 'master']
+    return ([[master] for master in masters] +
+            [agents[i:i + agent_batch_size] for i in range(0, len(agents), agent_batch_size)])
+
+
+def _has_failures(result):
+    return any(
+        process_result['returncode'] != 0
+        for host_result in result
+        for command_result in host_result
+        for process_result in command_result.values())
+
+
+async def _run_upgrade_script(config, nodes, script_path, args, stage, async_delegate, timeout):
+    chain = ssh.utils.CommandChain('upgrade')
+    chain.add_pipe(script_path, action_lib.get_piped_script_cmd(args), stage=stage)
+    # The script outlives the default process_timeout: it fetches and activates the packages, then waits up
+    # to 300 seconds for the node to become healthy. A timed out run counts as failed and stops the upgrade.
+    runner = action_lib.get_async_runner(config, nodes, async_delegate=async_delegate, process_timeout=timeout)
+    return await runner.run_commands_chain_async([chain], block=True)
+
+
+async def upgrade_nodes(config, block=True, async_delegate=None, options=None):
+    """
+    Upgrade all the nodes of the cluster over ssh with the node upgrade script.
+
+    The packages are fetched on every node at once first. The nodes are then upgraded in the batches of
+    get_upgrade_batches. The script only succeeds once the node-poststart and cluster checks pass, and the
+    upgrade stops at the first batch with a failure, so an unhealthy cluster is never upgraded further. Each
+    run of the script on a node may take up to options.upgrade_timeout seconds.
+    """
+    gen_out = config_util.onprem_generate(config)
+    config_util.make_serve_dir(gen_out)
+    script_path = generate_node_upgrade_script(gen_out, options.installed_cluster_version)
+    nodes = action_lib.get_full_nodes_list(config)
+
+    result = await _run_upgrade_script(
+        config, nodes, script_path, ['--fetch-only'], 'Fetching DC/OS packages', async_delegate,
+        options.upgrade_timeout)
+    if _has_failures(result):
+        return result
+
+    batches = get_upgrade_batches(nodes, options.agent_batch_size)
+    for index, batch in enumerate(batches, 1):
+        log.info('Upgrading batch {} of {}: {}'.format(index, len(batches), ', '.join(node.ip for node in batch)))
+        batch_result = await _run_upgrade_script(
+            config, batch, script_path, [], 'Upgrading DC/OS', async_delegate, options.upgrade_timeout)
+        result += batch_result
+        if _has_failures(batch_result):
+            log.error('Stopping the upgrade, batch {} failed'.format(index))
+            break
+    return result
@@ -42,6 +42,7 @@ from pkgpanda.util import (
     is_windows,
     json_prettyprint,
     load_string,
+    load_yaml_str,
     split_by_token,
     write_json,
     write_string,
@@ -256,7 +257,7 @@ def render_templates(template_dict, arguments):
                 assert len(templates) == 1
                 full_template = rendered_template
                 continue
-            template_data = yaml.safe_load(rendered_template)
+            template_data = load_yaml_str(rendered_template)
 
             if full_template:
                 full_template = merge_dictionaries(full_template, template_data)
@@ -300,35 +301,32 @@ def write_to_non_taken(base_filename, json):
 def do_gen_package(config, package_filename):
     # Generate the specific dcos-config package.
     # Version will be setup-{sha1 of contents}
-    with gen.util.pkgpanda_package_tmpdir() as tmpdir:
-        # Only contains package, root
-        assert config.keys() == {"package"}
-
-        # Write out the individual files
-        for file_info in config["package"]:
-            assert file_info.keys() <= {"path", "content", "permissions"}
-            if is_absolute_path(file_info['path']):
-                fileinfo_drive, fileinfo_path = os.path.splitdrive(file_info['path'])
-                path = tmpdir + fileinfo_path
-            else:
-                path = tmpdir + '/' + file_info['path']
-            try:
-                if os.path.dirname(path):
-                    os.makedirs(os.path.dirname(path), mode=0o755)
-            except FileExistsError:
-                pass
-
-            with open(path, 'w') as f:
-                f.write(file_info['content'] or '')
-
-            # the file has special mode defined, handle that.
-            if 'permissions' in file_info:
-                assert isinstance(file_info['permissions'], str)
-                os.chmod(path, int(file_info['permissions'], 8))
-            else:
-                os.chmod(path, 0o644)
+    # Only contains package, root
+    assert config.keys() == {"package"}
+
+    # Gather the individual files
+    files = dict()
+    for file_info in config["package"]:
+        assert file_info.keys() <= {"path", "content", "permissions"}
+        if is_absolute_path(file_info['path']):
+            fileinfo_drive, fileinfo_path = os.path.splitdrive(file_info['path'])
+            path = fileinfo_path
+        else:
+            path = '/' + file_info['path']
+        path = os.path.normpath(path).replace(os.sep, '/').lstrip('/')
+
+        content = (file_info['content'] or '').encode('utf-8')
 
-        gen.util.make_pkgpanda_package(tmpdir, package_filename)
+        # the file has special mode defined, handle that.
+        if 'permissions' in file_info:
+            assert isinstance(file_info['permissions'], str)
+            mode = int(file_info['permissions'], 8)
+        else:
+            mode = 0o644
+
+        files[path] = (content, mode)
+
+    gen.util.write_pkgpanda_package(files, package_filename)
 
 
 def render_late_content(content, late_values):
@@ -426,9 +424,10 @@ def validate_all_arguments_match_parameters(parameters, setters, arguments):
 def validate(
         arguments,
         extra_templates=list(),
-        extra_sources=list()):
+        extra_sources=list(),
+        cache: gen.internals.ResolverCache=None):
     sources, targets, _ = get_dcosconfig_source_target_and_templates(arguments, extra_templates, extra_sources)
-    return gen.internals.resolve_configuration(sources, targets).status_dict
+    return gen.internals.resolve_configuration(sources, targets, cache).status_dict
 
 
 def user_arguments_to_source(user_arguments) -> gen.internals.Source:
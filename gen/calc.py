@@ -22,6 +22,7 @@ argument calculation functions: like validation function, the arguments specifie
 See gen.internals for more on how the nuts and bolts of this process works
 """
 import collections
+import functools
 import ipaddress
 import json
 import os
@@ -42,6 +43,16 @@ DCOS_VERSION = '1.13-dev'
 CHECK_SEARCH_PATH = '/opt/mesosphere/bin:/usr/bin:/bin:/sbin'
 
 
+@functools.lru_cache(maxsize=256)
+def load_json_cached(value: str):
+    """json.loads() memoized across validate functions and calculators.
+
+    Many of them parse the same arguments (master_list, resolvers, check_config, ...). The decoded
+    object is shared between all callers so it must not be modified.
+    """
+    return json.loads(value)
+
+
 def type_str(value):
     return type(value).__name__
 
@@ -72,7 +83,7 @@ def validate_int_in_range(value, low, high):
 
 def validate_json_list(value):
     try:
-        items = json.loads(value)
+        items = load_json_cached(value)
     except ValueError as ex:
         raise AssertionError("Must be a JSON formatted list, but couldn't be parsed the given "
                              "value `{}` as one because of: {}".format(value, ex)) from ex
@@ -168,12 +179,11 @@ def calulate_dcos_image_commit():
 def calculate_resolvers_str(resolvers):
     # Validation because accidentally slicing a string instead of indexing a
     # list of resolvers then finding out at cluster launch is painful.
-    resolvers = json.loads(resolvers)
-    return ",".join(resolvers)
+    return ",".join(load_json_cached(resolvers))
 
 
 def calculate_mesos_dns_resolvers_str(resolvers):
-    resolver_list = json.loads(resolvers)
+    resolver_list = load_json_cached(resolvers)
 
     # Mesos-DNS unfortunately requires completley different config parameters
     # for saying "Don't resolve / reject non-Mesos-DNS requests" than "there are
@@ -235,14 +245,14 @@ def calculate_ip6_detect_contents(ip6_detect_filename):
 def calculate_rexray_config_contents(rexray_config):
     return yaml.dump(
         # Assume block style YAML (not flow) for REX-Ray config.
-        yaml.dump(json.loads(rexray_config), default_flow_style=False)
+        yaml.dump(load_json_cached(rexray_config), default_flow_style=False)
     )
 
 
 def validate_json_dictionary(data):
     # TODO(cmaloney): Pull validate_json() out.
     try:
-        loaded = json.loads(data)
+        loaded = load_json_cached(data)
         assert isinstance(loaded, dict), "Must be a JSON dictionary. Got a {}".format(type_str(loaded))
         return loaded
     except ValueError as ex:
@@ -272,7 +282,7 @@ def calculate_use_mesos_hooks(mesos_hooks):
 
 def validate_network_default_name(overlay_network_default_name, dcos_overlay_network):
     try:
-        overlay_network = json.loads(dcos_overlay_network)
+        overlay_network = load_json_cached(dcos_overlay_network)
     except ValueError as ex:
         raise AssertionError("Provided input was not valid JSON: {}".format(dcos_overlay_network)) from ex
 
@@ -294,7 +304,7 @@ def validate_dcos_ucr_default_bridge_subnet(dcos_ucr_default_bridge_subnet):
 
 def validate_dcos_overlay_network(dcos_overlay_network):
     try:
-        overlay_network = json.loads(dcos_overlay_network)
+        overlay_network = load_json_cached(dcos_overlay_network)
     except ValueError as ex:
         raise AssertionError("Provided input was not valid JSON: {}".format(dcos_overlay_network)) from ex
 
@@ -408,7 +418,7 @@ def validate_mesos_dns_ip_sources(mesos_dns_ip_sources):
 
 
 def calc_num_masters(master_list):
-    return str(len(json.loads(master_list)))
+    return str(len(load_json_cached(master_list)))
 
 
 def calculate_no_proxy(no_proxy):
@@ -426,8 +436,7 @@ def validate_zk_path(exhibitor_zk_path):
 
 
 def calculate_exhibitor_static_ensemble(master_list):
-    masters = json.loads(master_list)
-    masters.sort()
+    masters = sorted(load_json_cached(master_list))
     return ','.join(['%d:%s' % (i + 1, m) for i, m in enumerate(masters)])
 
 
@@ -623,7 +632,7 @@ def validate_dns_forward_zones(dns_forward_zones):
 
     zone_defs = None
     try:
-        zone_defs = json.loads(dns_forward_zones)
+        zone_defs = load_json_cached(dns_forward_zones)
     except ValueError as ex:
         error = fz_err("{} is not valid JSON: {}", dns_forward_zones, ex)
         raise AssertionError(error) from ex
@@ -662,10 +671,13 @@ def validate_mesos_max_completed_tasks_per_framework(
                                  "parameter as an integer: {}".format(ex)) from ex
 
 
+MESOS_RECOVERY_TIMEOUT_RE = re.compile(r"([\d\.]+)(\w+)")
+
+
 def validate_mesos_recovery_timeout(mesos_recovery_timeout):
     units = ['ns', 'us', 'ms', 'secs', 'mins', 'hrs', 'days', 'weeks']
 
-    match = re.match("([\d\.]+)(\w+)", mesos_recovery_timeout)
+    match = MESOS_RECOVERY_TIMEOUT_RE.match(mesos_recovery_timeout)
     assert match is not None, "Error parsing 'mesos_recovery_timeout' value: {}.".format(mesos_recovery_timeout)
 
     value = match.group(1)
@@ -715,8 +727,8 @@ def calculate_check_config_contents(check_config, custom_checks, check_search_pa
             merged_config['node_checks'] = merged_node_checks
         return merged_config
 
-    dcos_checks = json.loads(check_config)
-    user_checks = json.loads(custom_checks)
+    dcos_checks = load_json_cached(check_config)
+    user_checks = load_json_cached(custom_checks)
     merged_checks = merged_check_config(user_checks, dcos_checks)
     merged_checks['check_env'] = {
         'PATH': check_search_path,
@@ -900,53 +912,54 @@ def calculate_check_config(check_time):
     return json.dumps(check_config)
 
 
-def validate_check_config(check_config):
+class _PrettyReprAnd(schema.And):
 
-    class PrettyReprAnd(schema.And):
+    def __repr__(self):
+        return self._error
 
-        def __repr__(self):
-            return self._error
 
-    check_name = PrettyReprAnd(
-        str,
-        lambda val: len(val) > 0,
-        lambda val: not any(w in val for w in string.whitespace),
-        error='Check name must be a nonzero length string with no whitespace')
+_check_name = _PrettyReprAnd(
+    str,
+    lambda val: len(val) > 0,
+    lambda val: not any(w in val for w in string.whitespace),
+    error='Check name must be a nonzero length string with no whitespace')
 
-    timeout_units = ['ns', 'us', 'µs', 'ms', 's', 'm', 'h']
-    timeout = schema.Regex(
-        '^\d+(\.\d+)?({})$'.format('|'.join(timeout_units)),
-        error='Timeout must be a string containing an integer or float followed by a unit: {}'.format(
-            ', '.join(timeout_units)))
+_timeout_units = ['ns', 'us', 'µs', 'ms', 's', 'm', 'h']
+_timeout = schema.Regex(
+    '^\d+(\.\d+)?({})$'.format('|'.join(_timeout_units)),
+    error='Timeout must be a string containing an integer or float followed by a unit: {}'.format(
+        ', '.join(_timeout_units)))
 
-    check_config_schema = schema.Schema({
-        schema.Optional('cluster_checks'): {
-            check_name: {
+CHECK_CONFIG_SCHEMA = schema.Schema({
+    schema.Optional('cluster_checks'): {
+        _check_name: {
+            'description': str,
+            'cmd': [str],
+            'timeout': _timeout,
+        },
+    },
+    schema.Optional('node_checks'): {
+        'checks': {
+            _check_name: {
                 'description': str,
                 'cmd': [str],
-                'timeout': timeout,
-            },
-        },
-        schema.Optional('node_checks'): {
-            'checks': {
-                check_name: {
-                    'description': str,
-                    'cmd': [str],
-                    'timeout': timeout,
-                    schema.Optional('roles'): schema.Schema(
-                        ['master', 'agent'],
-                        error='roles must be a list containing master or agent or both',
-                    ),
-                },
+                'timeout': _timeout,
+                schema.Optional('roles'): schema.Schema(
+                    ['master', 'agent'],
+                    error='roles must be a list containing master or agent or both',
+                ),
             },
-            schema.Optional('prestart'): [check_name],
-            schema.Optional('poststart'): [check_name],
         },
-    })
+        schema.Optional('prestart'): [_check_name],
+        schema.Optional('poststart'): [_check_name],
+    },
+})
 
+
+def validate_check_config(check_config):
     check_config_obj = validate_json_dictionary(check_config)
     try:
-        check_config_schema.validate(check_config_obj)
+        CHECK_CONFIG_SCHEMA.validate(check_config_obj)
     except schema.SchemaError as exc:
         raise AssertionError(str(exc).replace('\n', ' ')) from exc
 
@@ -969,8 +982,8 @@ def validate_custom_checks(custom_checks, check_config):
     def node_check_names(config):
         return set(config.get('node_checks', {}).get('checks', {}).keys())
 
-    user_checks = json.loads(custom_checks)
-    dcos_checks = json.loads(check_config)
+    user_checks = load_json_cached(custom_checks)
+    dcos_checks = load_json_cached(check_config)
     shared_cluster_check_names = cluster_check_names(user_checks).intersection(cluster_check_names(dcos_checks))
     shared_node_check_names = node_check_names(user_checks).intersection(node_check_names(dcos_checks))
 
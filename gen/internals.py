@@ -2,6 +2,9 @@ import copy
 import enum
 import inspect
 import logging
+import time
+import weakref
+from collections import namedtuple
 from contextlib import contextmanager
 from functools import partial, partialmethod
 from typing import Any, Callable, Dict, List, Set, Tuple, Union
@@ -13,8 +16,21 @@ from pkgpanda.util import hash_checkout
 log = logging.getLogger(__name__)
 
 
+# Setters and validate functions are mostly module level functions which are handed to every
+# Resolver, so their signatures are only reflected upon once.
+_function_parameters = weakref.WeakKeyDictionary()
+
+
 def get_function_parameters(function):
-    return set(inspect.signature(function).parameters)
+    try:
+        parameters = _function_parameters.get(function)
+    except TypeError:
+        # Not weak referenceable.
+        return set(inspect.signature(function).parameters)
+
+    if parameters is None:
+        parameters = _function_parameters[function] = frozenset(inspect.signature(function).parameters)
+    return set(parameters)
 
 
 def validate_arguments_strings(arguments: dict):
@@ -93,6 +109,14 @@ class Setter:
         self.is_user = is_user
         self._value_id = hash_checkout(value_id(value))
 
+        # Identifies this setter for a ResolverCache. Strings compare by value, functions by identity
+        # so that two different functions with the same name and parameters are never confused.
+        self.cache_key = (
+            ('late', value.expression) if isinstance(value, Late) else value,
+            is_optional,
+            tuple(conditions),
+            is_user)
+
         def get_value():
             return value
 
@@ -456,10 +480,76 @@ class ArgumentDict(dict):
         self._finalized = True
 
 
+def function_name(function: Callable) -> str:
+    if isinstance(function, partial):
+        return function.func.__name__
+    return function.__name__
+
+
+class ResolverProfile:
+    """Records where the time of resolving a configuration goes.
+
+    Every setter and validate function call is recorded with its wall time along with the stack of
+    arguments being resolved when it was called. Setters are only called once all their parameters
+    have been resolved, so the time recorded for a call never includes the time spent calculating
+    other arguments.
+    """
+
+    def __init__(self):
+        self._setters = dict()
+        self._validators = dict()
+        self._stacks = dict()
+
+    @contextmanager
+    def timed(self, kind: str, arguments: Tuple[str, ...], function: Callable, stack: List[str]):
+        assert kind in ('setter', 'validate')
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            name = function_name(function)
+            stats = (self._setters if kind == 'setter' else self._validators).setdefault(
+                (arguments, name), {'calls': 0, 'seconds': 0.0, 'depth': 0})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['depth'] = max(stats['depth'], len(stack))
+
+            frames = tuple(stack) + ('{}:{}'.format(kind, name),)
+            self._stacks[frames] = self._stacks.get(frames, 0.0) + elapsed
+
+    @property
+    def total_seconds(self):
+        return sum(self._stacks.values())
+
+    def to_dict(self):
+        def make_entries(stats_by_key, argument_key):
+            entries = list()
+            for (arguments, name), stats in stats_by_key.items():
+                entry = {argument_key: arguments[0] if argument_key == 'argument' else sorted(arguments),
+                         'function': name}
+                entry.update(stats)
+                entries.append(entry)
+            return sorted(entries, key=lambda entry: entry['seconds'], reverse=True)
+
+        return {
+            'total_seconds': self.total_seconds,
+            'setters': make_entries(self._setters, 'argument'),
+            'validators': make_entries(self._validators, 'arguments'),
+        }
+
+    def folded_stacks(self) -> str:
+        """Stacks in the folded format understood by flamegraph.pl, weighted in microseconds."""
+        lines = list()
+        for frames, seconds in sorted(self._stacks.items()):
+            lines.append('{} {}'.format(';'.join(frames), int(seconds * 1000000)))
+        return '\n'.join(lines) + '\n'
+
+
 class Validator:
     """Holds a collection of validate functions, and can be asked to call them"""
 
-    def __init__(self, validate_functions, targets):
+    def __init__(self, validate_functions, targets, profile: ResolverProfile=None):
         # Note: targets must be passed in and inspected here, since the validate_functions that a
         # target yields can't be inspected for the parameter name. To get around this yield_validates
         # returns a two-tuple of the name and a callable.
@@ -468,6 +558,7 @@ class Validator:
         # argument name.
         self._validate_by_arg = dict()
         self._multi_arg_validate = dict()
+        self._profile = profile
 
         for function in validate_functions:
             parameters = get_function_parameters(function)
@@ -483,7 +574,28 @@ class Validator:
             for parameter, function in target.yield_validates():
                 self._validate_by_arg.setdefault(parameter, list()).append(function)
 
-    def validate_single(self, name: str, value: str):
+    def cache_key(self, name: str):
+        """Identifies the set of single argument validate functions for the given parameter name.
+
+        Partials generated by Target.yield_validates() are re-created for every Target, so they are
+        compared by the set of values they accept rather than by identity.
+        """
+        key = list()
+        for validate_fn in self._validate_by_arg.get(name, list()):
+            if isinstance(validate_fn, partial):
+                key.append((validate_fn.func, tuple(sorted(validate_fn.keywords['valid_values']))))
+            else:
+                key.append(validate_fn)
+        return tuple(key)
+
+    def _call(self, arguments, validate_fn, stack, *args, **kwargs):
+        if self._profile is None:
+            validate_fn(*args, **kwargs)
+            return
+        with self._profile.timed('validate', arguments, validate_fn, stack):
+            validate_fn(*args, **kwargs)
+
+    def validate_single(self, name: str, value: str, stack: List[str]=None):
         """Calls all validate functions which validate the given parameter name
 
         The validate functions will raise an AssertionError which should be caught by the caller
@@ -492,7 +604,7 @@ class Validator:
         validate_fns = self._validate_by_arg.get(name)
         if validate_fns is not None:
             for validate_fn in validate_fns:
-                validate_fn(value)
+                self._call((name,), validate_fn, stack or [name], value)
 
     # TODO(cmaloney): The distance between the validate_single and multi_arg_validate interface,
     # while necessary for efficient functioning currently, is showing that there is tension between
@@ -527,20 +639,62 @@ class Validator:
             # the error dictionary.
             try:
                 for validate_fn in validate_fns:
-                    validate_fn(**kwargs)
+                    self._call(tuple(parameter_set), validate_fn, [], **kwargs)
             except AssertionError as ex:
                 yield (parameter_set, ex.args[0])
 
 
+class ResolverCache:
+    """Remembers how every argument was calculated by a Resolver so a later resolve can reuse it.
+
+    For each argument name stores what its calculation depended upon: the setters and validate
+    functions which could set / check it, and the arguments which were resolved while calculating
+    it (setter parameters and condition names), in the order they were first asked for. A later
+    Resolver given the same cache reuses the stored outcome of an argument if its setters and
+    validate functions are unchanged and every dependency finalized to the same outcome again.
+    Otherwise the argument is calculated from scratch.
+
+    Setters must only depend upon their parameters for the reuse to be correct. The cache holds the
+    outcomes of the most recent resolve only.
+    """
+
+    def __init__(self):
+        self._entries = dict()
+
+    def get(self, name: str):
+        return self._entries.get(name)
+
+    def update(self, entries: dict):
+        self._entries = entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+CachedResolution = namedtuple('CachedResolution', ['key', 'dependencies', 'outcome', 'error', 'setter_index'])
+
+
 # Depth first search argument calculator. Detects cycles, as well as unmet
 # dependencies.
 # TODO(cmaloney): Separate chain / path building when unwinding from the root
 #                 error messages.
 class Resolver:
-    def __init__(self, setters, validate_fns, targets):
+    def __init__(
+            self,
+            setters,
+            validate_fns,
+            targets,
+            cache: ResolverCache=None,
+            profile: ResolverProfile=None):
         self._resolved = False
         self._setters = setters
         self._targets = targets
+        self._cache = cache
+        self._profile = profile
+
+        # Mapping from an argument name to the names of the arguments that were resolved while
+        # calculating it, in the order they were first asked for.
+        self._dependencies = dict()
 
         self._errors = dict()
         self._unset = set()
@@ -554,7 +708,7 @@ class Resolver:
 
         self._contexts = list()
 
-        self._validator = Validator(validate_fns, targets)
+        self._validator = Validator(validate_fns, targets, profile)
 
     def _calculate(self, resolvable):
         # Filter out any setters which have predicates / conditions which are
@@ -630,8 +784,12 @@ class Resolver:
             kwargs[parameter] = self._resolve_name(parameter)
 
         try:
-            value = setter.calc(**kwargs)
-            self._validator.validate_single(resolvable.name, value)
+            if self._profile is None:
+                value = setter.calc(**kwargs)
+            else:
+                with self._profile.timed('setter', (resolvable.name,), setter.calc, self._eval_stack):
+                    value = setter.calc(**kwargs)
+            self._validator.validate_single(resolvable.name, value, self._eval_stack)
         except AssertionError as ex:
             raise CalculatorError(ex.args[0], [ex]) from ex
 
@@ -652,7 +810,66 @@ class Resolver:
         foo = self._eval_stack.pop()
         assert foo == name, "Internal consistency error: Unwinding stack seems to not be the order it was built in..."
 
+    def _record_dependency(self, name):
+        if not self._eval_stack:
+            return
+        dependencies = self._dependencies[self._eval_stack[-1]]
+        if name not in dependencies:
+            dependencies.append(name)
+
+    def _cache_key(self, name):
+        return (
+            tuple(setter.cache_key for setter in self._setters.get(name, list())),
+            self._validator.cache_key(name))
+
+    def _outcome(self, resolvable):
+        """A comparable summary of how the finalized resolvable ended up, including side effects."""
+        if resolvable.is_resolved:
+            return ('resolved', resolvable.value)
+        if resolvable.is_late:
+            return ('late',)
+        if resolvable.name in self._errors:
+            return ('error', self._errors[resolvable.name])
+        # Skip messages are never reported, so only whether the argument was left unset matters.
+        return ('skip', resolvable.name in self._unset)
+
+    def _reuse_cached(self, resolvable):
+        """Finalize resolvable from the cache if nothing it was calculated from has changed.
+
+        Dependencies are re-checked in the order the original calculation asked for them. Since
+        calculations are deterministic, a fresh calculation would have asked for the same
+        dependencies up to the first one which differs, so no extra arguments get resolved.
+        """
+        if self._cache is None:
+            return False
+
+        entry = self._cache.get(resolvable.name)
+        if entry is None or entry.key != self._cache_key(resolvable.name):
+            return False
+
+        for name, outcome in entry.dependencies:
+            self._ensure_finalized(self._arguments[name])
+            if self._outcome(self._arguments[name]) != outcome:
+                return False
+
+        state = entry.outcome[0]
+        if state == 'resolved':
+            resolvable.finalize_value(entry.outcome[1], self._setters[resolvable.name][entry.setter_index])
+        elif state == 'late':
+            self._late.add(resolvable.name)
+            resolvable.finalize_late()
+        elif state == 'error':
+            resolvable.finalize_error(CalculatorError(entry.error))
+            self._errors[resolvable.name] = entry.outcome[1]
+        else:
+            assert state == 'skip'
+            resolvable.finalize_error(SkipError(entry.error))
+            if entry.outcome[1]:
+                self._unset.add(resolvable.name)
+        return True
+
     def _ensure_finalized(self, resolvable):
+        self._record_dependency(resolvable.name)
         if resolvable.is_finalized:
             return
 
@@ -662,8 +879,12 @@ class Resolver:
         # the second time the resolvable was encountered, and then trying to finalize a second time
         # when the stack unwinds.
         with self._stack_layer(resolvable.name):
+            self._dependencies[resolvable.name] = list()
             try:
-                resolvable.finalize_value(*self._calculate(resolvable))
+                if not self._reuse_cached(resolvable):
+                    # Only the dependencies of the actual calculation should be remembered.
+                    self._dependencies[resolvable.name] = list()
+                    resolvable.finalize_value(*self._calculate(resolvable))
             except LateBoundException:
                 self._late.add(resolvable.name)
                 resolvable.finalize_late()
@@ -755,6 +976,37 @@ class Resolver:
         for parameter_set, error in self._validator.yield_multi_argument_validate_errors(self._arguments):
             self._errors[parameter_set] = error
 
+        if self._cache is not None:
+            self._update_cache()
+
+    def _update_cache(self):
+        entries = dict()
+        for name, resolvable in self._arguments.items():
+            if name not in self._dependencies:
+                # Finalized without ever being calculated, nothing to remember.
+                continue
+            setter_index = None
+            if resolvable.is_resolved:
+                setter_index = self._setters[name].index(resolvable.setter)
+            error = None
+            if resolvable.is_error:
+                error = str(resolvable.error)
+            entries[name] = CachedResolution(
+                key=self._cache_key(name),
+                dependencies=[
+                    (dependency, self._outcome(self._arguments[dependency]))
+                    for dependency in self._dependencies[name]],
+                outcome=self._outcome(resolvable),
+                error=error,
+                setter_index=setter_index)
+        self._cache.update(entries)
+
+    @property
+    def dependencies(self):
+        """Mapping from every calculated argument name to the argument names it depended upon."""
+        assert self._resolved, "Can't get dependencies until they've been resolved"
+        return self._dependencies
+
     @property
     def arguments(self):
         assert self._resolved, "Can't get arguments until they've been resolved"
@@ -802,7 +1054,11 @@ class Resolver:
         }
 
 
-def resolve_configuration(sources: List[Source], targets: List[Target]):
+def resolve_configuration(
+        sources: List[Source],
+        targets: List[Target],
+        cache: ResolverCache=None,
+        profile: ResolverProfile=None):
 
     # Merge the sources into a big dictionary of setters + validators, ensuring
     # that all setters are either strings or functions.
@@ -837,7 +1093,7 @@ def resolve_configuration(sources: List[Source], targets: List[Target]):
         validate += source.validate
 
     # Use setters to calculate every required parameter
-    resolver = Resolver(setters, validate, targets)
+    resolver = Resolver(setters, validate, targets, cache, profile)
     resolver.resolve()
 
     def target_finalized(target):
@@ -4,9 +4,11 @@ import tarfile
 import tempfile
 
 import pytest
+import yaml
 
 import gen
 import pkgpanda.util
+from gen.tests.utils import make_arguments
 
 
 def file_mode(filename: str) -> str:
@@ -112,6 +114,36 @@ def test_do_gen_package():
         ]})
 
 
+def test_do_gen_package_is_reproducible(tmpdir):
+    config = {'package': [
+        {
+            'path': '/etc/foo',
+            'content': 'foo',
+            'permissions': '0600',
+        },
+        {
+            'path': '/baz/qux/quux',
+            'content': 'quux',
+        },
+    ]}
+    first = str(tmpdir.join('first.tar.xz'))
+    second = str(tmpdir.join('second.tar.xz'))
+    gen.do_gen_package(config, first)
+    gen.do_gen_package(config, second)
+
+    with open(first, 'rb') as f, open(second, 'rb') as g:
+        assert f.read() == g.read()
+
+    with tarfile.open(first) as package_tarball:
+        members = package_tarball.getmembers()
+    assert [m.name for m in members] == [
+        '.', './baz', './baz/qux', './baz/qux/quux', './etc', './etc/foo']
+    for member in members:
+        assert (member.uid, member.gid) == (0, 0)
+        if member.isdir():
+            assert member.mode == 0o755
+
+
 def test_extract_files_containing_late_variables():
     regular_config_files = [
         {
@@ -207,3 +239,27 @@ def test_validate_downstream_entry():
                 'bar': 'bar',
             },
         })
+
+
+def generate_and_dump(arguments: dict) -> tuple:
+    generated = gen.generate(arguments)
+    dumped_templates = {name: gen.render_yaml(template) for name, template in generated.templates.items()}
+    return generated.arguments, generated.templates, dumped_templates, generated.cluster_packages
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="configuration not present on windows")
+def test_libyaml_matches_pure_python(monkeypatch, tmpdir):
+    # The generated package lists are written relative to the cwd, so generate in tmpdir. The image commit is
+    # otherwise read with git from the cwd.
+    monkeypatch.setenv('DCOS_IMAGE_COMMIT', 'test_commit')
+    ip_detect = tmpdir.join('ip-detect')
+    ip_detect.write('#!/bin/sh\necho "a: b" # - [x]\n\techo \'{x}\'  \n')
+    arguments = make_arguments({'ip_detect_filename': str(ip_detect)})
+
+    if yaml.__with_libyaml__:
+        assert pkgpanda.util.YamlSafeLoader is yaml.CSafeLoader
+    with tmpdir.as_cwd():
+        libyaml_result = generate_and_dump(arguments)
+
+        monkeypatch.setattr(pkgpanda.util, 'YamlSafeLoader', yaml.SafeLoader)
+        assert generate_and_dump(arguments) == libyaml_result
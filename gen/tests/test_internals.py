@@ -5,6 +5,7 @@ import pytest
 import gen.internals
 from gen.exceptions import ValidationError
 from gen.internals import Scope, Source, Target
+from gen.tests.utils import make_arguments
 
 
 def sample_fn_small():
@@ -28,6 +29,10 @@ def test_get_function_parameters():
     assert get_function_parameters(lambda x: x) == {'x'}
     assert get_function_parameters(lambda x, y, a, b: sample_fn_normal(x)) == {'x', 'y', 'a', 'b'}
 
+    # Signatures are cached, callers modifying the result must not affect later calls.
+    get_function_parameters(sample_fn_big).clear()
+    assert get_function_parameters(sample_fn_big) == {'foo', 'bar', 'baz', 'ping', 'pong'}
+
 
 def test_validate_arguments_strings():
     validate_arguments_strings = gen.internals.validate_arguments_strings
@@ -146,3 +151,94 @@ def test_source_secrets():
     extra_secret_entry['secret'].append('d')
     with pytest.raises(Exception):
         Source(extra_secret_entry)
+
+
+def resolve_with_cache(arguments, cache=None):
+    sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(arguments, [], [])
+    return gen.internals.resolve_configuration(sources, targets, cache)
+
+
+def resolution_summary(resolver):
+    arguments = dict()
+    for name, resolvable in resolver.arguments.items():
+        value = resolvable.value if resolvable.is_resolved or resolvable.is_late else None
+        arguments[name] = (str(resolvable._state), value)
+    return resolver.status_dict, resolver.late, arguments
+
+
+@pytest.mark.parametrize('new_arguments', [
+    {},
+    {'telemetry_enabled': 'foo'},
+    {'master_list': '["52.37.192.49"]'},
+    {'resolvers': '["8.8.8.8"]', 'dns_search': 'example.com'},
+    {'bootstrap_url': 'foo'},
+    {'mesos_recovery_timeout': '24years'},
+    {'dcos_overlay_network_default_name': 'foo'},
+    {'exhibitor_storage_backend': 'aws_s3',
+     'master_discovery': 'master_http_loadbalancer',
+     'aws_region': 'foo',
+     'exhibitor_address': 'http://foobar',
+     'exhibitor_explicit_keys': 'false',
+     'num_masters': '5',
+     's3_bucket': 'baz',
+     's3_prefix': 'mofo'},
+    {'exhibitor_storage_backend': 'static', 'master_discovery': 'master_http_loadbalancer'},
+])
+def test_resolve_incremental_matches_full(new_arguments):
+    cache = gen.internals.ResolverCache()
+    resolve_with_cache(make_arguments({}), cache)
+    assert len(cache) > 0
+
+    # Change away from and then back to the base arguments, each time comparing with a fresh resolve.
+    for arguments in [make_arguments(new_arguments), make_arguments({})]:
+        incremental = resolve_with_cache(arguments, cache)
+        full = resolve_with_cache(arguments)
+        assert resolution_summary(incremental) == resolution_summary(full)
+
+
+def test_resolve_incremental_reuses_unaffected(monkeypatch):
+    calculated = list()
+    calculate = gen.internals.Resolver._calculate
+
+    def counting_calculate(self, resolvable):
+        calculated.append(resolvable.name)
+        return calculate(self, resolvable)
+
+    monkeypatch.setattr(gen.internals.Resolver, '_calculate', counting_calculate)
+
+    cache = gen.internals.ResolverCache()
+    resolve_with_cache(make_arguments({}), cache)
+    assert 'exhibitor_zk_hosts' in calculated
+
+    # Nothing changed, nothing gets calculated.
+    calculated.clear()
+    resolve_with_cache(make_arguments({}), cache)
+    assert calculated == []
+
+    # Only the changed argument and what depends upon it get calculated.
+    calculated.clear()
+    resolve_with_cache(make_arguments({'cluster_name': 'foo'}), cache)
+    assert 'cluster_name' in calculated
+    assert 'exhibitor_zk_hosts' not in calculated
+    assert 'master_list' not in calculated
+
+
+def test_resolve_profile():
+    profile = gen.internals.ResolverProfile()
+    sources, targets, _ = gen.get_dcosconfig_source_target_and_templates(make_arguments({}), [], [])
+    gen.internals.resolve_configuration(sources, targets, profile=profile)
+
+    profile_dict = profile.to_dict()
+    assert profile_dict['total_seconds'] > 0
+
+    setters = {entry['argument']: entry for entry in profile_dict['setters']}
+    assert setters['exhibitor_zk_hosts']['calls'] == 1
+    assert setters['config_yaml_full']['depth'] >= 1
+    validators = {entry['function'] for entry in profile_dict['validators']}
+    assert 'validate_one_of' in validators
+
+    # Every line is a ';' separated stack of frames followed by its weight.
+    for line in profile.folded_stacks().splitlines():
+        frames, weight = line.rsplit(' ', 1)
+        assert frames.split(';')[-1].startswith(('setter:', 'validate:'))
+        assert int(weight) >= 0
@@ -1,11 +1,16 @@
+import io
 import logging
 import os
 import os.path
-
+import tarfile
 from tempfile import TemporaryDirectory
 
 from pkgpanda.util import make_tar
 
+# Every entry of a package written by write_pkgpanda_package() gets this modification time so the
+# same files always produce byte for byte the same package.
+PACKAGE_ENTRY_MTIME = 0
+
 
 def pkgpanda_package_tmpdir():
     # Forcibly set umask so that os.makedirs() always makes directories with
@@ -24,3 +29,45 @@ def make_pkgpanda_package(contents_dir, package_filename):
 
     make_tar(package_filename, contents_dir)
     logging.info("Package filename: %s", package_filename)
+
+
+def write_pkgpanda_package(files: dict, package_filename):
+    """Write a pkgpanda package containing the given files without staging them on disk.
+
+    files maps each file's path relative to the package root to a (content bytes, mode) tuple. The
+    entries are streamed straight into an xz compressed tarball, owned by uid / gid 0 and ordered by
+    path. Parent directories get their own entries with mode 0755 like make_pkgpanda_package().
+    """
+    directories = {'.'}
+    for path in files:
+        parent = os.path.dirname(path)
+        while parent:
+            directories.add(parent)
+            parent = os.path.dirname(parent)
+
+    def make_info(path, mode):
+        info = tarfile.TarInfo('./' + path if path != '.' else '.')
+        info.mode = mode
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        info.mtime = PACKAGE_ENTRY_MTIME
+        return info
+
+    # Ensure the output directory exists
+    if os.path.dirname(package_filename):
+        os.makedirs(os.path.dirname(package_filename), exist_ok=True)
+
+    with tarfile.open(package_filename, 'w:xz', format=tarfile.GNU_FORMAT) as package:
+        for path in sorted(directories | files.keys()):
+            if path in directories:
+                assert path not in files, "{} is both a file and a directory".format(path)
+                info = make_info(path, 0o755)
+                info.type = tarfile.DIRTYPE
+                package.addfile(info)
+            else:
+                content, mode = files[path]
+                info = make_info(path, mode)
+                info.size = len(content)
+                package.addfile(info, io.BytesIO(content))
+
+    logging.info("Package filename: %s", package_filename)
@@ -1,18 +1,25 @@
+import gzip
+import hashlib
+import json
 import logging
 import os
 import sys
-import threading
+import weakref
 
-from flask import Flask, Response
+from flask import Flask, request, Response
 from flask_compress import Compress
 
+import history.statebuffer
 from history.statebuffer import BufferCollection, BufferUpdater
 
 
 compress = Compress()
 state_buffer = None
+buffer_updater = None
 log = logging.getLogger(__name__)
 add_headers_cb = None
+# Serialized buffers by buffer, see _cached_response_
+cached_bodies = weakref.WeakKeyDictionary()
 
 # These headers are common to requests to mesos and client responses
 headers = {
@@ -34,6 +41,25 @@ except ImportError:
     log.info('no dcos_auth_python module detected; using defaults')
 
 
+class CachedBody():
+    """A buffer serialized for the responses, valid until the buffer is updated
+
+    The gzip encoding is only made once asked for, and has its own ETag as it is a different representation.
+    """
+    def __init__(self, version, content):
+        self.version = version
+        self.body = content.encode()
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.gzip_etag = self.etag + '-gzip'
+        self._gzip_body = None
+
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            self._gzip_body = gzip.compress(self.body)
+        return self._gzip_body
+
+
 def headers_cb():
     """Callback method for providing headers per request
 
@@ -48,9 +74,9 @@ def headers_cb():
 
 
 def update():
-    BufferUpdater(state_buffer, headers_cb).update()
-    update_thread = threading.Timer(2, update)
-    update_thread.start()
+    global buffer_updater
+    buffer_updater = BufferUpdater(state_buffer, headers_cb)
+    buffer_updater.run()
 
 
 def create_app():
@@ -77,6 +103,7 @@ def home():
     return _response_("history/last - to get the last fetched state\n" +
                       "history/minute - to get the state array of the last minute\n" +
                       "history/hour - to get the state array of the last hour\n" +
+                      "metrics - to get metrics about the state fetches\n" +
                       "ping - to get a pong\n")
 
 
@@ -84,8 +111,15 @@ def ping():
     return _response_("pong")
 
 
+def metrics():
+    fetch_metrics = history.statebuffer.state_fetcher.get_metrics()
+    fetch_metrics['missed_updates'] = buffer_updater.missed_updates if buffer_updater else 0
+    return _response_(json.dumps(fetch_metrics))
+
+
 def last():
-    return _response_(state_buffer.dump('last')[0])
+    # The buffer is empty until the first update is done.
+    return _cached_response_('last', lambda states: states[0] if len(states) else '{}')
 
 
 def minute():
@@ -97,7 +131,33 @@ def hour():
 
 
 def _buffer_response_(name):
-    return _response_("[" + ",".join(state_buffer.dump(name)) + "]")
+    return _cached_response_(name, lambda states: "[" + ",".join(states) + "]")
+
+
+def _cached_response_(name, serialize):
+    """Respond with the serialized buffer, which is only serialized and compressed again once it changes"""
+    history_buffer = state_buffer.buffers[name]
+    cached = cached_bodies.get(history_buffer)
+    if cached is None or cached.version != history_buffer.version:
+        # Read the version first: should the buffer be updated meanwhile, the body is serialized again on
+        # the next request rather than be stale.
+        version = history_buffer.version
+        cached = CachedBody(version, serialize(history_buffer.dump()))
+        cached_bodies[history_buffer] = cached
+
+    if 'gzip' in request.accept_encodings:
+        response = _response_(cached.gzip_body)
+        response.set_etag(cached.gzip_etag)
+        # flask_compress leaves responses which are already encoded alone
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = _response_(cached.body)
+        response.set_etag(cached.etag)
+    response.vary.add('Accept-Encoding')
+    if request.if_none_match.contains(response.get_etag()[0]):
+        response.status_code = 304
+        response.set_data(b'')
+    return response
 
 
 def _response_(content):
@@ -107,6 +167,7 @@ def _response_(content):
 def route(app):
     app.add_url_rule('/', view_func=home)
     app.add_url_rule('/ping', view_func=ping)
+    app.add_url_rule('/metrics', view_func=metrics)
     app.add_url_rule('/history/last', view_func=last)
     app.add_url_rule('/history/minute', view_func=minute)
     app.add_url_rule('/history/hour', view_func=hour)
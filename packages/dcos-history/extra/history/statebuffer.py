@@ -1,7 +1,13 @@
+import gzip
+import hashlib
 import json
 import logging
+import math
+import mmap
 import os
+import struct
 import threading
+import time
 from collections import deque
 from datetime import datetime, timedelta
 from typing import Optional
@@ -11,8 +17,26 @@ import requests
 logging.getLogger('requests.packages.urllib3').setLevel(logging.WARN)
 
 FETCH_PERIOD = 2
+# Buffers persisted by earlier versions, one file per state, are still read on startup.
 FILE_EXT = '.state-summary.json'
 FILENAME_TS_FMT = '%Y-%m-%dT%H:%M:%S.%f{}'.format(FILE_EXT)
+SEGMENT_EXT = '.state-summary.log'
+SEGMENT_TS_FMT = '%Y-%m-%dT%H:%M:%S.%f{}'.format(SEGMENT_EXT)
+
+# Segments are a sequence of records: a header with the timestamp (microseconds since the epoch), flags and
+# length of the state, followed by the state itself.
+RECORD_HEADER = struct.Struct('>qBI')
+RECORD_FLAG_GZIP = 1
+EPOCH = datetime(1970, 1, 1)
+
+COMPRESS_BUFFERS = os.getenv('HISTORY_BUFFER_COMPRESS', 'false') == 'true'
+
+# Delta encoded buffers store a full state every DELTA_KEYFRAME_INTERVAL states, and the changes to the
+# previous state otherwise.
+DELTA_KEYFRAME_INTERVAL = 10
+# Lists of the state-summary which are diffed record by record, by their id
+DELTA_RECORD_LISTS = ('slaves', 'frameworks')
+UNCHANGED_DELTA = json.dumps({'set': {}, 'records': {}}, separators=(',', ':'))
 
 STATE_SUMMARY_URI = os.getenv('STATE_SUMMARY_URI', 'http://leader.mesos:5050/state-summary')
 
@@ -32,30 +56,255 @@ def parse_log_time(fname):
     return datetime.strptime(fname, FILENAME_TS_FMT)
 
 
+def read_legacy_file(path):
+    with open(path, 'r') as fh:
+        content = fh.read()
+    # States used to be written JSON encoded a second time.
+    try:
+        state = json.loads(content)
+    except ValueError:
+        return content
+    return state if isinstance(state, str) else content
+
+
+def encode_record(timestamp: datetime, state, compress=False):
+    data = state.encode()
+    flags = 0
+    if compress:
+        data = gzip.compress(data)
+        flags |= RECORD_FLAG_GZIP
+    return RECORD_HEADER.pack((timestamp - EPOCH) // timedelta(microseconds=1), flags, len(data)) + data
+
+
+def read_segment(path):
+    """Return the (timestamp, state) records of a segment, up to the first incomplete one."""
+    records = []
+    with open(path, 'rb') as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return records
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset + RECORD_HEADER.size <= len(data):
+                timestamp, flags, length = RECORD_HEADER.unpack_from(data, offset)
+                offset += RECORD_HEADER.size
+                if offset + length > len(data):
+                    logging.warning('Ignoring the incomplete last record of {}'.format(path))
+                    break
+                state = data[offset:offset + length]
+                offset += length
+                if flags & RECORD_FLAG_GZIP:
+                    state = gzip.decompress(state)
+                records.append((EPOCH + timedelta(microseconds=timestamp), state.decode()))
+    return records
+
+
+class StateFetcher():
+    """Fetches the state-summary over a kept alive connection, and keeps metrics about the fetches
+
+    Requests are conditional when Mesos sent an ETag or Last-Modified header. A state identical to the
+    previous one, by hash or by a 304 answer, is given as the previous state object so it isn't kept twice.
+    """
+    def __init__(self):
+        self.session = requests.Session()
+        self.conditional_headers = {}
+        self.last_state = None
+        self.last_digest = None
+        self.fetches = 0
+        self.failures = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.last_latency = None
+        self.max_latency = 0
+        self.total_latency = 0
+
+    def fetch(self, headers_cb):
+        timestamp = datetime.now()
+        start = time.monotonic()
+        try:
+            request_headers = headers_cb()
+            request_headers.update(self.conditional_headers)
+            # TODO(cmaloney): Access the mesos master redirect before requesting
+            # state-summary so that we always get the "authoritative"
+            # state-summary. leader.mesos isn't updated instantly.
+            # That requires mesos stop returning hostnames from `/master/redirect`.
+            # See: https://github.com/apache/mesos/blob/master/src/master/http.cpp#L746
+            resp = self.session.get(
+                STATE_SUMMARY_URI, timeout=FETCH_PERIOD * .9, headers=request_headers, verify=TLS_VERIFY)
+            if resp.status_code == 304 and self.last_state is not None:
+                self.not_modified += 1
+                state = self.last_state
+            else:
+                resp.raise_for_status()
+                digest = hashlib.sha1(resp.content).hexdigest()
+                if digest == self.last_digest:
+                    self.unchanged += 1
+                else:
+                    self.last_state = resp.text
+                    self.last_digest = digest
+                state = self.last_state
+                self.conditional_headers = {
+                    request_header: resp.headers[response_header]
+                    for request_header, response_header in [
+                        ('If-None-Match', 'ETag'), ('If-Modified-Since', 'Last-Modified')]
+                    if response_header in resp.headers}
+        except Exception as e:
+            logging.warning("Could not fetch state: %s" % e)
+            self.failures += 1
+            state = '{}'
+        self.fetches += 1
+        self.last_latency = time.monotonic() - start
+        self.max_latency = max(self.max_latency, self.last_latency)
+        self.total_latency += self.last_latency
+        return timestamp, state
+
+    def get_metrics(self):
+        return {
+            'fetches': self.fetches,
+            'failures': self.failures,
+            'not_modified': self.not_modified,
+            'unchanged': self.unchanged,
+            'last_latency_seconds': self.last_latency,
+            'max_latency_seconds': self.max_latency,
+            'mean_latency_seconds': self.total_latency / self.fetches if self.fetches else None}
+
+
+state_fetcher = StateFetcher()
+
+
 def fetch_state(headers_cb):
-    timestamp = datetime.now()
+    return state_fetcher.fetch(headers_cb)
+
+
+def _is_record_list(value):
+    if not isinstance(value, list):
+        return False
+    if not all(isinstance(record, dict) and isinstance(record.get('id'), str) for record in value):
+        return False
+    return len({record['id'] for record in value}) == len(value)
+
+
+def make_delta(previous: dict, state: dict):
+    """Return the changes from the previous state to the given one, as a JSON string
+
+    The agents and frameworks of the state are compared one by one, only those which changed are included.
+    """
+    delta = {'set': {}, 'records': {}}
+    if list(state.keys()) != list(previous.keys()):
+        delta['keys'] = list(state.keys())
+    for key, value in state.items():
+        previous_value = previous.get(key)
+        if key in DELTA_RECORD_LISTS and _is_record_list(value) and _is_record_list(previous_value):
+            previous_records = {record['id']: record for record in previous_value}
+            ids = [record['id'] for record in value]
+            changes = {
+                'changed': {
+                    record['id']: record for record in value if previous_records.get(record['id']) != record}}
+            if ids != [record['id'] for record in previous_value]:
+                changes['ids'] = ids
+            delta['records'][key] = changes
+        elif key not in previous or previous_value != value:
+            delta['set'][key] = value
+    return json.dumps(delta, separators=(',', ':'))
+
+
+def apply_delta(previous: dict, delta):
+    """Return the state made from the previous state and a delta of make_delta()"""
+    delta = json.loads(delta)
+    state = {}
+    for key in delta.get('keys', previous.keys()):
+        if key in delta['set']:
+            state[key] = delta['set'][key]
+        elif key in delta['records']:
+            changes = delta['records'][key]
+            previous_records = {record['id']: record for record in previous[key]}
+            ids = changes.get('ids', [record['id'] for record in previous[key]])
+            state[key] = [changes['changed'].get(record_id, previous_records.get(record_id)) for record_id in ids]
+        else:
+            state[key] = previous[key]
+    return state
+
+
+def _parse_state(state):
     try:
-        # TODO(cmaloney): Access the mesos master redirect before requesting
-        # state-summary so that we always get the "authoritative"
-        # state-summary. leader.mesos isn't updated instantly.
-        # That requires mesos stop returning hostnames from `/master/redirect`.
-        # See: https://github.com/apache/mesos/blob/master/src/master/http.cpp#L746
-        resp = requests.get(STATE_SUMMARY_URI, timeout=FETCH_PERIOD * .9, headers=headers_cb(), verify=TLS_VERIFY)
-        resp.raise_for_status()
-        state = resp.text
-    except Exception as e:
-        logging.warning("Could not fetch state: %s" % e)
-        state = '{}'
-    return timestamp, state
+        parsed = json.loads(state)
+    except ValueError:
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+class DeltaBuffer():
+    """A bounded sequence of states, like deque(maxlen=...), which stores most states as deltas
+
+    States are rebuilt from the keyframe before them when read. Entries older than the window are only
+    removed once no delta in the window depends on them anymore.
+    """
+    def __init__(self, maxlen, keyframe_interval=DELTA_KEYFRAME_INTERVAL):
+        self.maxlen = maxlen
+        self.keyframe_interval = keyframe_interval
+        # (is_keyframe, state or delta) tuples
+        self.entries = deque()
+        self.last_state = None
+        # The parsed last state, None if it isn't a JSON object. Kept so that each state is parsed once.
+        self.last_parsed = None
+        self.since_keyframe = 0
+
+    def append(self, state):
+        if self.last_parsed is not None and state == self.last_state:
+            # Same state again, nothing to parse nor diff
+            parsed = self.last_parsed
+        else:
+            parsed = _parse_state(state)
+        if self.last_parsed is None or parsed is None or self.since_keyframe + 1 >= self.keyframe_interval:
+            self.entries.append((True, state))
+            self.since_keyframe = 0
+        else:
+            delta = UNCHANGED_DELTA if parsed is self.last_parsed else make_delta(self.last_parsed, parsed)
+            self.entries.append((False, delta))
+            self.since_keyframe += 1
+        self.last_state = state
+        self.last_parsed = parsed
+
+        excess = len(self.entries) - self.maxlen
+        droppable = max([i for i in range(1, excess + 1) if self.entries[i][0]], default=0)
+        for _ in range(droppable):
+            self.entries.popleft()
+
+    def __len__(self):
+        return min(len(self.entries), self.maxlen)
+
+    def __iter__(self):
+        # A copy, so that appends meanwhile don't disturb the iteration
+        entries = list(self.entries)
+        skip = max(len(entries) - self.maxlen, 0)
+        state = None
+        parsed = None
+        for idx, (is_keyframe, data) in enumerate(entries):
+            if is_keyframe:
+                state = data
+                parsed = None
+            elif data != UNCHANGED_DELTA:
+                if parsed is None:
+                    parsed = json.loads(state)
+                parsed = apply_delta(parsed, data)
+                state = None
+            if idx >= skip:
+                if state is None:
+                    state = json.dumps(parsed, separators=(',', ':'))
+                yield state
+
+    def __getitem__(self, index):
+        return list(self)[index]
 
 
 class HistoryBuffer():
 
-    def __init__(self, time_window, update_period, path=None):
+    def __init__(self, time_window, update_period, path=None, compress=False, delta_encode=False):
         """
         :param time_window: how many seconds this buffer will span
         :param update_period: the number of seconds between updates for this buffer
         :param path: (str) path for the dir to write to disk in
+        :param compress: gzip the states written to disk
+        :param delta_encode: keep the states in memory as deltas to the previous ones, see DeltaBuffer
         """
         updates_per_window = int(time_window / update_period)
         if time_window % update_period != 0:
@@ -63,8 +312,13 @@ class HistoryBuffer():
                 'Invalid updates per window: {} '
                 'time_window/update_period must be an integer'.format(updates_per_window))
 
-        self.in_memory = deque([], updates_per_window)
+        if delta_encode:
+            self.in_memory = DeltaBuffer(updates_per_window)
+        else:
+            self.in_memory = deque([], updates_per_window)
         self.update_period = timedelta(seconds=update_period)
+        # Incremented on every update, for the serialized buffer to be cached until the next one
+        self.version = 0
 
         if path:
             try:
@@ -73,46 +327,83 @@ class HistoryBuffer():
                 logging.info('Using previously created buffer persistence dir: {}'.format(path))
             self.path = path
             self.disk_count = updates_per_window
-            old_files = [os.path.join(self.path, f) for f in os.listdir(self.path)]
-            filtered_old_files = [f for f in old_files if f.endswith(FILE_EXT)]
-            self.disk_files = list(sorted(filtered_old_files))
-            backup_files = self.disk_files[-1 * updates_per_window:]
-            backup_count = len(backup_files)
-
-            def update_and_ff(f_path, ff_end):
-                """Accounts for gaps between data in memory with blank filler
-                """
-                # Set timestamp to None for memory-only buffer updates
-                with open(f_path, 'r') as fh:
-                    self._update_buffer(fh.read())
-                while (ff_end - self.update_period) >= self.next_update:
-                    self._update_buffer('{}')
+            self.compress = compress
+            self.segments = []
+            self.segment = None
+            backup_records = self._read_disk_records()[-1 * updates_per_window:]
+            self._compact(backup_records)
 
-            for idx, f in enumerate(backup_files):
+            for idx, (timestamp, state) in enumerate(backup_records):
                 if idx == 0:
-                    # set the first update time to correspond to the oldest backup file
+                    # set the first update time to correspond to the oldest backup record
                     # before we attempt to do an update and fastforward
-                    self.next_update = parse_log_time(f.split('/')[-1])
-                if idx == (backup_count - 1):
-                    # Last backup file, fastforward to present
-                    update_and_ff(f, datetime.now())
+                    self.next_update = timestamp
+                if idx == (len(backup_records) - 1):
+                    # Last backup record, fastforward to present
+                    ff_end = datetime.now()
                 else:
-                    # More backup files, only fastforward to the next one
-                    next_filetime = parse_log_time(backup_files[idx + 1].split('/')[-1])
-                    update_and_ff(f, next_filetime)
+                    # More backup records, only fastforward to the next one
+                    ff_end = backup_records[idx + 1][0]
+                # Accounts for gaps between data in memory with blank filler
+                self._update_buffer(state)
+                while (ff_end - self.update_period) >= self.next_update:
+                    self._update_buffer('{}')
         else:
             self.disk_count = 0
 
         # Guarantees first call after instanciation will cause update
         self.next_update = datetime.now()
 
-    def _get_datafile_name(self, timestamp: datetime):
+    def _get_segment_name(self, timestamp: datetime):
         assert timestamp.tzinfo is None
-        return '{}/{}'.format(self.path, timestamp.strftime(FILENAME_TS_FMT))
+        return '{}/{}'.format(self.path, timestamp.strftime(SEGMENT_TS_FMT))
+
+    def _read_disk_records(self):
+        records = []
+        for f in sorted(os.listdir(self.path)):
+            f_path = os.path.join(self.path, f)
+            if f.endswith(SEGMENT_EXT):
+                records += read_segment(f_path)
+            elif f.endswith(FILE_EXT):
+                records.append((parse_log_time(f), read_legacy_file(f_path)))
+        # A crash during a compaction can leave the compacted records in the old segments too, keep one
+        # record per timestamp.
+        records = {timestamp: state for timestamp, state in records}
+        return sorted(records.items(), key=lambda record: record[0])
 
-    def _clean_excess_disk_files(self):
-        while len(self.disk_files) > self.disk_count:
-            os.remove(self.disk_files.pop(0))
+    def _compact(self, records):
+        """Rewrite the given records as the only segment, replacing all the previous ones and legacy files."""
+        compacted = None
+        if records:
+            compacted = self._get_segment_name(records[0][0])
+            with open(compacted + '.tmp', 'wb') as fh:
+                for timestamp, state in records:
+                    fh.write(encode_record(timestamp, state, self.compress))
+            os.replace(compacted + '.tmp', compacted)
+            self.segments.append(compacted)
+            self.segment = open(compacted, 'ab')
+            self.segment_count = len(records)
+
+        for f in os.listdir(self.path):
+            f_path = os.path.join(self.path, f)
+            if f.endswith((SEGMENT_EXT, SEGMENT_EXT + '.tmp', FILE_EXT)) and f_path != compacted:
+                os.remove(f_path)
+
+    def _append_to_disk(self, timestamp: datetime, state):
+        # A full segment is followed by a new one. Once that is full too it holds all the records to keep,
+        # so the one before is removed: disk usage stays within two windows, in two files.
+        if self.segment is None or self.segment_count >= self.disk_count:
+            if self.segment is not None:
+                self.segment.close()
+            self.segments.append(self._get_segment_name(timestamp))
+            self.segment = open(self.segments[-1], 'ab')
+            self.segment_count = 0
+            while len(self.segments) > 2:
+                os.remove(self.segments.pop(0))
+
+        self.segment.write(encode_record(timestamp, state, self.compress))
+        self.segment.flush()
+        self.segment_count += 1
 
     def add_data(self, timestamp: datetime, state):
         if timestamp >= self.next_update:
@@ -120,14 +411,11 @@ class HistoryBuffer():
 
     def _update_buffer(self, state, storage_time: Optional[datetime]=None):
         self.in_memory.append(state)
+        self.version += 1
         self.next_update += self.update_period
 
         if storage_time and (self.disk_count > 0):
-            data_file = self._get_datafile_name(storage_time)
-            with open(data_file, 'w') as f:
-                json.dump(state, f)
-            self.disk_files.append(data_file)
-            self._clean_excess_disk_files()
+            self._append_to_disk(storage_time, state)
 
     def dump(self):
         return self.in_memory
@@ -137,8 +425,11 @@ class BufferCollection():
     """Defines the buffers to be maintained"""
     def __init__(self, buffer_dir):
         self.buffers = {
-            'minute': HistoryBuffer(60, 2, path=buffer_dir + '/minute'),
-            'hour': HistoryBuffer(60 * 60, 60, path=buffer_dir + '/hour'),
+            # Reading a delta encoded buffer rebuilds all of its states, which is only worth it for the
+            # large and rarely updated hour buffer.
+            'minute': HistoryBuffer(60, 2, path=buffer_dir + '/minute', compress=COMPRESS_BUFFERS),
+            'hour': HistoryBuffer(
+                60 * 60, 60, path=buffer_dir + '/hour', compress=COMPRESS_BUFFERS, delta_encode=True),
             'last': HistoryBuffer(FETCH_PERIOD, FETCH_PERIOD)}
 
     def dump(self, name):
@@ -158,11 +449,38 @@ class BufferUpdater():
     def __init__(self, buffer_collection, headers_cb):
         self.buffer_collection = buffer_collection
         self.headers_cb = headers_cb
+        self.missed_updates = 0
+        self.stopped = threading.Event()
 
     def update(self):
         self.buffer_collection.add_data(*fetch_state(self.headers_cb))
 
     def run(self):
+        """Update right away, then start updating every FETCH_PERIOD seconds in a single thread"""
+        start = time.monotonic()
         self.update()
-        t = threading.Timer(FETCH_PERIOD, self.run)
-        t.start()
+        thread = threading.Thread(target=self._run_scheduled, args=(start,), name='history-updater', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run_scheduled(self, last_update):
+        # Updates are scheduled on a fixed clock rather than FETCH_PERIOD after the previous one finished,
+        # so slow fetches don't make the updates drift.
+        next_update = last_update
+        while True:
+            next_update += FETCH_PERIOD
+            now = time.monotonic()
+            if now > next_update:
+                # Skip the updates a slow fetch ran past rather than run them back to back
+                missed = math.ceil((now - next_update) / FETCH_PERIOD)
+                self.missed_updates += missed
+                next_update += missed * FETCH_PERIOD
+            if self.stopped.wait(next_update - now):
+                return
+            try:
+                self.update()
+            except Exception:
+                logging.exception('Failed to update the buffers')
@@ -1,9 +1,12 @@
 """Test uses randomly generated data such that data ordering
 and refreshing can be checked
 """
+import gzip
+import json
 import os
 import random
 import string
+import time
 from datetime import datetime, timedelta
 
 import pytest
@@ -11,7 +14,7 @@ import pytest
 import history.server_util
 import history.statebuffer
 import pkgpanda.util
-from history.statebuffer import FETCH_PERIOD, FILE_EXT
+from history.statebuffer import FETCH_PERIOD, FILE_EXT, read_segment, SEGMENT_EXT
 
 
 @pytest.fixture(scope='function')
@@ -96,8 +99,52 @@ def test_endpoint_hour(history_service):
 @pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
 def test_file_trimming(history_service):
     history_service[1](30 * 60 * 2)  # 2 hours of data
-    assert len(os.listdir(history_service[3].buffers['minute'].path)) == 30
-    assert len(os.listdir(history_service[3].buffers['hour'].path)) == 60
+    for name, count in [('minute', 30), ('hour', 60)]:
+        path = history_service[3].buffers[name].path
+        # At most two segments, which hold the whole buffer
+        assert len(os.listdir(path)) == 2
+        records = [state for f in sorted(os.listdir(path)) for _, state in read_segment(os.path.join(path, f))]
+        assert count <= len(records) <= 2 * count
+        assert records[-count:] == list(history_service[3].dump(name))
+
+
+# TODO: DCOS_OSS-3472 - muted Windows tests requiring investigation
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
+def test_segment_recovery(tmpdir):
+    b = history.statebuffer.HistoryBuffer(60, FETCH_PERIOD, path=tmpdir.strpath, compress=True)
+    start_time = datetime.now()
+    for i in range(10):
+        b.add_data(start_time + timedelta(seconds=i * FETCH_PERIOD), '{"i": %d}' % i)
+    # A record cut short by a crash is dropped
+    with open(b.segment.name, 'ab') as fh:
+        fh.write(history.statebuffer.encode_record(datetime.now(), '{"i": 10}')[:-2])
+
+    b = history.statebuffer.HistoryBuffer(60, FETCH_PERIOD, path=tmpdir.strpath)
+    assert list(b.dump())[:10] == ['{"i": %d}' % i for i in range(10)]
+    assert len(os.listdir(tmpdir.strpath)) == 1
+
+
+# TODO: DCOS_OSS-3472 - muted Windows tests requiring investigation
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
+def test_interrupted_compaction(tmpdir):
+    b = history.statebuffer.HistoryBuffer(60, FETCH_PERIOD, path=tmpdir.strpath)
+    start_time = datetime.now()
+    for i in range(5):
+        b.add_data(start_time + timedelta(seconds=i * FETCH_PERIOD), '{"i": %d}' % i)
+    # A crash after the compacted segment was written, but before the old one was removed
+    segment = b.segment.name
+    b.segment.close()
+    with open(segment, 'rb') as fh:
+        data = fh.read()
+    old_segment = os.path.join(tmpdir.strpath, (start_time - timedelta(seconds=1)).strftime(
+        history.statebuffer.SEGMENT_TS_FMT))
+    with open(old_segment, 'wb') as fh:
+        fh.write(data)
+
+    b = history.statebuffer.HistoryBuffer(60, FETCH_PERIOD, path=tmpdir.strpath)
+    assert list(b.dump())[:5] == ['{"i": %d}' % i for i in range(5)]
+    assert len(read_segment(b.segment.name)) == 5
+    assert os.listdir(tmpdir.strpath) == [os.path.basename(b.segment.name)]
 
 
 # TODO: DCOS_OSS-3472 - muted Windows tests requiring investigation
@@ -147,13 +194,50 @@ def test_data_recovery(monkeypatch, tmpdir):
     assert resp_data == exp_resp
     # also check that all the previous data is '2old'
     assert all([s == '2old' for s in resp_data[:-11]])
-    # check that excess old data was trimmed, but 'user' data is untouched
-    assert len(os.listdir(sb.buffers['minute'].path)) == 31
+    # check that excess old data was trimmed and the files were compacted to a segment, but 'user' data is
+    # untouched
+    files = sorted(os.listdir(sb.buffers['minute'].path))
+    assert len([f for f in files if f.endswith(FILE_EXT)]) == 0
+    assert len([f for f in files if f.endswith(SEGMENT_EXT)]) == 2
+    assert len([f for f in files if f.endswith('.user-summary.json')]) == 1
+    records = read_segment(os.path.join(sb.buffers['minute'].path, files[0]))
+    assert [state for _, state in records[-3:]] == ['foo', 'qux', 'bar']
     resp = test_client.get("/history/hour")
     # No data was left for hour, so nothing loads other than the first update
     assert resp.data.decode() == '[baz]'
 
 
+# TODO: DCOS_OSS-3472 - muted Windows tests requiring investigation
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="test fails on Windows reason unknown")
+def test_cached_response(history_service):
+    history_service[1](1)
+    resp = history_service[0].get('/history/minute')
+    etag = resp.headers['ETag']
+    assert resp.data.decode() == '[' + history_service[2][-1] + ']'
+
+    resp = history_service[0].get('/history/minute', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+    assert resp.data == b''
+
+    resp = history_service[0].get('/history/minute', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.headers['ETag'] != etag
+    assert gzip.decompress(resp.data).decode() == '[' + history_service[2][-1] + ']'
+
+    # An update gives a new body
+    history_service[1](1)
+    resp = history_service[0].get('/history/minute', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.data.decode() == '[' + ','.join(history_service[2][-2:]) + ']'
+
+
+def test_endpoint_last_empty(history_service):
+    # Before the first update
+    resp = history_service[0].get("/history/last")
+    assert resp.status_code == 200
+    assert resp.data.decode() == '{}'
+
+
 def test_add_headers(history_service):
     resp = history_service[0].get('/history/minute')
     # check that auth header is not added to response - this would leak the
@@ -163,11 +247,112 @@ def test_add_headers(history_service):
     assert resp.headers['Access-Control-Max-Age'] == '86400'
 
 
+def test_delta_buffer():
+    def make_state(i):
+        return json.dumps({
+            'hostname': 'master',
+            'slaves': [{'id': 'agent{}'.format(j), 'used': i if j == 1 else 0} for j in range(i % 4, 5)],
+            'frameworks': [{'id': 'marathon', 'tasks': i // 3}],
+            'ts': i}, separators=(',', ':'))
+
+    states = [make_state(i) for i in range(25)] + ['{}', 'not json', make_state(25)]
+    b = history.statebuffer.DeltaBuffer(7, keyframe_interval=5)
+    for i, state in enumerate(states):
+        b.append(state)
+        assert list(b) == states[max(i - 6, 0):i + 1]
+        assert len(b) == min(i + 1, 7)
+        # At most one keyframe interval of entries older than the window is kept around
+        assert len(b.entries) < 7 + 5
+    assert b[-1] == states[-1]
+
+    # A repeated state is stored as an empty delta
+    b.append(states[-1])
+    assert b.entries[-1] == (False, history.statebuffer.UNCHANGED_DELTA)
+    assert list(b)[-2:] == [states[-1], states[-1]]
+
+    # Only the changed agents are stored, along with their order as an agent was removed
+    delta = json.loads(history.statebuffer.make_delta(json.loads(make_state(4)), json.loads(make_state(5))))
+    assert delta['set'] == {'ts': 5}
+    assert delta['records']['slaves'] == {
+        'changed': {'agent1': {'id': 'agent1', 'used': 5}},
+        'ids': ['agent1', 'agent2', 'agent3', 'agent4']}
+    assert delta['records']['frameworks'] == {'changed': {}}
+
+
+class MockResponse():
+    def __init__(self, status_code, text='', headers={}):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode()
+        self.headers = headers
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP {}'.format(self.status_code))
+
+
+def test_state_fetcher(monkeypatch):
+    responses = [
+        MockResponse(200, '{"a": 1}', {'ETag': '"1"'}),
+        MockResponse(304),
+        MockResponse(200, '{"a": 1}', {'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+        MockResponse(503),
+        MockResponse(200, '{"a": 2}')]
+    requests = []
+
+    def mock_get(url, headers, **kwargs):
+        requests.append(headers)
+        return responses.pop(0)
+
+    fetcher = history.statebuffer.StateFetcher()
+    monkeypatch.setattr(fetcher.session, 'get', mock_get)
+    states = [fetcher.fetch(lambda: {'Authorization': 'test'})[1] for _ in range(5)]
+    assert states == ['{"a": 1}', '{"a": 1}', '{"a": 1}', '{}', '{"a": 2}']
+    # Identical states are the same object
+    assert states[0] is states[1] is states[2]
+    assert requests[0] == {'Authorization': 'test'}
+    assert requests[1] == {'Authorization': 'test', 'If-None-Match': '"1"'}
+    assert requests[3] == {'Authorization': 'test', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+
+    metrics = fetcher.get_metrics()
+    assert (metrics['fetches'], metrics['failures'], metrics['not_modified'], metrics['unchanged']) == (5, 1, 1, 1)
+    assert metrics['max_latency_seconds'] >= metrics['last_latency_seconds']
+
+
+def test_buffer_updater(monkeypatch, tmpdir):
+    monkeypatch.setattr(history.statebuffer, 'FETCH_PERIOD', 0.01)
+    updates = []
+
+    def mock_state(headers):
+        updates.append(datetime.now())
+        if len(updates) == 3:
+            # A slow fetch
+            time.sleep(0.035)
+        return datetime.now(), '{}'
+
+    monkeypatch.setattr(history.statebuffer, 'fetch_state', mock_state)
+    buffer_collection = history.statebuffer.BufferCollection(tmpdir.strpath)
+    updater = history.statebuffer.BufferUpdater(buffer_collection, None)
+    thread = updater.run()
+    # The first update is done by the time run() returns
+    assert len(updates) >= 1
+    assert len(buffer_collection.dump('last')) == 1
+    time.sleep(0.2)
+    updater.stop()
+    thread.join()
+    assert len(updates) > 5
+    assert updater.missed_updates >= 3
+
+    history.server_util.buffer_updater = updater
+    resp = history.server_util.test().test_client().get('/metrics')
+    assert json.loads(resp.data.decode())['missed_updates'] == updater.missed_updates
+
+
 # Tests for malformed filenames, ref DCOS_OSS-2210
 def test_file_timestamp(monkeypatch, tmpdir):
     round_ts = datetime(2018, 2, 28, 20, 17, 14, 0)
     b = history.statebuffer.HistoryBuffer(60, 2, path=tmpdir.strpath)
-    qname = b._get_datafile_name(round_ts)
+    qname = b._get_segment_name(round_ts)
     fname = qname.split('/')[-1]
-    parsed_time = datetime.strptime(fname, '%Y-%m-%dT%H:%M:%S.%f.state-summary.json')
+    parsed_time = datetime.strptime(fname, '%Y-%m-%dT%H:%M:%S.%f.state-summary.log')
     assert parsed_time == round_ts
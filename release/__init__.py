@@ -7,6 +7,7 @@ Co-ordinates across all gen.build_deploy
 """
 
 import argparse
+import concurrent.futures
 import copy
 import importlib
 import inspect
@@ -15,6 +16,7 @@ import logging
 import os.path
 import subprocess
 import sys
+import time
 from distutils.version import LooseVersion
 from typing import Optional
 
@@ -175,13 +177,14 @@ class Repository():
                 nonlocal upload_path
 
                 # First action -> upload
-                # Future actions -> copy from upload / first action
+                # Future actions -> copy from upload / first action, or from where the first action copies
+                # from, so that none of the copies has to wait for another.
                 if upload_path is not None:
                     return {
                         'method': 'copy',
                         'if_not_exists': is_reproducible,
                         'args': {
-                            'source_path': upload_path,
+                            'source_path': artifact.get('local_copy_from', upload_path),
                             'destination_path': destination_path}}
 
                 # Always set upload_path
@@ -245,9 +248,26 @@ class Repository():
             'local_content': to_json(strip_locals(metadata))
         }, False)
 
+        # Drop the commands which would store something already stored: copies of a path onto itself, and
+        # repeats of an earlier command.
+        planned = set()
+
+        def deduplicate(commands):
+            result = []
+            for command in commands:
+                args = command['args']
+                if command['method'] == 'copy' and args['source_path'] == args['destination_path']:
+                    continue
+                key = (command['method'], tuple(sorted(args.items())))
+                if key in planned:
+                    continue
+                planned.add(key)
+                result.append(command)
+            return result
+
         return {
-            'stage1': stage1,
-            'stage2': stage2,
+            'stage1': deduplicate(stage1),
+            'stage2': deduplicate(stage2),
         }
 
 
@@ -669,21 +689,194 @@ def get_storage_provider_factory(kind):
     return module.factories[name]
 
 
-def apply_storage_commands(storage_providers: dict, storage_commands: dict) -> None:
+# Providers which build their artifacts out of local copies of the core artifacts (the installer embeds them).
+LOCAL_ARTIFACT_PROVIDERS = {'bash'}
+
+# Number of commands run at once against a storage provider, unless its config sets `concurrency`.
+DEFAULT_STORAGE_CONCURRENCY = 8
+STORAGE_COMMAND_ATTEMPTS = 3
+
+
+def get_storage_command_waves(commands: list) -> list:
+    """Split the commands of a stage into waves which can each run all at once.
+
+    Copies may read what an earlier command of the same stage stored (an artifact is uploaded to its first
+    destination, then copied from there to the others), so they go in a wave after that command's."""
+    wave_by_path = {}
+    waves = []
+    for command in commands:
+        source_path = command['args'].get('source_path')
+        wave = wave_by_path[source_path] + 1 if command['method'] == 'copy' and source_path in wave_by_path else 0
+        wave_by_path[command['args']['destination_path']] = wave
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(command)
+    return waves
+
+
+def get_storage_command_size(command: dict) -> int:
+    """Number of bytes the command sends to the storage provider. Copies happen within the provider."""
+    if command['method'] != 'upload':
+        return 0
+    if command['args'].get('local_path'):
+        return os.path.getsize(command['args']['local_path'])
+    return len(command['args']['blob'])
+
+
+def get_listing_prefixes(paths) -> list:
+    """Folders to list to learn which of the given paths exist.
+
+    That is the folders of the paths, where sibling folders are listed through their parent instead, so the
+    artifacts of all the packages (packages/<name>/<id>.tar.xz) take a single listing."""
+    # Artifacts at the top level would need a listing of everything, they are better checked on their own.
+    folders = {os.path.dirname(path) for path in paths} - {''}
+    children = {}
+    for folder in folders:
+        children.setdefault(os.path.dirname(folder), set()).add(folder)
+
+    prefixes = set()
+    for parent, siblings in children.items():
+        if parent and len(siblings) > 1:
+            prefixes.add(parent)
+        else:
+            prefixes |= siblings
+    # Listings are recursive, so nothing within another listed folder needs a listing of its own.
+    return sorted(prefix for prefix in prefixes if not any(prefix.startswith(other + '/') for other in prefixes))
+
+
+class ExistingArtifacts:
+    """Answers whether artifacts exist on a storage provider from listings of it.
+
+    A few paginated listings replace a request per artifact. The listings are not refreshed, the artifacts
+    stored through this object are added to them instead."""
+
+    def __init__(self, provider):
+        self.__provider = provider
+        self.__listed_prefixes = []
+        self.__paths = set()
+        self.__can_list = True
+
+    def prefetch(self, paths):
+        if not self.__can_list:
+            return
+        for prefix in get_listing_prefixes(paths):
+            if self.__is_listed(prefix + '/'):
+                continue
+            try:
+                self.__paths |= self.__provider.list_recursive(prefix)
+            except (NotImplementedError, release.storage.UnsupportedOperation):
+                # Fall back to checking every artifact on its own.
+                self.__can_list = False
+                return
+            except Exception as ex:
+                # The listing is only an optimization, a provider which can't list (for lack of permissions,
+                # say) still gets every artifact checked on its own.
+                logger.warning("Listing {} failed, checking artifacts one at a time: {}".format(prefix, ex))
+                self.__can_list = False
+                return
+            self.__listed_prefixes.append(prefix)
+
+    def __is_listed(self, path):
+        return any(path.startswith(prefix + '/') for prefix in self.__listed_prefixes)
+
+    def exists(self, path):
+        if self.__is_listed(path):
+            return path in self.__paths
+        return self.__provider.exists(path)
+
+    def add(self, path):
+        self.__paths.add(path)
+
+
+def apply_storage_command(
+        provider_name,
+        provider,
+        command,
+        attempts=STORAGE_COMMAND_ATTEMPTS,
+        retry_delay=1,
+        existing: Optional[ExistingArtifacts]=None):
+    """Run a storage command, retrying with exponential backoff when it fails.
+
+    Returns the number of bytes stored, or None if the command was skipped."""
+    path = command['args']['destination_path']
+    exists = existing.exists if existing is not None else provider.exists
+    for attempt in range(1, attempts + 1):
+        try:
+            # If it is only supposed to be if the artifact does not exist, check for existence
+            # and skip if it exists.
+            if command['if_not_exists'] and exists(path):
+                print("Store to", provider_name, "artifact", path, "skipped because it already exists")
+                return None
+            print("Store to", provider_name, "artifact", path, "by method", command['method'])
+            getattr(provider, command['method'])(**command['args'])
+            if existing is not None:
+                existing.add(path)
+            return get_storage_command_size(command)
+        except release.storage.UnsupportedOperation:
+            raise
+        except Exception as ex:
+            if attempt == attempts:
+                raise
+            delay = retry_delay * 2 ** (attempt - 1)
+            print("Store to", provider_name, "artifact", path, "failed, retrying in {}s: {}".format(delay, ex))
+            time.sleep(delay)
+
+
+def apply_storage_commands(
+        storage_providers: dict,
+        storage_commands: dict,
+        concurrency: Optional[dict]=None,
+        attempts: int=STORAGE_COMMAND_ATTEMPTS,
+        retry_delay: float=1) -> None:
+    """Run the storage commands against every storage provider.
+
+    All of stage1 is stored before any of stage2. Within a stage the commands run in parallel across
+    artifacts and providers, with at most concurrency[provider name] commands at once per provider."""
     assert storage_commands.keys() == {'stage1', 'stage2'}
+    concurrency = concurrency or {}
+
+    executors = {
+        name: concurrent.futures.ThreadPoolExecutor(max_workers=concurrency.get(name, DEFAULT_STORAGE_CONCURRENCY))
+        for name in storage_providers}
+    existing = {name: ExistingArtifacts(provider) for name, provider in storage_providers.items()}
+    stored_count = 0
+    skipped_count = 0
+    stored_bytes = 0
+    start = time.monotonic()
+    try:
+        for stage in ['stage1', 'stage2']:
+            checked_paths = [
+                command['args']['destination_path'] for command in storage_commands[stage]
+                if command['if_not_exists']]
+            prefetches = [
+                executors[provider_name].submit(existing[provider_name].prefetch, checked_paths)
+                for provider_name in storage_providers]
+            for future in prefetches:
+                future.result()
+            for wave in get_storage_command_waves(storage_commands[stage]):
+                futures = [
+                    executors[provider_name].submit(
+                        apply_storage_command, provider_name, provider, command, attempts, retry_delay,
+                        existing[provider_name])
+                    for provider_name, provider in storage_providers.items()
+                    for command in wave]
+                concurrent.futures.wait(futures)
+                # Raises the first failure, once nothing of the wave is in flight anymore.
+                for future in futures:
+                    size = future.result()
+                    if size is None:
+                        skipped_count += 1
+                    else:
+                        stored_count += 1
+                        stored_bytes += size
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
 
-    for stage in ['stage1', 'stage2']:
-        commands = storage_commands[stage]
-        for provider_name, provider in storage_providers.items():
-            for artifact in commands:
-                path = artifact['args']['destination_path']
-                # If it is only supposed to be if the artifact does not exist, check for existence
-                # and skip if it exists.
-                if artifact['if_not_exists'] and provider.exists(path):
-                    print("Store to", provider_name, "artifact", path, "skipped because it already exists")
-                    continue
-                print("Store to", provider_name, "artifact", path, "by method", artifact['method'])
-                getattr(provider, artifact['method'])(**artifact['args'])
+    duration = max(time.monotonic() - start, 0.001)
+    print("Stored {} artifacts ({} skipped because they already exist), uploading {:.1f} MB in {:.1f}s "
+          "({:.1f} MB/s)".format(
+              stored_count, skipped_count, stored_bytes / 10**6, duration, stored_bytes / 10**6 / duration))
 
 
 # Two stages of uploading artifacts. First puts all the artifacts into their places / uploads
@@ -697,6 +890,7 @@ class ReleaseManager():
 
     def _setup_storage(self, storage_config):
         self.__storage_providers = {}
+        self.__storage_concurrency = {}
         for name, options in storage_config.items():
             options = copy.deepcopy(options)
             if 'kind' not in options:
@@ -708,6 +902,9 @@ class ReleaseManager():
             read_only = options.get('read_only', False)
             if 'read_only' in options:
                 del options['read_only']
+            if 'concurrency' in options:
+                self.__storage_concurrency[name] = options['concurrency']
+                del options['concurrency']
 
             # Construct the storage, making sure all remaining configuration options
             # are used.
@@ -734,12 +931,15 @@ class ReleaseManager():
     def get_metadata(self, src_channel):
         return from_json(self.__preferred_provider.fetch(src_channel + '/metadata.json').decode())
 
-    def fetch_key_artifacts(self, metadata):
+    def fetch_key_artifacts(self, metadata, download=True):
+        """Point the core artifacts at their copies in the repository, so they are copied there rather than
+        uploaded. With download, also fetch the ones missing locally, all at once."""
         assert metadata['reproducible_artifact_path'][-1] != '/'
         assert metadata['repository_path'][-1] != '/'
 
         def fetch_artifact(artifact):
-            print("Fetching core artifact if it doesn't exist: ", artifact)
+            if download:
+                print("Fetching core artifact if it doesn't exist: ", artifact)
             if 'channel_path' in artifact:
                 assert artifact['channel_path'][0] != '/'
                 src_path = metadata['reproducible_artifact_path'] + '/' + artifact['channel_path']
@@ -752,7 +952,8 @@ class ReleaseManager():
                     dest_path = 'packages/cache/complete/' + dest_path
                 else:
                     dest_path = 'packages/cache/bootstrap/' + dest_path
-                self.__preferred_provider.download(src_path, dest_path)
+                if download:
+                    self.__preferred_provider.download(src_path, dest_path)
                 artifact['local_copy_from'] = src_path
                 artifact['local_path'] = artifact['channel_path']
             if 'reproducible_path' in artifact:
@@ -762,12 +963,14 @@ class ReleaseManager():
 
                 src_path = metadata['repository_path'] + '/' + artifact['reproducible_path']
 
-                self.__preferred_provider.download_if_not_exist(src_path, local_path)
+                if download:
+                    self.__preferred_provider.download_if_not_exist(src_path, local_path)
                 artifact['local_copy_from'] = src_path
                 artifact['local_path'] = local_path
 
-        for artifact in metadata['core_artifacts']:
-            fetch_artifact(artifact)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DEFAULT_STORAGE_CONCURRENCY) as executor:
+            for future in [executor.submit(fetch_artifact, artifact) for artifact in metadata['core_artifacts']]:
+                future.result()
 
     def promote(self, src_channel, destination_repository, destination_channel):
         metadata = self.get_metadata(src_channel)
@@ -777,7 +980,9 @@ class ReleaseManager():
         assert metadata['commit'] == util.dcos_image_commit, "You must promote from a checkout of " \
             "the same commit when `release create` aws run. {}".format(util.dcos_image_commit)
 
-        self.fetch_key_artifacts(metadata)
+        # The core artifacts are copied within the storage providers. Only the installer is built out of the local
+        # copies of them.
+        self.fetch_key_artifacts(metadata, download=bool(LOCAL_ARTIFACT_PROVIDERS & set(self.__provider_names)))
 
         repository = Repository(destination_repository, destination_channel, 'commit/{}'.format(metadata['commit']))
         set_repository_metadata(
@@ -788,6 +993,10 @@ class ReleaseManager():
         metadata['channel_artifacts'] = make_channel_artifacts(metadata, self.__provider_names)
 
         storage_commands = repository.make_commands(metadata)
+        commands = storage_commands['stage1'] + storage_commands['stage2']
+        print("Promotion plan: {} copies and {} uploads to each storage provider".format(
+            sum(command['method'] == 'copy' for command in commands),
+            sum(command['method'] == 'upload' for command in commands)))
         self.apply_storage_commands(storage_commands)
 
         return metadata
@@ -848,7 +1057,7 @@ class ReleaseManager():
             return
 
         with logger.scope("Uploading artifacts"):
-            apply_storage_commands(self.__storage_providers, storage_commands)
+            apply_storage_commands(self.__storage_providers, storage_commands, self.__storage_concurrency)
 
 
 _config = None
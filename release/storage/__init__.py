@@ -1,5 +1,8 @@
 import abc
+import contextlib
+import io
 import os.path
+import tempfile
 
 from pkgpanda.util import make_directory
 
@@ -44,6 +47,24 @@ class AbstractStorageProvider(metaclass=abc.ABCMeta):
 
         self.download(path, local_path)
 
+    @contextlib.contextmanager
+    def open_read(self, path):
+        """Context manager giving a binary file object to stream the contents of the given file from.
+
+        Providers which can stream a file override this, by default the whole file is fetched first."""
+        yield io.BytesIO(self.fetch(path))
+
+    @contextlib.contextmanager
+    def open_write(self, destination_path, no_cache=False, content_type=None):
+        """Context manager giving a binary file object to stream the contents of destination_path to.
+
+        The file is only stored once the block exits without an exception. Providers which can stream a file
+        override this, by default the contents are gathered in a local temporary file which is uploaded."""
+        with tempfile.NamedTemporaryFile() as f:
+            yield f
+            f.flush()
+            self.upload(destination_path, local_path=f.name, no_cache=no_cache, content_type=content_type)
+
     @abc.abstractmethod
     def exists(self, path):
         """Return true iff the given file / path exists."""
@@ -108,6 +129,12 @@ class ReadOnlyProxy(AbstractStorageProvider):
     def download(self, path, local_path):
         return self._storage_provider.download(path, local_path)
 
+    def open_read(self, path):
+        return self._storage_provider.open_read(path)
+
+    def open_write(self, destination_path, no_cache=False, content_type=None):
+        raise UnsupportedOperation("open_write on read-only storage")
+
     def exists(self, path):
         return self._storage_provider.exists(path)
 
@@ -1,10 +1,22 @@
+import concurrent.futures
+import contextlib
+import threading
 from typing import Optional
 
 import boto3
+import boto3.s3.transfer
 import botocore
 
 from release.storage import AbstractStorageProvider
 
+# Objects up to the part size are stored with a single request, larger ones are uploaded in parts of that size
+# in parallel.
+DEFAULT_MULTIPART_PART_SIZE = 64 * 1024 * 1024
+DEFAULT_MULTIPART_CONCURRENCY = 8
+# Smallest part S3 accepts in a multipart upload, other than the last one.
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024
+FETCH_CHUNK_SIZE = 1024 * 1024
+
 
 def get_aws_session(access_key_id, secret_access_key, region_name=None):
     """ This method will replace access_key_id and secret_access_key
@@ -27,15 +39,86 @@ def get_aws_session(access_key_id, secret_access_key, region_name=None):
         region_name=region_name)
 
 
+class S3MultipartWriter:
+    """Binary file object which stores what is written to it in an S3 object.
+
+    Data is sent in parts of part_size bytes as it comes, with up to concurrency parts in flight, which also
+    bounds the memory used to about concurrency + 1 parts. Nothing is stored until close(), abort() cancels
+    the upload."""
+
+    def __init__(self, s3_object, extra_args: dict, part_size: int, concurrency: int):
+        self.__object = s3_object
+        self.__extra_args = extra_args
+        self.__part_size = part_size
+        self.__buffer = bytearray()
+        self.__upload = None
+        self.__parts = []
+        self.__executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.__slots = threading.BoundedSemaphore(concurrency)
+
+    def write(self, data):
+        self.__buffer += data
+        while len(self.__buffer) >= self.__part_size:
+            self.__send_part(bytes(self.__buffer[:self.__part_size]))
+            del self.__buffer[:self.__part_size]
+        return len(data)
+
+    def __send_part(self, data):
+        if self.__upload is None:
+            self.__upload = self.__object.initiate_multipart_upload(**self.__extra_args)
+        # Wait for a part to be sent before buffering yet another one.
+        self.__slots.acquire()
+        self.__parts.append(self.__executor.submit(self.__upload_part, len(self.__parts) + 1, data))
+
+    def __upload_part(self, number, data):
+        try:
+            response = self.__upload.Part(number).upload(Body=data)
+            return {'PartNumber': number, 'ETag': response['ETag']}
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        try:
+            if self.__upload is None:
+                self.__object.put(Body=bytes(self.__buffer), **self.__extra_args)
+                return
+            if self.__buffer:
+                self.__send_part(bytes(self.__buffer))
+                self.__buffer.clear()
+            parts = [part.result() for part in self.__parts]
+            self.__upload.complete(MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.__executor.shutdown()
+
+    def abort(self):
+        self.__executor.shutdown()
+        if self.__upload is not None:
+            self.__upload.abort()
+
+
 class S3StorageProvider(AbstractStorageProvider):
     name = 'aws'
 
     def __init__(self, bucket, object_prefix, download_url,
-                 access_key_id=None, secret_access_key=None, region_name=None):
+                 access_key_id=None, secret_access_key=None, region_name=None,
+                 multipart_part_size=DEFAULT_MULTIPART_PART_SIZE, multipart_concurrency=DEFAULT_MULTIPART_CONCURRENCY):
         """ If access_key_id and secret_acccess_key are unset, boto3 will
         try to authenticate by other methods. See here for other credential options:
         http://boto3.readthedocs.io/en/latest/guide/configuration.html#configuring-credentials
+
+        Objects larger than multipart_part_size bytes are uploaded in parts of that size,
+        multipart_concurrency of them at once.
         """
+        assert int(multipart_part_size) >= MIN_MULTIPART_PART_SIZE
+        self.__multipart_part_size = int(multipart_part_size)
+        self.__multipart_concurrency = int(multipart_concurrency)
+        self.__transfer_config = boto3.s3.transfer.TransferConfig(
+            multipart_threshold=self.__multipart_part_size,
+            multipart_chunksize=self.__multipart_part_size,
+            max_concurrency=self.__multipart_concurrency)
         if object_prefix is not None:
             assert object_prefix and not object_prefix.startswith('/') and not object_prefix.endswith('/')
 
@@ -62,11 +145,33 @@ class S3StorageProvider(AbstractStorageProvider):
         return self.__bucket.Object(self._get_path(name))
 
     def fetch(self, path):
+        with self.open_read(path) as body:
+            data = bytearray()
+            for chunk in iter(lambda: body.read(FETCH_CHUNK_SIZE), b''):
+                data += chunk
+        return bytes(data)
+
+    @contextlib.contextmanager
+    def open_read(self, path):
         body = self.get_object(path).get()['Body']
-        data = bytes()
-        for chunk in iter(lambda: body.read(4096), b''):
-            data += chunk
-        return data
+        try:
+            yield body
+        finally:
+            body.close()
+
+    @contextlib.contextmanager
+    def open_write(self, destination_path, no_cache=False, content_type=None):
+        writer = S3MultipartWriter(
+            self.get_object(destination_path),
+            self._get_extra_args(no_cache, content_type),
+            self.__multipart_part_size,
+            self.__multipart_concurrency)
+        try:
+            yield writer
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
 
     def download_inner(self, path, local_path):
         self.get_object(path).download_file(local_path)
@@ -82,24 +187,29 @@ class S3StorageProvider(AbstractStorageProvider):
 
         new_object.copy_from(CopySource=old_path)
 
+    @staticmethod
+    def _get_extra_args(no_cache, content_type):
+        extra_args = {}
+        if no_cache:
+            extra_args['CacheControl'] = 'no-cache'
+        if content_type:
+            extra_args['ContentType'] = content_type
+        return extra_args
+
     def upload(self,
                destination_path: str,
                blob: Optional[bytes]=None,
                local_path: Optional[str]=None,
                no_cache: bool=False,
                content_type: Optional[str]=None):
-        extra_args = {}
-        if no_cache:
-            extra_args['CacheControl'] = 'no-cache'
-        if content_type:
-            extra_args['ContentType'] = content_type
+        extra_args = self._get_extra_args(no_cache, content_type)
 
         s3_object = self.get_object(destination_path)
 
         assert local_path is None or blob is None
         if local_path:
-            with open(local_path, 'rb') as data:
-                s3_object.put(Body=data, **extra_args)
+            # Large files go in parallel multipart uploads.
+            s3_object.upload_file(local_path, ExtraArgs=extra_args, Config=self.__transfer_config)
         else:
             assert isinstance(blob, bytes)
             s3_object.put(Body=blob, **extra_args)
@@ -118,7 +228,7 @@ class S3StorageProvider(AbstractStorageProvider):
             name = object_summary.key
 
             # Sanity check the prefix is there before removing.
-            assert name.startswith(self.__object_prefix + '/')
+            assert name.startswith(self.object_prefix)
 
             # Add the unprefixed name since the caller of this function doesn't
             # know we've added the prefix / only sees inside the prefix ever.
@@ -1,9 +1,12 @@
+import contextlib
 import os
 
 import requests
 
 from release.storage import AbstractStorageProvider
 
+CHUNK_SIZE = 1024 * 1024
+
 
 class HttpStorageProvider(AbstractStorageProvider):
     name = 'http'
@@ -35,7 +38,7 @@ class HttpStorageProvider(AbstractStorageProvider):
             with open(local_path_tmp, 'w+b') as f:
                 r = requests.get(url, stream=True)
                 r.raise_for_status()
-                for chunk in r.iter_content(chunk_size=4096):
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
                     f.write(chunk)
                 os.rename(local_path_tmp, local_path)
         except:
@@ -46,6 +49,16 @@ class HttpStorageProvider(AbstractStorageProvider):
                 pass
             raise
 
+    @contextlib.contextmanager
+    def open_read(self, path):
+        r = requests.get(url=self._get_absolute(path), stream=True)
+        try:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            yield r.raw
+        finally:
+            r.close()
+
     def exists(self, path):
         url = self._get_absolute(path)
 
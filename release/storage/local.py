@@ -1,10 +1,37 @@
+import contextlib
 import os.path
+import subprocess
+import sys
+import uuid
 from typing import Optional
 
 from pkgpanda.util import copy_file, is_absolute_path, make_directory, remove_directory
 from release.storage import AbstractStorageProvider
 
 
+@contextlib.contextmanager
+def replace_atomic(full_path):
+    """Give a temporary path to write to, which then replaces full_path.
+
+    Files are never rewritten in place since they may be hardlinked to other files of the storage."""
+    make_directory(os.path.dirname(full_path))
+    tmp_path = '{}.tmp-{}'.format(full_path, uuid.uuid4().hex)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, full_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def clone_file(source_path, destination_path):
+    """Copy a file, sharing its blocks (reflink) where the filesystem supports it."""
+    if sys.platform.startswith('linux'):
+        subprocess.check_call(['cp', '--reflink=auto', source_path, destination_path])
+    else:
+        copy_file(source_path, destination_path)
+
+
 # Local storage provider useful for testing. Not used for the local artifacts
 # since it would cause excess / needless copies, and doesn't work for "promote"
 # since the artifacts won't be local (And downloading them all to be local
@@ -24,15 +51,16 @@ class LocalStorageProvider(AbstractStorageProvider):
             return f.read()
 
     def download_inner(self, path, local_path):
-        copy_file(self.__full_path(path), local_path)
-
-    # Copy between fully qualified paths
-    def __copy(self, full_source_path, full_destination_path):
-        make_directory(os.path.dirname(full_destination_path))
-        copy_file(full_source_path, full_destination_path)
+        clone_file(self.__full_path(path), local_path)
 
     def copy(self, source_path, destination_path):
-        self.__copy(self.__full_path(source_path), self.__full_path(destination_path))
+        # Files within the storage are immutable, so copies are hardlinks, falling back to a copy across
+        # filesystems or where links aren't supported.
+        with replace_atomic(self.__full_path(destination_path)) as tmp_path:
+            try:
+                os.link(self.__full_path(source_path), tmp_path)
+            except OSError:
+                clone_file(self.__full_path(source_path), tmp_path)
 
     def upload(
             self,
@@ -43,16 +71,24 @@ class LocalStorageProvider(AbstractStorageProvider):
             content_type: Optional[str]=None):
         # TODO(cmaloney): Don't discard the extra no_cache / content_type. We ideally want to be
         # able to test those are set.
-        destination_full_path = self.__full_path(destination_path)
-        make_directory(os.path.dirname(destination_full_path))
-
         assert local_path is None or blob is None
-        if local_path:
-            self.__copy(local_path, destination_full_path)
-        else:
-            assert isinstance(blob, bytes)
-            with open(destination_full_path, 'wb') as f:
-                f.write(blob)
+        with replace_atomic(self.__full_path(destination_path)) as tmp_path:
+            if local_path:
+                # Not a hardlink, the local file isn't ours and may be modified in place later.
+                clone_file(local_path, tmp_path)
+            else:
+                assert isinstance(blob, bytes)
+                with open(tmp_path, 'wb') as f:
+                    f.write(blob)
+
+    def open_read(self, path):
+        return open(self.__full_path(path), 'rb')
+
+    @contextlib.contextmanager
+    def open_write(self, destination_path, no_cache=False, content_type=None):
+        with replace_atomic(self.__full_path(destination_path)) as tmp_path:
+            with open(tmp_path, 'wb') as f:
+                yield f
 
     def exists(self, path):
         assert not is_absolute_path(path)
@@ -69,11 +105,19 @@ class LocalStorageProvider(AbstractStorageProvider):
 
     def list_recursive(self, path):
         final_filenames = set()
-        for dirpath, _, filenames in os.walk(self.__full_path(path)):
-            assert dirpath.startswith(self.__storage_path)
-            dirpath_no_prefix = dirpath[len(self.__storage_path) + 1:]
-            for filename in filenames:
-                final_filenames.add(dirpath_no_prefix + '/' + filename)
+        # os.scandir gives the file types along with the names, no stat per entry is needed.
+        folders = [path]
+        while folders:
+            folder = folders.pop()
+            try:
+                entries = list(os.scandir(self.__full_path(folder)))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    folders.append(folder + '/' + entry.name)
+                else:
+                    final_filenames.add(folder + '/' + entry.name)
 
         return final_filenames
 
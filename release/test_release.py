@@ -9,6 +9,7 @@ import pytest
 
 import release
 import release.storage.aws
+import release.storage.local
 from pkgpanda.build import BuildError
 from pkgpanda.util import is_windows, make_directory, variant_prefix, write_json, write_string
 from . import load_provider_names
@@ -171,9 +172,27 @@ def exercise_storage_provider(tmpdir, name, config):
         store.copy(upload_file_path, copy_dest_path)
         check_file(copy_dest_path, upload_file)
 
+        # Test streaming a file in and out.
+        stream_path = get_path('stream/stream.txt')
+        stream_content = make_content("stream")
+        with store.open_write(stream_path, **upload_extra_args) as f:
+            for i in range(0, len(stream_content), 4):
+                f.write(stream_content[i:i + 4])
+        check_file(stream_path, stream_content)
+        with store.open_read(stream_path) as f:
+            assert f.read() == stream_content
+
+        # Nothing is stored when writing fails.
+        with pytest.raises(RuntimeError):
+            with store.open_write(get_path('stream/failed.txt'), **upload_extra_args) as f:
+                f.write(stream_content)
+                raise RuntimeError()
+        assert not store.exists(get_path('stream/failed.txt'))
+
         # Check that listing all the files in the storage provider gives the list of
         # files we've uploaded / checked and only that list of files.
         assert store.list_recursive(test_base_path) == {
+            get_path('stream/stream.txt'),
             get_path('upload_file.txt'),
             get_path('upload_bytes.txt'),
             get_path('dir1/bar/upload_bytes2.txt'),
@@ -216,6 +235,190 @@ def test_storage_provider_local(tmpdir):
     exercise_storage_provider(work_dir, 'local_path', {'path': str(repo_dir)})
 
 
+@pytest.mark.skipif(is_windows, reason="Fails on windows, cause unknown")
+def test_storage_provider_local_links(tmpdir):
+    tmpdir.join('local').write('local')
+    storage = release.storage.local.LocalStorageProvider(str(tmpdir.join('repository')))
+    storage.upload('a/1', local_path=str(tmpdir.join('local')))
+    storage.copy('a/1', 'b/1')
+
+    # Copies within the storage share the file, uploads don't share the local one.
+    assert os.path.samefile(str(tmpdir.join('repository/a/1')), str(tmpdir.join('repository/b/1')))
+    assert not os.path.samefile(str(tmpdir.join('local')), str(tmpdir.join('repository/a/1')))
+
+    # Replacing one of the copies leaves the other alone.
+    storage.upload('b/1', blob=b'new')
+    assert storage.fetch('a/1') == b'local'
+    assert storage.fetch('b/1') == b'new'
+    assert storage.list_recursive('a') == {'a/1'}
+
+
+class FakeS3Object:
+    def __init__(self):
+        self.body = None
+        self.parts = {}
+        self.aborted = False
+
+    def put(self, Body, **kwargs):  # noqa: N803
+        self.body = Body
+
+    def initiate_multipart_upload(self, **kwargs):
+        return self
+
+    def Part(self, number):  # noqa: N802
+        parts = self.parts
+
+        class Part:
+            def upload(self, Body):  # noqa: N803
+                parts[number] = Body
+                return {'ETag': str(number)}
+        return Part()
+
+    def complete(self, MultipartUpload):  # noqa: N803
+        assert [part['PartNumber'] for part in MultipartUpload['Parts']] == sorted(self.parts)
+        self.body = b''.join(self.parts[number] for number in sorted(self.parts))
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_s3_multipart_writer():
+    s3_object = FakeS3Object()
+    writer = release.storage.aws.S3MultipartWriter(s3_object, {}, 4, 2)
+    writer.write(b'0123456789')
+    writer.write(b'abc')
+    writer.close()
+    assert s3_object.body == b'0123456789abc'
+    assert s3_object.parts == {1: b'0123', 2: b'4567', 3: b'89ab', 4: b'c'}
+
+    # Small objects take a single request.
+    s3_object = FakeS3Object()
+    writer = release.storage.aws.S3MultipartWriter(s3_object, {}, 4, 2)
+    writer.write(b'012')
+    writer.close()
+    assert (s3_object.body, s3_object.parts) == (b'012', {})
+
+    s3_object = FakeS3Object()
+    writer = release.storage.aws.S3MultipartWriter(s3_object, {}, 4, 2)
+    writer.write(b'0123456789')
+    writer.abort()
+    assert s3_object.aborted and s3_object.body is None
+
+
+class FlakyLocalStorageProvider(release.storage.local.LocalStorageProvider):
+    def __init__(self, path):
+        super().__init__(path)
+        self.failures = 0
+
+    def upload(self, destination_path, **kwargs):
+        # Fail the first upload of everything once.
+        if not self.exists(destination_path + '.failed'):
+            self.failures += 1
+            super().upload(destination_path + '.failed', blob=b'')
+            raise ConnectionError('connection reset')
+        super().upload(destination_path, **kwargs)
+
+
+def test_apply_storage_commands(tmpdir):
+    tmpdir.join('local/1.tar.xz').write('1' * 100, ensure=True)
+    storage_commands = {
+        'stage1': [
+            {'method': 'upload', 'if_not_exists': True,
+             'args': {'destination_path': 'packages/1.tar.xz', 'local_path': str(tmpdir.join('local/1.tar.xz'))}},
+            {'method': 'copy', 'if_not_exists': False,
+             'args': {'source_path': 'packages/1.tar.xz', 'destination_path': 'channel/1.tar.xz'}},
+            {'method': 'upload', 'if_not_exists': False,
+             'args': {'destination_path': 'channel/metadata.json', 'blob': b'{}'}}],
+        'stage2': [
+            {'method': 'copy', 'if_not_exists': False,
+             'args': {'source_path': 'channel/metadata.json', 'destination_path': 'metadata.json'}}]}
+
+    # Copies of an artifact wait for its upload.
+    assert release.get_storage_command_waves(storage_commands['stage1']) == [
+        [storage_commands['stage1'][0], storage_commands['stage1'][2]], [storage_commands['stage1'][1]]]
+
+    providers = {
+        'a': release.storage.local.LocalStorageProvider(str(tmpdir.join('a'))),
+        'b': FlakyLocalStorageProvider(str(tmpdir.join('b')))}
+    release.apply_storage_commands(providers, storage_commands, {'a': 1, 'b': 4}, retry_delay=0)
+    for name in providers:
+        assert tmpdir.join(name, 'channel/1.tar.xz').read() == '1' * 100
+        assert tmpdir.join(name, 'metadata.json').read() == '{}'
+    assert providers['b'].failures == 2
+
+    # Failures past the last attempt are raised.
+    providers['b'].remove_recursive('channel/metadata.json.failed')
+    with pytest.raises(ConnectionError):
+        release.apply_storage_commands(providers, storage_commands, attempts=1, retry_delay=0)
+
+
+class CountingLocalStorageProvider(release.storage.local.LocalStorageProvider):
+    def __init__(self, path):
+        super().__init__(path)
+        self.calls = []
+
+    def exists(self, path):
+        self.calls.append(('exists', path))
+        return super().exists(path)
+
+    def list_recursive(self, path):
+        self.calls.append(('list_recursive', path))
+        return super().list_recursive(path)
+
+
+def test_get_listing_prefixes():
+    assert release.get_listing_prefixes([
+        'repo/packages/a/a--1.tar.xz',
+        'repo/packages/b/b--1.tar.xz',
+        'repo/bootstrap/1.bootstrap.tar.xz',
+        'repo/bootstrap/1.active.json',
+        'metadata.json']) == ['repo/bootstrap', 'repo/packages']
+    assert release.get_listing_prefixes(['repo/packages/a/a--1.tar.xz']) == ['repo/packages/a']
+
+
+def test_apply_storage_commands_lists_existing(tmpdir):
+    provider = CountingLocalStorageProvider(str(tmpdir.join('storage')))
+    provider.upload('repo/packages/a/a--1.tar.xz', blob=b'a')
+
+    def upload(path):
+        return {'method': 'upload', 'if_not_exists': True, 'args': {'destination_path': path, 'blob': b'new'}}
+
+    storage_commands = {
+        'stage1': [upload('repo/packages/{0}/{0}--1.tar.xz'.format(name)) for name in 'abc'] + [
+            upload('metadata.json')],
+        'stage2': [upload('repo/packages/c/c--1.tar.xz')]}
+    release.apply_storage_commands({'storage': provider}, storage_commands, retry_delay=0)
+
+    # A single listing, which learns about the artifacts stored since rather than being repeated.
+    assert provider.calls == [('list_recursive', 'repo/packages'), ('exists', 'metadata.json')]
+    assert provider.fetch('repo/packages/a/a--1.tar.xz') == b'a'
+    assert provider.fetch('repo/packages/b/b--1.tar.xz') == b'new'
+
+
+def test_apply_storage_commands_listing_fails(tmpdir):
+    class UnlistableLocalStorageProvider(CountingLocalStorageProvider):
+        def list_recursive(self, path):
+            super().list_recursive(path)
+            raise PermissionError('AccessDenied')
+
+    provider = UnlistableLocalStorageProvider(str(tmpdir.join('storage')))
+    provider.upload('repo/packages/a/a--1.tar.xz', blob=b'a')
+    storage_commands = {
+        'stage1': [
+            {'method': 'upload', 'if_not_exists': True, 'args': {'destination_path': path, 'blob': b'new'}}
+            for path in ['repo/packages/a/a--1.tar.xz', 'repo/packages/b/b--1.tar.xz']],
+        'stage2': []}
+    release.apply_storage_commands({'storage': provider}, storage_commands, retry_delay=0)
+
+    # Every artifact is checked on its own instead, and listing isn't tried again.
+    assert provider.calls[0] == ('list_recursive', 'repo/packages')
+    assert sorted(provider.calls[1:]) == [
+        ('exists', 'repo/packages/a/a--1.tar.xz'),
+        ('exists', 'repo/packages/b/b--1.tar.xz')]
+    assert provider.fetch('repo/packages/a/a--1.tar.xz') == b'a'
+    assert provider.fetch('repo/packages/b/b--1.tar.xz') == b'new'
+
+
 copy_make_commands_result = {'stage1': [
     {
         'if_not_exists': True,
@@ -232,7 +435,7 @@ copy_make_commands_result = {'stage1': [
     {
         'if_not_exists': False,
         'args': {
-            'source_path': 'stable/3.html',
+            'source_path': '/test_source_repo/3.html',
             'destination_path': 'stable/commit/testing_commit_2/3.html'},
         'method': 'copy'},
     {
@@ -244,7 +447,7 @@ copy_make_commands_result = {'stage1': [
     {
         'if_not_exists': False,
         'args': {
-            'source_path': 'stable/3.json',
+            'source_path': '/test_source_repo/3.json',
             'destination_path': 'stable/commit/testing_commit_2/3.json'},
         'method': 'copy'},
     {
@@ -279,18 +482,6 @@ copy_make_commands_result = {'stage1': [
         'method': 'upload'}
     ],
     'stage2': [{
-        'if_not_exists': False,
-        'args': {
-            'source_path': 'stable/3.html',
-            'destination_path': 'stable/3.html'},
-        'method': 'copy'},
-    {
-        'if_not_exists': False,
-        'args': {
-            'source_path': 'stable/3.json',
-            'destination_path': 'stable/3.json'},
-        'method': 'copy'},
-    {
         'if_not_exists': False,
         'args': {
             'source_path': 'stable/commit/testing_commit_2/2.html',
@@ -390,6 +581,8 @@ def exercise_make_commands(repository):
     }
 
     assert repository.make_commands(metadata) == copy_make_commands_result
+    # Copies of an artifact are all made from its source, so they run at once.
+    assert len(release.get_storage_command_waves(copy_make_commands_result['stage1'])) == 1
 
     upload_could_copy_artifacts = [{
         'reproducible_path': 'foo',
@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import copy
 import logging
 import os
@@ -6,8 +7,15 @@ try:
     import pty
 except ImportError:
     pass
+import re
+import shlex
+import shutil
+import signal
+import subprocess
 import sys
-
+import tempfile
+import threading
+import time
 from contextlib import contextmanager
 
 import ssh.validate
@@ -28,6 +36,99 @@ def make_slave_pty():
     os.close(master_pty)
 
 
+class PipeSource():
+    """The standard input of a pipe command, opened with async with.
+
+    source is either a local path, or a callable writing the data to the binary file object it is given,
+    which runs in a thread feeding a pipe. Leaving the block closes the read end and waits for that thread
+    in an executor, so a writer which is slow to notice doesn't hold up the event loop.
+    """
+    def __init__(self, source):
+        self.source = source
+        self.file = None
+        self.thread = None
+
+    async def __aenter__(self):
+        if not callable(self.source):
+            self.file = open(self.source, 'rb')
+            return self.file
+
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            try:
+                with os.fdopen(write_fd, 'wb') as f:
+                    self.source(f)
+            except BrokenPipeError:
+                # The command stopped reading, it didn't need the rest of the data.
+                pass
+            except Exception:
+                log.exception('Unable to write the data piped to the command')
+
+        self.file = os.fdopen(read_fd, 'rb')
+        self.thread = threading.Thread(target=write, daemon=True)
+        self.thread.start()
+        return self.file
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.file.close()
+        if self.thread is not None:
+            # With the read end closed, the writer is done one way or the other.
+            await asyncio.get_event_loop().run_in_executor(None, self.thread.join)
+
+
+class OutputBuffer():
+    """Collect the output of a command line by line, keeping only its last max_lines lines.
+
+    get_lines() splits the output like str.split('\\n') would. Lines longer than max_line_length bytes are
+    split up. Each line is passed to on_line as soon as it is complete.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, max_lines, on_line=None, split_cr=False, skip_prefix=None, max_line_length=64 * 1024):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+        self.partial = b''
+        self.on_line = on_line
+        self.split_cr = split_cr
+        self.skip_prefix = skip_prefix
+        self.max_line_length = max_line_length
+
+    async def read_from(self, stream):
+        while True:
+            data = await stream.read(self.chunk_size)
+            if not data:
+                return
+            self.feed(data)
+
+    def feed(self, data: bytes):
+        *complete, self.partial = (self.partial + data).split(b'\n')
+        for line in complete:
+            self._add_line(line)
+        while len(self.partial) > self.max_line_length:
+            self._add_line(self.partial[:self.max_line_length])
+            self.partial = self.partial[self.max_line_length:]
+
+    def _add_line(self, raw_line: bytes):
+        text = raw_line.decode(errors='replace')
+        for line in (text.split('\r') if self.split_cr else [text]):
+            if self.skip_prefix and line.startswith(self.skip_prefix):
+                continue
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+            if self.on_line is not None:
+                self.on_line(line)
+
+    def get_lines(self):
+        lines = list(self.lines)
+        if self.dropped:
+            lines.insert(0, '[{} earlier lines dropped]'.format(self.dropped))
+        # The text after the last newline, an empty string if the output ended with one.
+        last = self.partial.decode(errors='replace')
+        return lines + (last.split('\r') if self.split_cr else [last])
+
+
 def parse_ip(ip: str, default_port: int):
     tmp = ip.split(':')
     if len(tmp) == 2:
@@ -65,14 +166,147 @@ def add_host(target, default_port):
     return Node(target, default_port=default_port)
 
 
+def make_ssh_config(key_path=None, control_dir=None, control_persist=600, known_hosts_path=None):
+    """Return the contents of an ssh_config file with one host section applying to all hosts.
+
+    When control_dir is given, connections look for a master connection's socket in that directory
+    and multiplex over it when one is running. Otherwise they fall back to a connection of their own.
+    When known_hosts_path is given, the host key of each host is recorded there on the first connection.
+    """
+    options = [
+        ('ConnectTimeout', '10'),
+        ('StrictHostKeyChecking', 'no'),
+        ('UserKnownHostsFile', '"{}"'.format(known_hosts_path) if known_hosts_path else '/dev/null'),
+        ('HashKnownHosts', 'no'),
+        ('BatchMode', 'yes'),
+        ('PasswordAuthentication', 'no')]
+    if key_path:
+        options.append(('IdentityFile', '"{}"'.format(key_path)))
+    if control_dir:
+        options += [
+            ('ControlMaster', 'no'),
+            ('ControlPath', '"{}"'.format(os.path.join(control_dir, '%r@%h:%p'))),
+            ('ControlPersist', str(control_persist))]
+    return 'Host *\n' + ''.join('    {} {}\n'.format(key, value) for key, value in options)
+
+
+class RelayPool():
+    """Hand out the hosts which relay the data of a pipe command to other hosts.
+
+    At most fanout hosts get the data sent directly at a time. Every host which received the data relays
+    it to up to fanout other hosts at a time, until it moves on to its next chain. The number of hosts
+    holding the data so grows geometrically rather than linearly with time.
+    """
+    def __init__(self, fanout):
+        self.fanout = fanout
+        self.direct = 0
+        # Relays in progress from each source host.
+        self.sources = collections.OrderedDict()
+        self.retiring = set()
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        """Return the host to relay the data from, or None to send it directly."""
+        async with self.condition:
+            while True:
+                for source, relays in self.sources.items():
+                    if relays < self.fanout and source not in self.retiring:
+                        self.sources[source] += 1
+                        return source
+                if self.direct < self.fanout:
+                    self.direct += 1
+                    return None
+                await self.condition.wait()
+
+    async def release(self, source):
+        async with self.condition:
+            if source is None:
+                self.direct -= 1
+            else:
+                self.sources[source] -= 1
+            self.condition.notify_all()
+
+    async def add_source(self, host):
+        async with self.condition:
+            self.sources[host] = 0
+            self.condition.notify_all()
+
+    async def remove_source(self, host):
+        """Stop relaying from host, waiting for the relays in progress from it to finish."""
+        async with self.condition:
+            if host not in self.sources:
+                return
+            self.retiring.add(host)
+            while self.sources[host]:
+                await self.condition.wait()
+            del self.sources[host]
+            self.retiring.discard(host)
+            self.condition.notify_all()
+
+
+class ConcurrencyPool():
+    """Limit how many commands of one kind run at a time.
+
+    In adaptive mode the limit starts at limit and moves between 1 and maximum: it grows by one once as
+    many commands as the limit allows finished normally, and halves when a command fails to connect or
+    times out, or takes more than latency_factor times as long as the fastest run of the same stage. At
+    most one decrease happens per limit commands, so one burst of slow commands halves it only once.
+    """
+    def __init__(self, limit, adaptive=False, maximum=100, latency_factor=4):
+        self.limit = limit
+        self.adaptive = adaptive
+        self.maximum = max(limit, maximum)
+        self.latency_factor = latency_factor
+        self.active = 0
+        self.condition = asyncio.Condition()
+        # Fastest run seen of each stage.
+        self.baseline = {}
+        self.successes = 0
+        self.since_decrease = 0
+
+    async def acquire(self):
+        async with self.condition:
+            while self.active >= self.limit:
+                await self.condition.wait()
+            self.active += 1
+
+    async def release(self, stage=None, latency=None, returncode=0):
+        """Free the slot of a command, adapting the limit to how it went unless stage is None."""
+        async with self.condition:
+            self.active -= 1
+            if self.adaptive and stage is not None:
+                self._adapt(stage, latency, returncode)
+            self.condition.notify_all()
+
+    def _adapt(self, stage, latency, returncode):
+        self.since_decrease += 1
+        baseline = self.baseline.setdefault(stage, latency)
+        self.baseline[stage] = min(baseline, latency)
+        # ssh exits with 255 when it can't connect, None means the command timed out. Other failures are
+        # the command's own and don't tell anything about the load.
+        overloaded = returncode in (255, None) or latency > self.latency_factor * max(baseline, 0.01)
+        if overloaded:
+            self.successes = 0
+            if self.since_decrease >= self.limit and self.limit > 1:
+                self.limit = max(1, self.limit // 2)
+                self.since_decrease = 0
+                log.info('Lowered concurrency to {}'.format(self.limit))
+        else:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                log.debug('Raised concurrency to {}'.format(self.limit))
+
+
 class MultiRunner():
+    # Seconds the ssh-agent forwarded to relaying hosts holds the key. Relays started after that send the
+    # data directly instead.
+    relay_key_lifetime = 3600
+
     def __init__(self, targets: list, async_delegate=None, user=None, key_path=None, extra_opts='',
-                 process_timeout=120, parallelism=10, default_port=22):
-        # TODO(cmaloney): accept an "ssh_config" object which generates an ssh
-        # config file, then add a '-F' to that temporary config file rather than
-        # manually building up / adding the arguments in _get_base_args which is
-        # very error prone to get the formatting right. Should have just one
-        # host section which applies to all hosts, sets things like "user".
+                 process_timeout=120, parallelism=10, default_port=22, multiplex=True, fanout=0,
+                 copy_parallelism=None, adaptive=False, output_max_lines=1000):
         self.extra_opts = extra_opts
         self.process_timeout = process_timeout
         self.user = user
@@ -80,17 +314,94 @@ class MultiRunner():
         self.ssh_bin = '/usr/bin/ssh'
         self.scp_bin = '/usr/bin/scp'
         self.async_delegate = async_delegate
+        # Only the last output_max_lines lines of stdout and stderr of a command are kept in the results.
+        self.output_max_lines = output_max_lines
         self.__targets = []
         for target in targets:
             self.__targets.append(add_host(target, default_port))
+        # Commands are limited by their kind, so bandwidth heavy copies don't hold back cheap commands
+        # and the other way around.
         self.__parallelism = parallelism
-
-    def _get_base_args(self, bin_name, host):
-        # TODO(cmaloney): Switch to SSH config file, documented above. A single
-        # user is always required.
+        self.__copy_parallelism = copy_parallelism or parallelism
+        # Adapt the limits to the observed latency and failures of the commands (see ConcurrencyPool).
+        self.adaptive = adaptive
+        self._command_pools = {}
+        # Open one master connection per host and run every command of the chains over it, rather
+        # than paying for a TCP connection, key exchange and authentication on every command.
+        self.multiplex = multiplex and not is_windows
+        # When set, the data of pipe commands which have a relay command is relayed between the targets
+        # (see RelayPool).
+        self.fanout = fanout
+        # Set for the duration of run_commands_chain_async() by _ssh_config().
+        self.ssh_config_path = None
+        self.known_hosts_path = None
+        self.agent_socket = None
+        # RelayPool of each pipe command, keyed by id(command).
+        self._relay_pools = {}
+
+    @contextmanager
+    def _ssh_config(self):
+        """Write the ssh config file (and control socket directory) used by all the commands of a run."""
+        config_dir = tempfile.mkdtemp(prefix='dcos-ssh-')
+        agent_pid = None
+        try:
+            self.ssh_config_path = os.path.join(config_dir, 'ssh_config')
+            self.known_hosts_path = os.path.join(config_dir, 'known_hosts')
+            with open(self.ssh_config_path, 'w') as f:
+                f.write(make_ssh_config(self.key_path, config_dir if self.multiplex else None,
+                                        known_hosts_path=self.known_hosts_path))
+            if self.fanout:
+                agent_pid = self._start_agent(os.path.join(config_dir, 'agent.sock'))
+            self._relay_pools = {}
+            yield
+        finally:
+            if agent_pid is not None:
+                try:
+                    os.kill(agent_pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            self.ssh_config_path = None
+            self.known_hosts_path = None
+            self.agent_socket = None
+            shutil.rmtree(config_dir, ignore_errors=True)
+
+    def _start_agent(self, agent_socket):
+        """Start an ssh-agent holding the ssh key, to be forwarded to the targets which relay data.
+
+        The agent is dedicated to this run and holds nothing but the ssh key, for relay_key_lifetime seconds
+        at most, rather than forwarding the operator's own agent.
+
+        Returns the pid of the agent, or None if it could not be started in which case data is not relayed.
+        """
+        try:
+            output = subprocess.check_output(['ssh-agent', '-s', '-a', agent_socket]).decode()
+            agent_pid = int(re.search(r'SSH_AGENT_PID=(\d+)', output).group(1))
+        except (OSError, subprocess.CalledProcessError, AttributeError) as ex:
+            log.warning('Unable to start ssh-agent, not relaying data between hosts: {}'.format(ex))
+            return None
+        try:
+            subprocess.check_call(['ssh-add', '-t', str(self.relay_key_lifetime), self.key_path],
+                                  env={'SSH_AUTH_SOCK': agent_socket},
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as ex:
+            log.warning('Unable to add the ssh key to ssh-agent, not relaying data between hosts: {}'.format(ex))
+            os.kill(agent_pid, signal.SIGTERM)
+            return None
+        self.agent_socket = agent_socket
+        return agent_pid
+
+    def _get_env(self):
+        env = {'TERM': 'linux'}
+        if self.agent_socket:
+            env['SSH_AUTH_SOCK'] = self.agent_socket
+        return env
+
+    def _get_base_args(self, bin_name, host, tty=True):
+        assert self.ssh_config_path, 'ssh config must be written with _ssh_config()'
         if bin_name == self.ssh_bin:
             port_option = '-p'
-            add_opts = ['-tt']
+            # A pseudo-terminal would mangle binary data piped over the session.
+            add_opts = ['-tt'] if tty else ['-T']
             if self.extra_opts:
                 add_opts.extend(self.extra_opts.split(' '))
         else:
@@ -98,49 +409,109 @@ class MultiRunner():
             add_opts = []
         shared_opts = [
             bin_name,
-            '-oConnectTimeout=10',
-            '-oStrictHostKeyChecking=no',
-            '-oUserKnownHostsFile=/dev/null',
-            '-oBatchMode=yes',
-            '-oPasswordAuthentication=no',
-            '{}{}'.format(port_option, host.port),
-            '-i', self.key_path]
+            '-F', self.ssh_config_path,
+            '{}{}'.format(port_option, host.port)]
         shared_opts.extend(add_opts)
         return shared_opts
 
-    @asyncio.coroutine
-    def run_cmd_return_dict_async(self, cmd, host, namespace, future, stage):
-        with make_slave_pty() as slave_pty:
-            process = yield from asyncio.create_subprocess_exec(
-                *cmd, stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                stdin=slave_pty,
-                env={'TERM': 'linux'})
-            stdout = b''
-            stderr = b''
+    def _get_control_args(self, host, control_args):
+        args = [self.ssh_bin, '-F', self.ssh_config_path, '-p{}'.format(host.port)] + control_args
+        if self.extra_opts:
+            args.extend(self.extra_opts.split(' '))
+        return args + ['{}@{}'.format(self.user, host.ip)]
+
+    async def _run_control_cmd(self, cmd):
+        # The master connection stays in the background, make sure it does not hold on to any of our
+        # pipes.
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL, env=self._get_env())
+        try:
+            return await asyncio.wait_for(process.wait(), self.process_timeout)
+        except asyncio.TimeoutError:
             try:
-                stdout, stderr = yield from asyncio.wait_for(process.communicate(), self.process_timeout)
+                process.terminate()
+            except ProcessLookupError:
+                log.info('process with pid {} not found'.format(process.pid))
+            log.error('timeout of {} sec reached. PID {} killed'.format(self.process_timeout, process.pid))
+            await process.wait()
+
+    async def open_master(self, host):
+        """Start the master connection commands to host are multiplexed over.
+
+        Commands still work, each over a connection of its own, if the master fails to start.
+        """
+        if not self.multiplex:
+            return
+        cmd = self._get_control_args(host, ['-M', '-N', '-f'])
+        log.debug('opening master connection {}'.format(cmd))
+        returncode = await self._run_control_cmd(cmd)
+        if returncode != 0:
+            log.warning('Unable to open a master connection to {}:{}, returncode {}'.format(
+                host.ip, host.port, returncode))
+
+    async def close_master(self, host):
+        if not self.multiplex:
+            return
+        cmd = self._get_control_args(host, ['-O', 'exit'])
+        log.debug('closing master connection {}'.format(cmd))
+        await self._run_control_cmd(cmd)
+
+    async def _run_process(self, cmd, stdin, stdout, stderr):
+        # Return the returncode of cmd, None if it timed out, and its pid.
+        returncode = None
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            stdin=stdin,
+            env=self._get_env())
+        try:
+            await asyncio.wait_for(asyncio.gather(
+                stdout.read_from(process.stdout),
+                stderr.read_from(process.stderr),
+                process.wait()), self.process_timeout)
+            returncode = process.returncode
+        except asyncio.TimeoutError:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                log.info('process with pid {} not found'.format(process.pid))
+            log.error('timeout of {} sec reached. PID {} killed'.format(self.process_timeout, process.pid))
+            # Reap the process. The returncode stays None, marking the command as terminated.
+            try:
+                await asyncio.wait_for(process.wait(), 5)
             except asyncio.TimeoutError:
-                try:
-                    process.terminate()
-                except ProcessLookupError:
-                    log.info('process with pid {} not found'.format(process.pid))
-                log.error('timeout of {} sec reached. PID {} killed'.format(self.process_timeout, process.pid))
-
-        # For each possible line in stderr, match from the beginning of the line for the
-        # the confusing warning: "Warning: Permanently added ...". If the warning exists,
-        # remove it from the string.
-        err_arry = stderr.decode().split('\r')
-        stderr = bytes('\n'.join([line for line in err_arry if not line.startswith(
-            'Warning: Permanently added')]), 'utf-8')
+                process.kill()
+                await process.wait()
+        return returncode, process.pid
+
+    async def run_cmd_return_dict_async(self, cmd, host, namespace, future, stage, stdin_path=None):
+        def forward(stream):
+            # Show the output to the operator as it comes, rather than once the command finished.
+            if self.async_delegate is None:
+                return None
+            return lambda line: self.async_delegate.on_output(namespace, host, stage, stream, line)
+
+        stdout = OutputBuffer(self.output_max_lines, on_line=forward('stdout'))
+        # Drop the confusing warning: "Warning: Permanently added ..." which ssh prints to stderr for every
+        # new host, since the known hosts file is /dev/null.
+        stderr = OutputBuffer(self.output_max_lines, on_line=forward('stderr'), split_cr=True,
+                              skip_prefix='Warning: Permanently added')
+
+        if stdin_path:
+            async with PipeSource(stdin_path) as stdin:
+                returncode, pid = await self._run_process(cmd, stdin, stdout, stderr)
+        else:
+            with make_slave_pty() as stdin:
+                returncode, pid = await self._run_process(cmd, stdin, stdout, stderr)
 
         process_output = {
             '{}:{}'.format(host.ip, host.port): {
                 "cmd": cmd,
-                "stdout": stdout.decode().split('\n'),
-                "stderr": stderr.decode().split('\n'),
-                "returncode": process.returncode,
-                "pid": process.pid,
+                "stdout": stdout.get_lines(),
+                "stderr": stderr.get_lines(),
+                "returncode": returncode,
+                "pid": pid,
                 "stage": stage
             }
         }
@@ -148,8 +519,7 @@ class MultiRunner():
         future.set_result((namespace, process_output, host))
         return process_output
 
-    @asyncio.coroutine
-    def run_async(self, host, command, namespace, future, stage):
+    async def run_async(self, host, command, namespace, future, stage):
         # command consists of (command_flag, command, rollback, stage)
         # we will ignore all but command for now
         _, cmd, _, _ = command
@@ -160,11 +530,10 @@ class MultiRunner():
 
         full_cmd = self._get_base_args(self.ssh_bin, host) + ['{}@{}'.format(self.user, host.ip)] + cmd
         log.debug('executing command {}'.format(full_cmd))
-        result = yield from self.run_cmd_return_dict_async(full_cmd, host, namespace, future, stage)
+        result = await self.run_cmd_return_dict_async(full_cmd, host, namespace, future, stage)
         return result
 
-    @asyncio.coroutine
-    def copy_async(self, host, command, namespace, future, stage):
+    async def copy_async(self, host, command, namespace, future, stage):
         # command[0] is command_flag, command[-1] is stage
         # we will ignore them here.
         _, local_path, remote_path, remote_to_local, recursive, _ = command
@@ -178,10 +547,89 @@ class MultiRunner():
             copy_command += [local_path, remote_full_path]
         full_cmd = self._get_base_args(self.scp_bin, host) + copy_command
         log.debug('copy with command {}'.format(full_cmd))
-        result = yield from self.run_cmd_return_dict_async(full_cmd, host, namespace, future, stage)
+        result = await self.run_cmd_return_dict_async(full_cmd, host, namespace, future, stage)
         return result
 
-    def _run_chain_command(self, chain: CommandChain, host, chain_result):
+    def _relay_pool(self, command):
+        if not self.fanout or not self.agent_socket:
+            return None
+        return self._relay_pools.setdefault(id(command), RelayPool(self.fanout))
+
+    def _get_known_hosts(self, host):
+        """Return the lines of the known hosts file recorded for host by this run's connections to it."""
+        name = host.ip if host.port == 22 else '[{}]:{}'.format(host.ip, host.port)
+        try:
+            with open(self.known_hosts_path) as f:
+                return [line.strip() for line in f if name in line.split(' ', 1)[0].split(',')]
+        except IOError:
+            return []
+
+    def _get_relay_args(self, host, source, cmd, relay_cmd):
+        """Return the command relaying the data from source into cmd on host, or None if it can't be relayed.
+
+        It runs on host, fetching the data from source with the forwarded ssh-agent. The host key of source
+        is checked against the one this host saw, which is handed to host in a temporary known hosts file.
+        """
+        known_hosts = self._get_known_hosts(source)
+        if not known_hosts:
+            return None
+        fetch_cmd = [
+            'ssh', '-T',
+            '-oConnectTimeout=10',
+            '-oStrictHostKeyChecking=yes',
+            '-oUserKnownHostsFile="$known_hosts"',
+            '-oBatchMode=yes',
+            '-p{}'.format(source.port),
+            '{}@{}'.format(self.user, source.ip),
+            shlex.quote(' '.join(shlex.quote(arg) for arg in relay_cmd))]
+        script = ('known_hosts=$(mktemp) && printf \'%s\\n\' {} > "$known_hosts" && {} | {}; '
+                  'status=$?; rm -f "$known_hosts"; exit $status').format(
+            ' '.join(shlex.quote(line) for line in known_hosts), ' '.join(fetch_cmd), ' '.join(cmd))
+        return (self._get_base_args(self.ssh_bin, host, tty=False) + ['-A', '{}@{}'.format(self.user, host.ip)] +
+                ['sh', '-c', shlex.quote(script)])
+
+    async def pipe_async(self, host, command, namespace, future, stage):
+        # command[0] is command_flag, command[-1] is stage
+        # we will ignore them here.
+        _, local_path, cmd, relay_cmd, _ = command
+        if callable(cmd):
+            cmd = cmd(host)
+
+        pool = self._relay_pool(command) if relay_cmd else None
+        source = None
+        if pool is not None:
+            source = await pool.acquire()
+        try:
+            result = None
+            if source is not None:
+                full_cmd = self._get_relay_args(host, source, cmd, relay_cmd)
+                if full_cmd is None:
+                    log.warning('No host key of {} recorded, sending to {} directly'.format(source, host))
+                else:
+                    log.debug('relaying from {} into command {}'.format(source, full_cmd))
+                    relay_future = asyncio.Future()
+                    result = await self.run_cmd_return_dict_async(full_cmd, host, namespace, relay_future, stage)
+                    if result['{}:{}'.format(host.ip, host.port)]['returncode'] != 0:
+                        log.warning('Relaying from {} to {} failed, sending directly'.format(source, host))
+                        result = None
+                    else:
+                        future.set_result(relay_future.result())
+
+            if result is None:
+                full_cmd = (self._get_base_args(self.ssh_bin, host, tty=False) +
+                            ['{}@{}'.format(self.user, host.ip)] + cmd)
+                log.debug('piping {} into command {}'.format(local_path, full_cmd))
+                result = await self.run_cmd_return_dict_async(full_cmd, host, namespace, future, stage,
+                                                              stdin_path=local_path)
+        finally:
+            if pool is not None:
+                await pool.release(source)
+
+        if pool is not None and result['{}:{}'.format(host.ip, host.port)]['returncode'] == 0:
+            await pool.add_source(host)
+        return result
+
+    async def _run_chain_command(self, chain: CommandChain, host, chain_result):
 
         # Prepare status json
         if self.async_delegate is not None:
@@ -193,7 +641,8 @@ class MultiRunner():
 
         command_map = {
             CommandChain.execute_flag: self.run_async,
-            CommandChain.copy_flag: self.copy_async
+            CommandChain.copy_flag: self.copy_async,
+            CommandChain.pipe_flag: self.pipe_async
         }
 
         process_exit_code_map = {
@@ -224,8 +673,17 @@ class MultiRunner():
                 callback_called = asyncio.Future()
                 future.add_done_callback(lambda future: self.async_delegate.on_update(future, callback_called))
 
-            # command[0] is a type of a command, could be CommandChain.execute_flag, CommandChain.copy_flag
-            result = yield from command_map.get(command[0], None)(host, command, chain.namespace, future, stage)
+            # command[0] is a type of a command, could be CommandChain.execute_flag, CommandChain.copy_flag,
+            # CommandChain.pipe_flag
+            pool = self._command_pools[command[0]]
+            await pool.acquire()
+            start = time.monotonic()
+            try:
+                result = await command_map.get(command[0], None)(host, command, chain.namespace, future, stage)
+            except BaseException:
+                await pool.release()
+                raise
+            await pool.release(stage or command[0], time.monotonic() - start, result[host_port]['returncode'])
             status = process_exit_code_map.get(result[host_port]['returncode'], process_exit_code_map['failed'])
             host_status = status['host_status']
 
@@ -233,7 +691,7 @@ class MultiRunner():
                 # We need to make sure the callback was executed before we can proceed further
                 # 5 seconds should be enough for a callback.
                 try:
-                    yield from asyncio.wait_for(callback_called, 5)
+                    await asyncio.wait_for(callback_called, 5)
                 except asyncio.TimeoutError:
                     log.error('Callback did not execute within 5 sec')
                     host_status = 'terminated'
@@ -248,18 +706,51 @@ class MultiRunner():
             # Update chain status.
             self.async_delegate.on_done(chain.namespace, result, host_status=host_status)
 
-    @asyncio.coroutine
-    def dispatch_chain(self, host, chains, sem):
+    async def dispatch_chain(self, host, chains, sem):
         log.debug('Started dispatch_chain for host {}'.format(host))
         chain_result = []
-        with (yield from sem):
-            for chain in chains:
-                yield from self._run_chain_command(chain, host, chain_result)
+        async with sem:
+            await self.open_master(host)
+            try:
+                for chain in chains:
+                    try:
+                        await self._run_chain_command(chain, host, chain_result)
+                    finally:
+                        # The next chain may well remove the data this host relays.
+                        await self._remove_relay_source(chain, host)
+            finally:
+                await self.close_master(host)
         return chain_result
 
-    @asyncio.coroutine
-    def run_commands_chain_async(self, chains: list, block=False, state_json_dir=None, delegate_extra_params={}):
-        sem = asyncio.Semaphore(self.__parallelism)
+    async def _remove_relay_source(self, chain, host):
+        for command in chain.get_commands():
+            if command[0] == CommandChain.pipe_flag and command[3]:
+                pool = self._relay_pool(command)
+                if pool is not None:
+                    await pool.remove_source(host)
+
+    async def dispatch_chains(self, chains, sem):
+        with self._ssh_config():
+            tasks = []
+            for host in self.__targets:
+                tasks.append(asyncio.ensure_future(self.dispatch_chain(host, chains, sem)))
+
+            await asyncio.wait(tasks)
+        if self.async_delegate is not None:
+            self.async_delegate.flush()
+        return [task.result() for task in tasks]
+
+    async def run_commands_chain_async(self, chains: list, block=False, state_json_dir=None, delegate_extra_params={}):
+        execute_pool = ConcurrencyPool(self.__parallelism, self.adaptive)
+        copy_pool = ConcurrencyPool(self.__copy_parallelism, self.adaptive)
+        self._command_pools = {
+            CommandChain.execute_flag: execute_pool,
+            CommandChain.copy_flag: copy_pool,
+            CommandChain.pipe_flag: copy_pool}
+        # Bound the hosts in flight (and so their master connections) so that both pools can be kept busy
+        # while hosts move between kinds of commands.
+        sem = asyncio.Semaphore(execute_pool.maximum + copy_pool.maximum if self.adaptive else
+                                self.__parallelism + self.__copy_parallelism)
 
         if state_json_dir:
             log.debug('Using default JsonDelegate method, state_json_dir {}'.format(state_json_dir))
@@ -269,17 +760,12 @@ class MultiRunner():
 
         if block:
             log.debug('Waiting for run_command_chain_async to execute')
-            tasks = []
-            for host in self.__targets:
-                tasks.append(asyncio.async(self.dispatch_chain(host, chains, sem)))
-
-            yield from asyncio.wait(tasks)
+            result = await self.dispatch_chains(chains, sem)
             log.debug('run_command_chain_async executed')
-            return [task.result() for task in tasks]
+            return result
         else:
             log.debug('Started run_command_chain_async in non-blocking mode')
-            for host in self.__targets:
-                asyncio.async(self.dispatch_chain(host, chains, sem))
+            asyncio.ensure_future(self.dispatch_chains(chains, sem))
 
     def validate(self):
         """Raises an AssertException if validation does not pass"""
@@ -13,7 +13,7 @@ import pytest
 from retrying import retry
 
 import pkgpanda.util
-from ssh.runner import MultiRunner, Node
+from ssh.runner import ConcurrencyPool, MultiRunner, Node, OutputBuffer, RelayPool
 from ssh.utils import AbstractSSHLibDelegate, CommandChain
 
 
@@ -131,7 +131,8 @@ def test_ssh_async(sshd_manager, loop):
                     assert '/usr/bin/ssh' in process_result['cmd']
                     assert 'uname' in process_result['cmd']
                     assert '-tt' in process_result['cmd']
-                    assert len(process_result['cmd']) == 13
+                    assert '-F' in process_result['cmd']
+                    assert len(process_result['cmd']) == 8
 
 
 @pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
@@ -196,6 +197,65 @@ def test_scp_async(sshd_manager, loop):
                     assert workspace + '/pilot.txt' in process_result['cmd']
 
 
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_pipe_async(sshd_manager, loop):
+    with sshd_manager.run(1) as sshd_ports:
+        workspace = str(sshd_manager.tmpdir)
+        # Binary content must get through the session unchanged.
+        content = bytes(range(256)) * 64
+        with open(workspace + '/pilot.bin', 'wb') as f:
+            f.write(content)
+        runner = MultiRunner(['127.0.0.1:{}'.format(port) for port in sshd_ports], user=getpass.getuser(),
+                             key_path=sshd_manager.key_path)
+
+        chain = CommandChain('test')
+        chain.add_pipe(workspace + '/pilot.bin', ['cat', '>', workspace + '/pilot.bin.piped'])
+        try:
+            pipe_results = loop.run_until_complete(runner.run_commands_chain_async([chain], block=True,
+                                                                                   state_json_dir=workspace))
+        finally:
+            loop.close()
+
+        assert len(pipe_results) == 1
+        with open(workspace + '/pilot.bin.piped', 'rb') as f:
+            assert f.read() == content
+        for host_result in pipe_results:
+            for command_result in host_result:
+                for host, process_result in command_result.items():
+                    assert process_result['returncode'] == 0, process_result['stderr']
+                    assert '-T' in process_result['cmd']
+                    assert '-tt' not in process_result['cmd']
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_pipe_fanout_async(sshd_manager, loop):
+    with sshd_manager.run(5) as sshd_ports:
+        workspace = str(sshd_manager.tmpdir)
+        pkgpanda.util.write_string(workspace + '/pilot.txt', uuid.uuid4().hex)
+        runner = MultiRunner(['127.0.0.1:{}'.format(port) for port in sshd_ports], user=getpass.getuser(),
+                             key_path=sshd_manager.key_path, fanout=1)
+
+        # All the hosts share the filesystem, give each its own destination.
+        chain = CommandChain('test')
+        chain.add_pipe(
+            workspace + '/pilot.txt',
+            lambda node: ['cat', '>', '{}/pilot.txt.{}'.format(workspace, node.port)],
+            relay_cmd=['cat', workspace + '/pilot.txt.{}'.format(sshd_ports[0])])
+        try:
+            results = loop.run_until_complete(runner.run_commands_chain_async([chain], block=True,
+                                                                              state_json_dir=workspace))
+        finally:
+            loop.close()
+
+        for host_result in results:
+            for command_result in host_result:
+                for host, process_result in command_result.items():
+                    assert process_result['returncode'] == 0, process_result['stderr']
+        for port in sshd_ports:
+            assert pkgpanda.util.load_string(workspace + '/pilot.txt.{}'.format(port)) == \
+                pkgpanda.util.load_string(workspace + '/pilot.txt')
+
+
 @pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
 def test_scp_recursive_async(sshd_manager, loop):
     with sshd_manager.run(1) as sshd_ports:
@@ -245,6 +305,153 @@ def test_command_chain():
     ]
 
 
+def test_output_buffer():
+    lines = []
+    buffer = OutputBuffer(3, on_line=lines.append, max_line_length=8)
+    for data in [b'one\r\ntw', b'o\nthree\nfour', b'\nfive', b'\n0123456789']:
+        buffer.feed(data)
+    assert lines == ['one\r', 'two', 'three', 'four', 'five', '01234567']
+    assert buffer.get_lines() == ['[3 earlier lines dropped]', 'four', 'five', '01234567', '89']
+
+    buffer = OutputBuffer(10)
+    assert buffer.get_lines() == ['']
+    buffer.feed(b'done\n')
+    assert buffer.get_lines() == ['done', '']
+
+    buffer = OutputBuffer(10, split_cr=True, skip_prefix='Warning: Permanently added')
+    buffer.feed(b"Warning: Permanently added '127.0.0.1' to the list of known hosts.\r\nerror\n")
+    assert buffer.get_lines() == ['', 'error', '']
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_run_cmd_streams_output(loop):
+    class OutputDelegate(AbstractSSHLibDelegate):
+        lines = []
+
+        def on_update(self, future, callback):
+            callback.set_result(True)
+
+        def on_done(self, *args, **kwargs):
+            pass
+
+        def prepare_status(self, name, nodes):
+            pass
+
+        def on_output(self, name, host, stage, stream, line):
+            self.lines.append((stream, line))
+
+    delegate = OutputDelegate()
+    runner = MultiRunner(['127.0.0.1'], async_delegate=delegate, output_max_lines=2)
+    host = Node('127.0.0.1')
+    future = asyncio.Future(loop=loop)
+    result = loop.run_until_complete(runner.run_cmd_return_dict_async(
+        ['sh', '-c', 'echo 1; echo 2; echo 3; echo error >&2; exit 3'], host, 'test', future, 'stage'))
+
+    assert result['127.0.0.1:22']['stdout'] == ['[1 earlier lines dropped]', '2', '3', '']
+    assert result['127.0.0.1:22']['stderr'] == ['error', '']
+    assert result['127.0.0.1:22']['returncode'] == 3
+    assert future.result() == ('test', result, host)
+    assert ('stdout', '1') in delegate.lines
+    assert ('stderr', 'error') in delegate.lines
+
+    runner = MultiRunner(['127.0.0.1'], async_delegate=delegate, process_timeout=0.1)
+    result = loop.run_until_complete(runner.run_cmd_return_dict_async(
+        ['sleep', '20'], host, 'test', asyncio.Future(loop=loop), 'stage'))
+    assert result['127.0.0.1:22']['returncode'] is None
+
+
+def test_relay_pool(loop):
+    pool = RelayPool(fanout=1)
+    first, second = Node('10.0.0.1'), Node('10.0.0.2')
+
+    async def relay():
+        # Only one host gets the data directly at a time.
+        assert (await pool.acquire()) is None
+        waiting = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        # Once it has the data, it relays it.
+        await pool.release(None)
+        await pool.add_source(first)
+        assert (await waiting) is first
+        assert (await pool.acquire()) is None
+
+        # A host stops relaying once the relays in progress from it are done.
+        await pool.add_source(second)
+        removing = asyncio.ensure_future(pool.remove_source(first))
+        await asyncio.sleep(0)
+        assert not removing.done()
+        assert (await pool.acquire()) is second
+        await pool.release(first)
+        await removing
+        assert list(pool.sources) == [second]
+
+    loop.run_until_complete(relay())
+
+
+def test_concurrency_pool(loop):
+    async def run(pool, results):
+        for latency, returncode in results:
+            await pool.acquire()
+            await pool.release('stage', latency, returncode)
+
+    # Without adaptive mode the limit is fixed.
+    pool = ConcurrencyPool(2)
+    loop.run_until_complete(run(pool, [(1, 255)] * 4))
+    assert pool.limit == 2
+
+    async def limited():
+        await pool.acquire()
+        await pool.acquire()
+        third = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0)
+        assert not third.done()
+        await pool.release()
+        await third
+
+    loop.run_until_complete(limited())
+
+    pool = ConcurrencyPool(2, adaptive=True, maximum=3)
+    # Grows after limit commands finished normally, up to maximum. Failures of the command itself
+    # don't count against it.
+    loop.run_until_complete(run(pool, [(1, 0), (1, 1), (1, 0), (1, 0), (1, 0), (1, 0), (1, 0)]))
+    assert pool.limit == 3
+
+    # Halves on connection failures, timeouts and slow commands, once per limit commands.
+    loop.run_until_complete(run(pool, [(1, 255)]))
+    assert pool.limit == 1
+    loop.run_until_complete(run(pool, [(1, 0), (10, 0)]))
+    assert pool.limit == 1
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_ssh_config_multiplexing():
+    runner = MultiRunner(['127.0.0.1:2222'], user='centos', key_path='/key', extra_opts='-oLogLevel=ERROR')
+    host = Node('127.0.0.1:2222')
+    with runner._ssh_config():
+        config_path = runner.ssh_config_path
+        with open(config_path) as f:
+            config = f.read()
+        control_dir = os.path.dirname(config_path)
+        assert 'IdentityFile "/key"\n' in config
+        assert 'ControlMaster no\n' in config
+        assert 'ControlPath "{}/%r@%h:%p"\n'.format(control_dir) in config
+
+        assert runner._get_base_args(runner.ssh_bin, host) == [
+            '/usr/bin/ssh', '-F', config_path, '-p2222', '-tt', '-oLogLevel=ERROR']
+        assert runner._get_base_args(runner.scp_bin, host) == ['/usr/bin/scp', '-F', config_path, '-P2222']
+        assert runner._get_control_args(host, ['-O', 'exit']) == [
+            '/usr/bin/ssh', '-F', config_path, '-p2222', '-O', 'exit', '-oLogLevel=ERROR', 'centos@127.0.0.1']
+    assert runner.ssh_config_path is None
+    assert not os.path.exists(control_dir)
+
+    runner = MultiRunner(['127.0.0.1'], user='centos', key_path='/key', multiplex=False)
+    with runner._ssh_config():
+        with open(runner.ssh_config_path) as f:
+            assert 'Control' not in f.read()
+
+
 @pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
 def test_ssh_command_terminate_async(sshd_manager, loop):
     with sshd_manager.run(1) as sshd_ports:
@@ -307,16 +514,13 @@ def test_tags_async(sshd_manager, loop):
                 assert len(result_json['hosts'][host_port]['tags']) == 2
                 assert result_json['hosts'][host_port]['tags']['tag1'] == 'test1'
                 assert result_json['hosts'][host_port]['tags']['tag2'] == 'test2'
-                assert result_json['hosts'][host_port]['commands'][0]['cmd'] == [
+                cmd = result_json['hosts'][host_port]['commands'][0]['cmd']
+                assert cmd[2].endswith('/ssh_config')
+                assert cmd == [
                     "/usr/bin/ssh",
-                    "-oConnectTimeout=10",
-                    "-oStrictHostKeyChecking=no",
-                    "-oUserKnownHostsFile=/dev/null",
-                    "-oBatchMode=yes",
-                    "-oPasswordAuthentication=no",
+                    "-F",
+                    cmd[2],
                     "-p{}".format(sshd_ports[0]),
-                    "-i",
-                    "{}/host_key".format(workspace),
                     "-tt",
                     "{}@127.0.0.1".format(getpass.getuser()),
                     "sleep",
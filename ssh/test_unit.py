@@ -1,11 +1,18 @@
+import asyncio
 import copy
+import json
 import os
+import shlex
+import subprocess
 import tempfile
+import time
 
 import pytest
 
 import pkgpanda.util
 import ssh.validate
+from ssh.runner import MultiRunner, Node, PipeSource
+from ssh.utils import ChainStateStore, JsonDelegate
 
 
 @pytest.fixture
@@ -121,3 +128,142 @@ def test_ssh_parallelism(default_config):
         default_config['ssh_parallelism'] = 'foo'
         assert ssh.validate.validate_config(default_config) == {
             'ssh_parallelism': 'Must be an integer but got a str: foo'}
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_ssh_bundle_transfer(default_config):
+    with tempfile.NamedTemporaryFile() as tmp:
+        default_config['ssh_key_path'] = tmp.name
+
+        default_config['ssh_bundle_transfer'] = False
+        assert ssh.validate.validate_config(default_config) == {}
+
+        default_config['ssh_bundle_transfer'] = 'foo'
+        assert ssh.validate.validate_config(default_config) == {
+            'ssh_bundle_transfer': "Must be one of 'true', 'false'. Got 'foo'."}
+
+        default_config['ssh_bundle_transfer'] = 'true'
+        default_config['ssh_batched_preflight'] = 'yes'
+        assert ssh.validate.validate_config(default_config) == {
+            'ssh_batched_preflight': "Must be one of 'true', 'false'. Got 'yes'."}
+
+
+@pytest.mark.skipif(pkgpanda.util.is_windows, reason="Windows does not support ssh native")
+def test_ssh_copy_parallelism(default_config):
+    with tempfile.NamedTemporaryFile() as tmp:
+        default_config['ssh_key_path'] = tmp.name
+
+        default_config['ssh_parallelism'] = 'foo'
+        assert ssh.validate.validate_config(default_config) == {
+            'ssh_parallelism': 'Must be an integer but got a str: foo'}
+
+        default_config['ssh_parallelism'] = 20
+        default_config['ssh_copy_parallelism'] = 101
+        assert ssh.validate.validate_config(default_config) == {
+            'ssh_copy_parallelism': 'Must be between 1 and 100 inclusive'}
+
+        default_config['ssh_copy_parallelism'] = 5
+        default_config['ssh_adaptive_parallelism'] = True
+        assert ssh.validate.validate_config(default_config) == {}
+
+
+def test_json_delegate_event_log(tmpdir):
+    state_dir = str(tmpdir)
+    nodes = [Node('10.0.0.1', {'role': 'master'}), Node('10.0.0.2', {'role': 'agent'})]
+    delegate = JsonDelegate(state_dir, len(nodes), total_masters=1, total_agents=1)
+
+    def update(node, cmd):
+        future = asyncio.Future(loop=loop)
+        future.set_result(('deploy', {'{}:{}'.format(node.ip, node.port): {'cmd': cmd, 'returncode': 0}}, node))
+        callback_called = asyncio.Future(loop=loop)
+        delegate.on_update(future, callback_called)
+        assert callback_called.result()
+
+    loop = asyncio.new_event_loop()
+    try:
+        for node in nodes:
+            delegate.prepare_status('deploy', nodes)
+        # The hosts are listed right away.
+        assert json.loads(tmpdir.join('deploy.json').read())['hosts']['10.0.0.1:22'] == {
+            'commands': [], 'tags': {'role': 'master'}, 'host_status': 'unstarted'}
+
+        update(nodes[0], ['uname'])
+        update(nodes[0], ['true'])
+        update(nodes[1], ['uname'])
+        delegate.on_done('deploy', {'10.0.0.1:22': {}}, host_status='success')
+    finally:
+        loop.close()
+
+    # A new store sees every event, whether or not it made it into a snapshot yet.
+    state = ChainStateStore(state_dir, 'deploy').state
+    events = tmpdir.join('deploy.jsonl').read()
+    assert '"status"' in events
+    delegate.flush()
+    assert json.loads(tmpdir.join('deploy.json').read()) == state
+    # The snapshot replaces the log.
+    assert tmpdir.join('deploy.jsonl').read() == ''
+    assert state['total_hosts'] == 2
+    assert state['chain_name'] == 'deploy'
+    assert state['hosts']['10.0.0.1:22']['host_status'] == 'success'
+    assert [c['cmd'] for c in state['hosts']['10.0.0.1:22']['commands']] == [['uname'], ['true']]
+    assert state['hosts']['10.0.0.2:22']['host_status'] == 'running'
+
+    # Replaying events which are in the snapshot already changes nothing.
+    tmpdir.join('deploy.jsonl').write(events)
+    assert ChainStateStore(state_dir, 'deploy').state == state
+
+    store = ChainStateStore(state_dir, 'deploy')
+    assert store.remove_host('10.0.0.2:22')
+    assert not store.remove_host('10.0.0.2:22')
+    assert list(json.loads(tmpdir.join('deploy.json').read())['hosts']) == ['10.0.0.1:22']
+
+
+def test_chain_state_store_trailing_flush(tmpdir):
+    store = ChainStateStore(str(tmpdir), 'deploy', snapshot_interval=0.2)
+    store.add_event({'type': 'prepare', 'hosts': {'10.0.0.1:22': {}}})
+    # The event came in before the interval was up, the snapshot follows once it is.
+    assert not tmpdir.join('deploy.json').check()
+    time.sleep(0.5)
+    assert list(json.loads(tmpdir.join('deploy.json').read())['hosts']) == ['10.0.0.1:22']
+    assert tmpdir.join('deploy.jsonl').read() == ''
+    assert not store.dirty
+
+
+def test_relay_args_check_host_key():
+    runner = MultiRunner([], user='core', key_path='/ssh_key')
+    with runner._ssh_config():
+        with open(runner.known_hosts_path, 'w') as f:
+            f.write('10.0.0.1 ssh-ed25519 AAAA\n[10.0.0.2]:2222 ssh-rsa BBBB\n')
+        assert runner._get_known_hosts(Node('10.0.0.2:2222')) == ['[10.0.0.2]:2222 ssh-rsa BBBB']
+
+        args = runner._get_relay_args(Node('10.0.0.3'), Node('10.0.0.1'), ['tar', '-x'], ['cat', '/bundle'])
+        assert args[-5:-1] == ['-A', 'core@10.0.0.3', 'sh', '-c']
+        script = shlex.split(args[-1])[0]
+        assert "printf '%s\\n' '10.0.0.1 ssh-ed25519 AAAA' > \"$known_hosts\"" in script
+        assert '-oStrictHostKeyChecking=yes -oUserKnownHostsFile="$known_hosts"' in script
+        assert subprocess.call(['sh', '-n', '-c', script]) == 0
+
+        # Without a recorded host key the data isn't relayed from that host.
+        assert runner._get_relay_args(Node('10.0.0.3'), Node('10.0.0.4'), ['tar', '-x'], ['cat', '/bundle']) is None
+
+
+def test_pipe_source(tmpdir):
+    def write(f):
+        for _ in range(1024):
+            f.write(b'x' * 1024)
+
+    async def check_output(cmd, source):
+        async with PipeSource(source) as stdin:
+            return subprocess.check_output(cmd, stdin=stdin)
+
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(check_output(['wc', '-c'], write)).strip() == b'1048576'
+
+        # A command which doesn't read all of its input doesn't leave the writer hanging.
+        assert loop.run_until_complete(check_output(['head', '-c', '3'], write)) == b'xxx'
+
+        tmpdir.join('data').write('data')
+        assert loop.run_until_complete(check_output(['cat'], str(tmpdir.join('data')))) == b'data'
+    finally:
+        loop.close()
@@ -3,6 +3,8 @@ import datetime
 import json
 import logging
 import os
+import threading
+import time
 from typing import Callable, Union
 
 log = logging.getLogger(__name__)
@@ -19,6 +21,7 @@ class CommandChain():
     '''
     execute_flag = 'execute'
     copy_flag = 'copy'
+    pipe_flag = 'pipe'
 
     def __init__(self, namespace):
         self.commands_stack = []
@@ -30,6 +33,13 @@ class CommandChain():
     def add_copy(self, local_path, remote_path, remote_to_local=False, recursive=False, stage=None):
         self.commands_stack.append((self.copy_flag, local_path, remote_path, remote_to_local, recursive, stage))
 
+    def add_pipe(self, local_path, cmd: Union[list, Callable], relay_cmd: list=None, stage=None):
+        # Execute cmd on a remote host with the contents of local_path as its standard input. local_path may
+        # also be a callable, which writes the data to the binary file object it is passed.
+        # relay_cmd, if given, writes the same data to stdout on a host which already ran cmd. It lets
+        # the runner have hosts relay the data to each other rather than sending it to each of them.
+        self.commands_stack.append((self.pipe_flag, local_path, cmd, relay_cmd, stage))
+
     def get_commands(self):
         # Return all commands
         return self.commands_stack
@@ -71,6 +81,153 @@ class AbstractSSHLibDelegate(metaclass=abc.ABCMeta):
         :return:
         '''
 
+    def on_output(self, name, host, stage, stream, line):
+        '''
+        A method called for every line a command prints, while it runs
+        :param name: A unique chain identifier
+        :param host: The ssh.Node the command runs on
+        :param stage: String, the stage of the command
+        :param stream: String, stdout or stderr
+        :param line: String, the line without its line break
+        :return:
+        '''
+        pass
+
+    def flush(self):
+        '''
+        A method called once all the chains of a run finished on all hosts.
+        :return:
+        '''
+        pass
+
+
+class ChainStateStore():
+    '''
+    The state of a chain, as shown by <state_dir>/<name>.json.
+
+    Changes are appended as events to the JSON lines log <state_dir>/<name>.jsonl and applied to an in-memory
+    view, which is written to <name>.json atomically at most every snapshot_interval seconds and on flush().
+    An event coming in sooner arms a timer writing it out once the interval is up, so <name>.json is never
+    more than snapshot_interval behind.
+    The log is truncated after each write, or gets a "snapshot" event marking it when that fails, so loading
+    replays the events logged after the last one on top of <name>.json. Replaying is idempotent, an event
+    logged before a snapshot which the log wasn't truncated for is replayed without effect.
+    '''
+    def __init__(self, state_dir, name, snapshot_interval=1):
+        self.snapshot_path = os.path.join(state_dir, '{}.json'.format(name))
+        self.log_path = os.path.join(state_dir, '{}.jsonl'.format(name))
+        self.snapshot_interval = snapshot_interval
+        self.state = {}
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                self.state = json.load(f)
+        for event in self._read_log():
+            self._apply(event)
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
+        # Events come in on the event loop, the trailing flush runs on the timer's thread.
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def _read_log(self):
+        # Return the events logged since the last snapshot.
+        events = []
+        if os.path.isfile(self.log_path):
+            with open(self.log_path) as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+                    if event['type'] == 'snapshot':
+                        events = []
+                    else:
+                        events.append(event)
+        return events
+
+    def _append_log(self, event):
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(event) + '\n')
+        except IOError:
+            log.error('Could not update state log {}'.format(self.log_path))
+
+    def _apply(self, event):
+        state = self.state
+        if event['type'] == 'prepare':
+            if state:
+                return
+            state['hosts'] = {}
+            for host, tags in event['hosts'].items():
+                state['hosts'][host] = {'commands': [], 'tags': tags, 'host_status': 'unstarted'}
+            return
+
+        if 'hosts' not in state:
+            state['hosts'] = {}
+        state.update(event['props'])
+        host = event['host']
+        if event['type'] == 'command':
+            host_state = state['hosts'].setdefault(host, {'commands': []})
+            if len(host_state['commands']) == event['index']:
+                host_state['commands'].append(event['result'])
+            if event['tags'] and 'tags' not in host_state:
+                host_state['tags'] = event['tags']
+
+            # Update chain status to running if not other state found or the status is unstarted.
+            if host_state.get('host_status', 'unstarted') == 'unstarted':
+                host_state['host_status'] = 'running'
+        elif event['type'] == 'status':
+            state['hosts'].setdefault(host, {'commands': []})['host_status'] = event['host_status']
+
+    def add_event(self, event):
+        with self._lock:
+            self._append_log(event)
+            self._apply(event)
+            self.dirty = True
+            wait = self.snapshot_interval - (time.monotonic() - self.last_snapshot)
+            if wait <= 0:
+                self.flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self.dirty:
+                self._write_snapshot()
+
+    def _write_snapshot(self):
+        tmp_path = self.snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except IOError:
+            log.error('Could not update state file {}'.format(self.snapshot_path))
+            return
+        # The snapshot holds every event logged so far, start the log over.
+        try:
+            open(self.log_path, 'w').close()
+        except IOError:
+            self._append_log({'type': 'snapshot'})
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
+
+    def remove_host(self, host):
+        """Forget host, writing the result out right away. Return whether host was known."""
+        with self._lock:
+            if host not in self.state.get('hosts', {}):
+                return False
+            self.state['hosts'].pop(host)
+            self.dirty = True
+            self.flush()
+            return True
+
 
 class JsonDelegate(AbstractSSHLibDelegate):
     def __init__(self, state_dir, targets_len, total_hosts=None, total_masters=None, total_agents=None, **kwargs):
@@ -78,97 +235,59 @@ class JsonDelegate(AbstractSSHLibDelegate):
         self.total_hosts = total_hosts if total_hosts else targets_len
         self.total_masters = total_masters
         self.total_agents = total_agents
+        self._stores = {}
 
-    def _update_chain_props(self, status_json, name):
-        # Update chain properties. We may update the properties
-        if 'hosts' not in status_json:
-            status_json['hosts'] = {}
+    def _get_store(self, name):
+        if name not in self._stores:
+            self._stores[name] = ChainStateStore(self.state_dir, name)
+        return self._stores[name]
 
+    def _chain_props(self, name):
         # Use this hack to update number of total hosts/masters/agent on the fly. This is used on deploy 'retry'.
-        if status_json.get('total_hosts') != self.total_hosts:
-            status_json['total_hosts'] = self.total_hosts
-
-        if status_json.get('total_masters') != self.total_masters:
-            status_json['total_masters'] = self.total_masters
-
-        if status_json.get('total_agents') != self.total_agents:
-            status_json['total_agents'] = self.total_agents
-
-        status_json['chain_name'] = name
-
-    def _read_json_state(self, name):
-        status_file = os.path.join(self.state_dir, '{}.json'.format(name))
-        if os.path.isfile(status_file):
-            with open(status_file) as f:
-                return json.load(f)
-        return {}
-
-    def _dump_json_state(self, name, status_json):
-        status_file = os.path.join(self.state_dir, '{}.json'.format(name))
-
-        with open(status_file, 'w') as f:
-            try:
-                json.dump(status_json, f)
-            except IOError:
-                log.error('Could not update state file {}'.format(status_file))
+        return {
+            'total_hosts': self.total_hosts,
+            'total_masters': self.total_masters,
+            'total_agents': self.total_agents,
+            'chain_name': name}
 
     def on_update(self, future, callback_called):
-        self._update_json_file(*future.result(), future_update=True, callback_called=callback_called)
+        name, result, host_object = future.result()
+        store = self._get_store(name)
+        for host, return_values in result.items():
+            return_values.update({
+                'date': str(datetime.datetime.now())
+            })
+            store.add_event({
+                'type': 'command',
+                'props': self._chain_props(name),
+                'host': host,
+                'index': len(store.state.get('hosts', {}).get(host, {}).get('commands', [])),
+                'result': return_values,
+                'tags': host_object.tags})
+        callback_called.set_result(True)
 
     def on_done(self, name, result, host_status=None):
-        self._update_json_file(name, result, None, host_status=host_status)
-
-    def _update_json_file(self, name, result, host_object, future_update=None, host_status=None, callback_called=None):
-        status_json = self._read_json_state(name)
-        self._update_chain_props(status_json, name)
-
-        for host, return_values in result.items():
-            # Block is executed for on_update callback
-            if future_update:
-                return_values.update({
-                    'date': str(datetime.datetime.now())
-                })
-
-                # Append to commands
-                if host in status_json['hosts']:
-                    status_json['hosts'][host]['commands'].append(return_values)
-                else:
-                    status_json['hosts'][host] = {
-                        'commands': [return_values]
-                    }
-
-                if host_object.tags and 'tags' not in status_json['hosts'][host]:
-                    status_json['hosts'][host]['tags'] = host_object.tags
-
-                # Update chain status to running if not other state found or the status is unstarted.
-                if ('host_status' not in status_json['hosts'][host] or
-                        status_json['hosts'][host]['host_status'] == 'unstarted'):
-                    status_json['hosts'][host]['host_status'] = 'running'
-
-        # Update chain status: success or fail
-        if host_status:
-            status_json['hosts'][host]['host_status'] = host_status
-
-        self._dump_json_state(name, status_json)
-        if callback_called:
-                callback_called.set_result(True)
+        if not host_status:
+            return
+        store = self._get_store(name)
+        for host in result:
+            store.add_event({'type': 'status', 'props': self._chain_props(name), 'host': host,
+                             'host_status': host_status})
 
     # When the function is invoked the json status file will be populated with a list of nodes passed as a parameter.
     # In this case a node should not be in any state and should just wait to be processed.
     def prepare_status(self, name: str, nodes: list):
-
-        json_status = self._read_json_state(name)
+        store = self._get_store(name)
 
         # if status file already exists we should not proceed.
-        if json_status:
+        if store.state:
             return
 
-        json_status['hosts'] = {}
-        for node in nodes:
-            ip_port = '{}:{}'.format(node.ip, node.port)
-            json_status['hosts'][ip_port] = {}
-            json_status['hosts'][ip_port]['commands'] = []
-            json_status['hosts'][ip_port]['tags'] = node.tags
-            json_status['hosts'][ip_port]['host_status'] = 'unstarted'
+        store.add_event({
+            'type': 'prepare',
+            'hosts': {'{}:{}'.format(node.ip, node.port): node.tags for node in nodes}})
+        store.flush()
 
-        self._dump_json_state(name, json_status)
+    def flush(self):
+        for store in self._stores.values():
+            store.flush()
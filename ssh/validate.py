@@ -39,7 +39,17 @@ source = Source({
         lambda agent_list, public_agent_list: compare_lists(agent_list, public_agent_list),
         validate_ssh_key_path,
         lambda ssh_port: gen.calc.validate_int_in_range(ssh_port, 1, 32000),
-        lambda ssh_parallelism: gen.calc.validate_int_in_range(ssh_parallelism, 1, 100)
+        lambda ssh_parallelism: gen.calc.validate_int_in_range(ssh_parallelism, 1, 100),
+        lambda ssh_copy_parallelism: gen.calc.validate_int_in_range(ssh_copy_parallelism, 1, 100),
+        lambda ssh_adaptive_parallelism: gen.calc.validate_true_false(ssh_adaptive_parallelism),
+        lambda ssh_bundle_transfer: gen.calc.validate_true_false(ssh_bundle_transfer),
+        lambda ssh_batched_preflight: gen.calc.validate_true_false(ssh_batched_preflight),
+        # With ssh_fanout set, the hosts relaying data get an ssh-agent holding the ssh key forwarded to them
+        # (ssh -A). For as long as a relay runs, root on the relaying host can use that agent to log in to
+        # every other host with the key. The agent is dedicated to the run and drops the key after an hour,
+        # and relays check the host keys recorded by this host, but only enable it on hosts trusted as much
+        # as the one running the installer.
+        lambda ssh_fanout: gen.calc.validate_int_in_range(ssh_fanout, 0, 100)
     ],
     'default': {
         'ssh_key_path': 'genconf/ssh_key',
@@ -47,7 +57,12 @@ source = Source({
         'public_agent_list': '[]',
         'ssh_port': '22',
         'process_timeout': '120',
-        'ssh_parallelism': '20'
+        'ssh_parallelism': '20',
+        'ssh_copy_parallelism': lambda ssh_parallelism: ssh_parallelism,
+        'ssh_adaptive_parallelism': 'false',
+        'ssh_bundle_transfer': 'true',
+        'ssh_batched_preflight': 'false',
+        'ssh_fanout': '0'
     }
 })
 
@@ -61,6 +76,11 @@ def get_target():
         'agent_list',
         'public_agent_list',
         'ssh_parallelism',
+        'ssh_copy_parallelism',
+        'ssh_adaptive_parallelism',
+        'ssh_bundle_transfer',
+        'ssh_batched_preflight',
+        'ssh_fanout',
         'process_timeout'})
 
 